@@ -0,0 +1,85 @@
+"""Compare ingest throughput of the events dashboard processor modes.
+
+The benchmark writes synthetic content_loaded events into the database
+configured by the usual POSTGRES_* environment variables and removes them
+again when it completes. It should only be pointed at a dev database (e.g.
+the one from the dashboard Docker environment).
+"""
+import argparse
+import time
+import uuid
+from raise_data.processors import events_dashboard_processor
+from raise_data.dashboard.schema import ContentLoadedEvent
+
+BENCHMARK_COURSE_ID = -1
+
+
+def generate_event_rows(num_rows):
+    events = [
+        {
+            "user_uuid": str(uuid.uuid4()),
+            "course_id": BENCHMARK_COURSE_ID,
+            "impression_id": str(uuid.uuid4()),
+            "timestamp": 1671306033221 + i,
+            "content_id": str(uuid.uuid4()),
+            "variant": "main",
+        }
+        for i in range(num_rows)
+    ]
+    return [
+        events_dashboard_processor.transform_event(
+            event, "content_loaded_event"
+        )
+        for event in events
+    ]
+
+
+def clear_benchmark_rows():
+    with events_dashboard_processor.session_factory.begin() as session:
+        session.query(ContentLoadedEvent).filter_by(
+            course_id=BENCHMARK_COURSE_ID
+        ).delete()
+
+
+def time_ingest(ingest_func, event_rows):
+    start = time.perf_counter()
+    ingest_func(event_rows, "content_loaded_event")
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark events dashboard ingest modes"
+    )
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=50000,
+        help="Number of synthetic events per run"
+    )
+    args = parser.parse_args()
+
+    ingest_funcs = {
+        "insert": events_dashboard_processor.insert_events,
+        "copy": events_dashboard_processor.copy_events,
+    }
+
+    clear_benchmark_rows()
+    try:
+        for mode, ingest_func in ingest_funcs.items():
+            event_rows = generate_event_rows(args.rows)
+            new_secs = time_ingest(ingest_func, event_rows)
+            # Replaying the same rows exercises the duplicate handling path
+            replay_secs = time_ingest(ingest_func, event_rows)
+            clear_benchmark_rows()
+
+            print(
+                f"{mode}: {args.rows / new_secs:,.0f} rows/sec new, "
+                f"{args.rows / replay_secs:,.0f} rows/sec replayed"
+            )
+    finally:
+        clear_benchmark_rows()
+
+
+if __name__ == "__main__":
+    main()
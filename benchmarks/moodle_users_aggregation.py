@@ -0,0 +1,158 @@
+"""Measure aggregation throughput of moodle users files.
+
+The benchmark generates a synthetic users payload and times the single
+pass aggregation of the moodle dashboard processor against the previous
+approach of walking the users three times and comparing datetimes. It also
+times the aggregation fed from the streaming JSON reader, as the processor
+does. No database is needed.
+"""
+import argparse
+import hashlib
+import io
+import json
+import random
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from raise_data.processors import moodle_dashboard_processor
+
+BENCHMARK_COURSE_ID = "1"
+DATA_TIMESTAMP_UTC = datetime(2022, 1, 1, 3, 0, 0, tzinfo=timezone.utc)
+
+
+def generate_users_data(num_users):
+    data_timestamp = int(DATA_TIMESTAMP_UTC.timestamp())
+    return [
+        {
+            "id": i,
+            "enrolledcourses": [{
+                "id": int(BENCHMARK_COURSE_ID),
+                "fullname": "Benchmark course"
+            }],
+            "roles": [{
+                "shortname": "student" if i % 30 else "editingteacher"
+            }],
+            "lastcourseaccess": random.choice([
+                0, data_timestamp - random.randint(0, 30 * 24 * 60 * 60)
+            ]),
+            "uuid": str(uuid.uuid4()) if i % 4 else None
+        }
+        for i in range(num_users)
+    ]
+
+
+def aggregate_users_data_three_pass(users_data, data_timestamp_utc):
+    """The previous implementation, kept here as the baseline"""
+    enrolled_students = 0
+    for user in users_data:
+        if user["roles"][0]["shortname"] == "student":
+            enrolled_students += 1
+
+    weekly_active_users = 0
+    daily_active_users = 0
+    for user in users_data:
+        lastaccess_utc = datetime.fromtimestamp(
+            user["lastcourseaccess"], timezone.utc
+        )
+        access_time_delta = data_timestamp_utc - lastaccess_utc
+        if access_time_delta < timedelta(days=7):
+            weekly_active_users += 1
+        if access_time_delta < timedelta(days=1):
+            daily_active_users += 1
+
+    event_user_enrollments = []
+    for user in users_data:
+        maybe_user_uuid = user.get("uuid")
+        if maybe_user_uuid is not None:
+            event_user_enrollments.append({
+                "course_id": BENCHMARK_COURSE_ID,
+                "role": user["roles"][0]["shortname"],
+                "user_uuid_md5": hashlib.md5(
+                    maybe_user_uuid.encode("utf-8")
+                ).hexdigest()
+            })
+
+    return (
+        enrolled_students,
+        weekly_active_users,
+        daily_active_users,
+        event_user_enrollments
+    )
+
+
+def aggregate_users_data_single_pass(users_data, data_timestamp_utc):
+    _, course_activity_stats, event_user_enrollments = \
+        moodle_dashboard_processor.aggregate_users_data(
+            BENCHMARK_COURSE_ID, "term", users_data, data_timestamp_utc
+        )
+    return (
+        course_activity_stats["enrolled_students"],
+        course_activity_stats["weekly_active_users"],
+        course_activity_stats["daily_active_users"],
+        event_user_enrollments
+    )
+
+
+def aggregate_users_file_streamed(users_file, data_timestamp_utc):
+    json_reader = moodle_dashboard_processor.JSONStreamReader(
+        io.BytesIO(users_file)
+    )
+    return aggregate_users_data_single_pass(
+        (json_reader.read_value() for _ in json_reader.iter_array()),
+        data_timestamp_utc
+    )
+
+
+def time_aggregation(aggregate_func, users_data, repeat):
+    best_secs = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = aggregate_func(users_data, DATA_TIMESTAMP_UTC)
+        secs = time.perf_counter() - start
+        best_secs = secs if best_secs is None else min(best_secs, secs)
+    return best_secs, result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark moodle users aggregation"
+    )
+    parser.add_argument(
+        "--users",
+        type=int,
+        default=50000,
+        help="Number of synthetic users in the payload"
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="Number of runs to take the best time from"
+    )
+    args = parser.parse_args()
+
+    users_data = generate_users_data(args.users)
+    users_file = json.dumps(users_data).encode("utf-8")
+
+    three_pass_secs, expected = time_aggregation(
+        aggregate_users_data_three_pass, users_data, args.repeat
+    )
+    single_pass_secs, result = time_aggregation(
+        aggregate_users_data_single_pass, users_data, args.repeat
+    )
+    streamed_secs, streamed_result = time_aggregation(
+        aggregate_users_file_streamed, users_file, args.repeat
+    )
+    if result != expected or streamed_result != expected:
+        raise RuntimeError("Aggregation results don't match")
+
+    for name, secs in [
+        ("three pass", three_pass_secs),
+        ("single pass", single_pass_secs),
+        ("single pass streamed from JSON", streamed_secs),
+    ]:
+        print(f"{name}: {args.users / secs:,.0f} users/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -82,6 +82,19 @@ class CourseContent(Base):
     visible: Mapped[bool]
 
 
+class ProcessedObject(Base):
+    __tablename__ = 'processed_object'
+    __table_args__ = (
+        UniqueConstraint('bucket', 'key', 'version'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    bucket: Mapped[str]
+    key: Mapped[str]
+    version: Mapped[str]
+    row_count: Mapped[int]
+
+
 class ContentLoadedEvent(Base):
     __tablename__ = 'content_loaded_event'
     __table_args__ = (
@@ -3,7 +3,7 @@ import json
 import boto3
 
 
-def create_synthetic_sns_event(s3_bucket, object_key):
+def create_synthetic_sns_event(s3_bucket, object_key, etag=None):
     s3_notification = {
         "Records": [{
             "eventName": "ObjectCreated:Post",
@@ -18,6 +18,12 @@ def create_synthetic_sns_event(s3_bucket, object_key):
         }]
     }
 
+    # Like real notifications, include the unquoted ETag so processors can
+    # skip files they have already processed without fetching them
+    if etag is not None:
+        s3_notification["Records"][0]["s3"]["object"]["eTag"] = \
+            etag.strip('"')
+
     return {
         "Message": json.dumps(s3_notification)
     }
@@ -64,7 +70,11 @@ def main():
         for content in page['Contents']:
             object_key = content.get("Key")
             if object_key.endswith(".avro"):
-                sns_event = create_synthetic_sns_event(s3_bucket, object_key)
+                sns_event = create_synthetic_sns_event(
+                    s3_bucket,
+                    object_key,
+                    content.get("ETag")
+                )
                 sqs_client.send_message(
                     QueueUrl=queue_url,
                     MessageBody=json.dumps(sns_event)
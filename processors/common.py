@@ -1,10 +1,28 @@
+import os
 import time
 import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
 from sqlalchemy.exc import IntegrityError
 from psycopg2.errors import UniqueViolation
 
 SQS_WAIT_TIME_SECS = 20
 SQS_MAX_MESSAGES = 10
+SQS_DELETE_MAX_ATTEMPTS = 3
+SQS_DELETE_RETRY_BASE_SECS = 0.1
+PREFETCH_STOP_CHECK_SECS = 1
+POLL_BACKOFF_INITIAL_SECS = 1
+
+# processor_runner options that can be configured for each processor
+RUNNER_OPTIONS = [
+    "concurrency",
+    "max_in_flight",
+    "visibility_timeout_secs",
+    "prefetch_batches",
+    "check_queue_depth",
+]
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +31,39 @@ class ProcessorException(Exception):
     pass
 
 
+def get_runner_config():
+    """Read the RUNNER_OPTIONS shared by all processors from the
+    environment, so the result can be passed to processor_runner as is.
+    """
+    return {
+        "concurrency": int(os.getenv("PROCESSOR_CONCURRENCY", "1")),
+        "max_in_flight": int(os.getenv("PROCESSOR_MAX_IN_FLIGHT", "0")),
+        "visibility_timeout_secs": int(
+            os.getenv("SQS_VISIBILITY_TIMEOUT_SECS", "0")
+        ),
+        "prefetch_batches": int(os.getenv("SQS_PREFETCH_BATCHES", "0")),
+        "check_queue_depth": os.getenv(
+            "SQS_CHECK_QUEUE_DEPTH", "false"
+        ).lower() == "true"
+    }
+
+
+def get_queue_visibility_timeout(sqs_client, queue_url):
+    res = sqs_client.get_queue_attributes(
+        QueueUrl=queue_url,
+        AttributeNames=["VisibilityTimeout"]
+    )
+    return int(res["Attributes"]["VisibilityTimeout"])
+
+
+def get_approximate_queue_depth(sqs_client, queue_url):
+    res = sqs_client.get_queue_attributes(
+        QueueUrl=queue_url,
+        AttributeNames=["ApproximateNumberOfMessages"]
+    )
+    return int(res["Attributes"]["ApproximateNumberOfMessages"])
+
+
 def get_sqs_messages(sqs_client, queue_url):
     res = sqs_client.receive_message(
         QueueUrl=queue_url,
@@ -22,43 +73,517 @@ def get_sqs_messages(sqs_client, queue_url):
     return res.get("Messages", [])
 
 
+def delete_sqs_messages(sqs_client, queue_url, receipt_handles):
+    """Delete messages using batch requests of up to SQS_MAX_MESSAGES
+    entries. Entries that fail for reasons that aren't the sender's fault
+    are retried, waiting twice as long before each retry starting from
+    SQS_DELETE_RETRY_BASE_SECS. Any remaining failures of a batch are logged
+    together, and those messages will be redelivered by SQS once their
+    visibility timeout expires.
+    """
+    for batch_start in range(0, len(receipt_handles), SQS_MAX_MESSAGES):
+        batch = receipt_handles[batch_start:batch_start + SQS_MAX_MESSAGES]
+        pending = {
+            str(entry_id): receipt_handle
+            for entry_id, receipt_handle in enumerate(batch)
+        }
+        failure_codes = {}
+
+        for attempt in range(SQS_DELETE_MAX_ATTEMPTS):
+            if attempt > 0:
+                time.sleep(SQS_DELETE_RETRY_BASE_SECS * 2 ** (attempt - 1))
+
+            res = sqs_client.delete_message_batch(
+                QueueUrl=queue_url,
+                Entries=[
+                    {"Id": entry_id, "ReceiptHandle": receipt_handle}
+                    for entry_id, receipt_handle in pending.items()
+                ]
+            )
+
+            retryable = {}
+            for failure in res.get("Failed", []):
+                if failure["SenderFault"]:
+                    logger.error(
+                        f"Failed deleting SQS message: {failure['Code']}"
+                    )
+                else:
+                    retryable[failure["Id"]] = pending[failure["Id"]]
+                    failure_codes[failure["Id"]] = failure["Code"]
+            pending = retryable
+
+            if len(pending) == 0:
+                break
+
+        if len(pending) > 0:
+            last_failure_codes = {
+                entry_id: failure_codes[entry_id] for entry_id in pending
+            }
+            logger.error(
+                f"Failed deleting {len(pending)} SQS messages after "
+                f"{SQS_DELETE_MAX_ATTEMPTS} attempts: {last_failure_codes}"
+            )
+
+
+def change_sqs_messages_visibility(
+    sqs_client, queue_url, receipt_handles, visibility_timeout_secs
+):
+    """Set the visibility timeout of messages, in batches of up to
+    SQS_MAX_MESSAGES. Failures are logged and the receipt handles of the
+    messages that couldn't be changed are returned.
+    """
+    failed_handles = []
+    for batch_start in range(0, len(receipt_handles), SQS_MAX_MESSAGES):
+        batch = receipt_handles[batch_start:batch_start + SQS_MAX_MESSAGES]
+        try:
+            res = sqs_client.change_message_visibility_batch(
+                QueueUrl=queue_url,
+                Entries=[
+                    {
+                        "Id": str(entry_id),
+                        "ReceiptHandle": receipt_handle,
+                        "VisibilityTimeout": visibility_timeout_secs
+                    }
+                    for entry_id, receipt_handle in enumerate(batch)
+                ]
+            )
+        except ClientError as e:
+            logger.warning(f"Failed changing SQS message visibility: {e}")
+            failed_handles.extend(batch)
+            continue
+
+        for failure in res.get("Failed", []):
+            logger.warning(
+                f"Failed changing SQS message visibility: {failure['Code']}"
+            )
+            failed_handles.append(batch[int(failure["Id"])])
+
+    return failed_handles
+
+
+class PollScheduler:
+    """Decides how long to wait before the next receive. While messages are
+    flowing the queue is polled again immediately. Once receives come back
+    empty, the wait backs off exponentially from POLL_BACKOFF_INITIAL_SECS
+    up to max_delay_secs. Even an empty response doesn't guarantee the
+    queue is empty, so if check_queue_depth is set the approximate number
+    of messages is checked before backing off.
+    """
+
+    def __init__(
+        self, sqs_client, queue_url, max_delay_secs, check_queue_depth=False
+    ):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.max_delay_secs = max_delay_secs
+        self.check_queue_depth = check_queue_depth
+        self.reset()
+
+    def reset(self):
+        self._delay_secs = min(POLL_BACKOFF_INITIAL_SECS, self.max_delay_secs)
+
+    def next_delay(self, sqs_messages):
+        if len(sqs_messages) > 0:
+            self.reset()
+            return 0
+
+        if self.check_queue_depth and self._queue_has_messages():
+            self.reset()
+            return 0
+
+        delay_secs = self._delay_secs
+        self._delay_secs = min(delay_secs * 2, self.max_delay_secs)
+        return delay_secs
+
+    def _queue_has_messages(self):
+        # The depth check is only an optimization, so if it fails the
+        # scheduler backs off as if the queue were empty
+        try:
+            return get_approximate_queue_depth(
+                self.sqs_client, self.queue_url
+            ) > 0
+        except ClientError as e:
+            logger.warning(f"Failed checking SQS queue depth: {e}")
+            return False
+
+
+class VisibilityHeartbeat:
+    """Background thread which periodically extends the visibility timeout
+    of tracked messages so SQS doesn't redeliver them while they are still
+    being processed. Messages should be untracked once they are deleted or
+    have failed processing.
+    """
+
+    def __init__(
+        self, sqs_client, queue_url, visibility_timeout_secs,
+        interval_secs=None, queue_visibility_timeout_secs=None
+    ):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.visibility_timeout_secs = visibility_timeout_secs
+        # Messages are received with the queue's visibility timeout, which
+        # may be shorter than the one they're extended to. Ticks aren't
+        # aligned with when messages are tracked, so a newly tracked message
+        # needs an extension within half of the shorter timeout.
+        if interval_secs is None:
+            interval_secs = min(
+                visibility_timeout_secs,
+                queue_visibility_timeout_secs or visibility_timeout_secs
+            ) / 2
+        self.interval_secs = interval_secs
+        self._receipt_handles = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def track(self, receipt_handle):
+        with self._lock:
+            self._receipt_handles.add(receipt_handle)
+
+    def untrack(self, receipt_handle):
+        with self._lock:
+            self._receipt_handles.discard(receipt_handle)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval_secs):
+            with self._lock:
+                receipt_handles = list(self._receipt_handles)
+
+            # Failures are expected for messages that were deleted or failed
+            # after the handles were collected, so these are only logged
+            change_sqs_messages_visibility(
+                self.sqs_client,
+                self.queue_url,
+                receipt_handles,
+                self.visibility_timeout_secs
+            )
+
+
+class SQSMessagePrefetcher:
+    """Background thread which keeps receiving messages while the previous
+    batch is being processed. At most prefetch_batches received batches are
+    buffered, and the optional poll_scheduler is used to wait between
+    receives. Prefetched messages are tracked by the heartbeat as soon as
+    they are received so their visibility timeout keeps being extended
+    while they wait. Without a heartbeat, get resets the visibility timeout
+    of a batch when it is handed out, so its messages get the queue's full
+    visibility timeout for processing as if they had just been received.
+    Messages whose timeout already expired, which SQS may have made visible
+    to other consumers again, are dropped.
+    """
+
+    def __init__(
+        self, sqs_client, queue_url, prefetch_batches, heartbeat=None,
+        poll_scheduler=None
+    ):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.heartbeat = heartbeat
+        self.poll_scheduler = poll_scheduler
+        self.visibility_timeout_secs = None
+        if heartbeat is None:
+            self.visibility_timeout_secs = get_queue_visibility_timeout(
+                sqs_client, queue_url
+            )
+        self._batches = queue.Queue(maxsize=prefetch_batches)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self.heartbeat is None:
+            return
+
+        # Messages that were never handed out will become visible again
+        # once their visibility timeout expires
+        while True:
+            try:
+                _, sqs_messages = self._batches.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(sqs_messages, list):
+                for message in sqs_messages:
+                    self.heartbeat.untrack(message["ReceiptHandle"])
+
+    def get(self):
+        """Return the next batch of received messages, dropping any that
+        expired while buffered.
+        """
+        received_at, sqs_messages = self._batches.get()
+        if isinstance(sqs_messages, Exception):
+            raise sqs_messages
+
+        if self.visibility_timeout_secs is None or len(sqs_messages) == 0:
+            return sqs_messages
+
+        waited_secs = time.monotonic() - received_at
+        if waited_secs >= self.visibility_timeout_secs:
+            logger.warning(
+                f"Dropping {len(sqs_messages)} prefetched messages "
+                "which exceeded their visibility timeout"
+            )
+            return []
+
+        failed_handles = set(change_sqs_messages_visibility(
+            self.sqs_client,
+            self.queue_url,
+            [message["ReceiptHandle"] for message in sqs_messages],
+            self.visibility_timeout_secs
+        ))
+        if failed_handles:
+            logger.warning(
+                f"Dropping {len(failed_handles)} prefetched messages "
+                "whose visibility timeout couldn't be reset"
+            )
+        return [
+            message for message in sqs_messages
+            if message["ReceiptHandle"] not in failed_handles
+        ]
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                sqs_messages = get_sqs_messages(
+                    self.sqs_client, self.queue_url
+                )
+            except Exception as e:
+                self._put((time.monotonic(), e))
+                return
+
+            if self.heartbeat:
+                for message in sqs_messages:
+                    self.heartbeat.track(message["ReceiptHandle"])
+            self._put((time.monotonic(), sqs_messages))
+
+            if self.poll_scheduler:
+                # Errors are handed to the consumer like receive errors, as
+                # get would otherwise block forever once this thread exits
+                try:
+                    delay_secs = self.poll_scheduler.next_delay(sqs_messages)
+                except Exception as e:
+                    self._put((time.monotonic(), e))
+                    return
+                self._stopped.wait(delay_secs)
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._batches.put(item, timeout=PREFETCH_STOP_CHECK_SECS)
+                return
+            except queue.Full:
+                continue
+
+
+class MessageWorkerPool:
+    """Thread pool used to process SQS messages concurrently. At most
+    max_in_flight (defaulting to concurrency) messages are submitted to the
+    pool at any given time, and submit blocks until capacity is available.
+    """
+
+    def __init__(self, concurrency=1, max_in_flight=None):
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._in_flight = threading.BoundedSemaphore(
+            max_in_flight or concurrency
+        )
+
+    def submit(self, fn, *args):
+        self._in_flight.acquire()
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(lambda _: self._in_flight.release())
+        return future
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+def process_messages_in_order(processor, sqs_messages):
+    """Process messages one after another, stopping at the first one that
+    raises a ProcessorException so later messages aren't processed ahead of
+    it. Returns the processed messages and the exception, if any.
+    """
+    processed_messages = []
+    for message in sqs_messages:
+        try:
+            processor(message)
+        except ProcessorException as e:
+            return processed_messages, e
+        processed_messages.append(message)
+    return processed_messages, None
+
+
+def process_sqs_messages(
+    sqs_client, queue_url, sqs_messages, processor, worker_pool,
+    heartbeat=None, batch_processor=None, ordering_key=None
+):
+    """Process a batch of received messages on the worker pool. Messages that
+    are processed successfully are deleted in a batch once all of them have
+    finished. ProcessorExceptions are logged and the corresponding messages
+    are left for SQS to redeliver. Any other exception is propagated.
+
+    If batch_processor is given, it is called once with all of the messages
+    instead. Should it raise a ProcessorException, the messages are retried
+    individually with processor so one bad message doesn't hold back the
+    rest of the batch.
+
+    If ordering_key is given, messages with the same key are processed one
+    after another in the order they were received, while messages with
+    different keys are processed concurrently. When one of them fails, the
+    later messages with its key are left for redelivery as well.
+    """
+    if heartbeat:
+        for message in sqs_messages:
+            heartbeat.track(message["ReceiptHandle"])
+
+    try:
+        processed_messages = None
+        if batch_processor and len(sqs_messages) > 1:
+            try:
+                worker_pool.submit(batch_processor, sqs_messages).result()
+                processed_messages = sqs_messages
+            except ProcessorException as e:
+                logger.warning(
+                    "Failed processing SQS message batch, retrying messages "
+                    f"individually: {e}"
+                )
+
+        if processed_messages is None:
+            processed_messages = []
+            if ordering_key is None:
+                message_groups = [[message] for message in sqs_messages]
+            else:
+                messages_by_key = {}
+                for message in sqs_messages:
+                    messages_by_key.setdefault(
+                        ordering_key(message), []
+                    ).append(message)
+                message_groups = list(messages_by_key.values())
+
+            processing = [
+                (
+                    messages,
+                    worker_pool.submit(
+                        process_messages_in_order, processor, messages
+                    )
+                )
+                for messages in message_groups
+            ]
+            for messages, future in processing:
+                group_processed_messages, error = future.result()
+                processed_messages.extend(group_processed_messages)
+                if error is None:
+                    continue
+
+                logger.error(f"Failed processing SQS message: {error}")
+                unprocessed_messages = \
+                    messages[len(group_processed_messages):]
+                if len(unprocessed_messages) > 1:
+                    logger.warning(
+                        f"Skipped {len(unprocessed_messages) - 1} later "
+                        "SQS messages with the same ordering key"
+                    )
+                if heartbeat:
+                    for message in unprocessed_messages:
+                        heartbeat.untrack(message["ReceiptHandle"])
+
+        # Delete successfully processed messages from SQS
+        if len(processed_messages) > 0:
+            delete_sqs_messages(
+                sqs_client,
+                queue_url,
+                [message["ReceiptHandle"] for message in processed_messages]
+            )
+    finally:
+        if heartbeat:
+            for message in sqs_messages:
+                heartbeat.untrack(message["ReceiptHandle"])
+
+
 def processor_runner(
-    sqs_client, sqs_queue_name, processor, poll_interval_mins, daemonize
+    sqs_client, sqs_queue_name, processor, poll_interval_mins, daemonize,
+    concurrency=1, max_in_flight=None, visibility_timeout_secs=None,
+    prefetch_batches=0, check_queue_depth=False, batch_processor=None,
+    ordering_key=None
 ):
+    """Poll an SQS queue and hand each message to processor. Messages are
+    processed on a MessageWorkerPool with the given concurrency and
+    max_in_flight limits. If visibility_timeout_secs is set, a heartbeat
+    keeps extending the visibility timeout of messages to that value until
+    they are deleted or fail. When daemonized with prefetch_batches set,
+    an SQSMessagePrefetcher receives the next batches while the current
+    one is processed. Waits between receives are decided by a PollScheduler
+    capped at poll_interval_mins. An optional batch_processor handles all
+    messages from a receive at once, and an optional ordering_key serializes
+    messages that share a key (see process_sqs_messages).
+    """
     queue_url_data = sqs_client.get_queue_url(
         QueueName=sqs_queue_name
     )
     queue_url = queue_url_data["QueueUrl"]
+    worker_pool = MessageWorkerPool(concurrency, max_in_flight)
 
-    while True:
-        sqs_messages = get_sqs_messages(sqs_client, queue_url)
-        for message in sqs_messages:
-            receipt_handle = message["ReceiptHandle"]
+    heartbeat = None
+    if visibility_timeout_secs:
+        heartbeat = VisibilityHeartbeat(
+            sqs_client,
+            queue_url,
+            visibility_timeout_secs,
+            queue_visibility_timeout_secs=get_queue_visibility_timeout(
+                sqs_client, queue_url
+            )
+        )
+        heartbeat.start()
 
-            try:
-                processor(message)
+    poll_scheduler = PollScheduler(
+        sqs_client, queue_url, poll_interval_mins*60, check_queue_depth
+    )
 
-                # Message processed successfully. Delete from SQS.
-                sqs_client.delete_message(
-                    QueueUrl=queue_url,
-                    ReceiptHandle=receipt_handle
-                )
-            except ProcessorException as e:
-                logger.error(f"Failed processing SQS message: {e}")
-
-        if not daemonize:
-            break
-
-        # Only sleep if the long polling request didn't return any messages.
-        # Otherwise we should keep trying to retrieve messages in order to
-        # drain the queue as SQS may not have returned all available / max
-        # requested. Even an empty response doesn't guarantee the queue
-        # is empty, so this is just a heuristic to balance timely processing
-        # with SQS requests when the polling interval is non-zero.
-        if len(sqs_messages) == 0:  # pragma: no cover
-            time.sleep(poll_interval_mins*60)
-        else:  # pragma: no cover
-            logger.info(f"Received {len(sqs_messages)} messages")
+    prefetcher = None
+    if daemonize and prefetch_batches:
+        prefetcher = SQSMessagePrefetcher(
+            sqs_client, queue_url, prefetch_batches, heartbeat,
+            poll_scheduler
+        )
+        prefetcher.start()
+
+    try:
+        while True:
+            if prefetcher:
+                sqs_messages = prefetcher.get()
+            else:
+                sqs_messages = get_sqs_messages(sqs_client, queue_url)
+            process_sqs_messages(
+                sqs_client, queue_url, sqs_messages, processor, worker_pool,
+                heartbeat, batch_processor, ordering_key
+            )
+
+            if not daemonize:
+                break
+
+            if len(sqs_messages) > 0:  # pragma: no cover
+                logger.info(f"Received {len(sqs_messages)} messages")
+
+            # The prefetcher waits between its own receives. Otherwise we
+            # keep retrieving messages without waiting while they're flowing
+            # in order to drain the queue, as SQS may not have returned all
+            # available / max requested, and back off once it looks idle.
+            if not prefetcher:  # pragma: no cover
+                time.sleep(poll_scheduler.next_delay(sqs_messages))
+    finally:
+        if prefetcher:
+            prefetcher.stop()
+        worker_pool.shutdown()
+        if heartbeat:
+            heartbeat.stop()
 
 
 def commit_ignoring_unique_violations(session):
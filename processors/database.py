@@ -0,0 +1,54 @@
+import os
+from sqlalchemy import create_engine, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import sessionmaker
+from raise_data.dashboard.schema import ProcessedObject
+
+# We setup the sqlalchemy resources at global scope and so read some expected
+# environment variables here. If they end up being missing, we'll fail later
+# anyways. Processors that run in the same process share this engine and its
+# connection pool.
+
+pg_server = os.getenv("POSTGRES_SERVER", "")
+pg_db = os.getenv("POSTGRES_DB", "")
+pg_user = os.getenv("POSTGRES_USER", "")
+pg_password = os.getenv("POSTGRES_PASSWORD", "")
+pg_pool_size = int(os.getenv("POSTGRES_POOL_SIZE", "5"))
+sqlalchemy_url = f"postgresql://{pg_user}:{pg_password}@{pg_server}/{pg_db}"
+
+engine = create_engine(sqlalchemy_url, pool_size=pg_pool_size)
+session_factory = sessionmaker(engine)
+
+
+def get_object_version(etag):
+    """S3 object ETags are quoted in API responses but not in notifications,
+    so they are normalized before being used as a ledger version.
+    """
+    if etag is None:
+        return None
+    return etag.strip('"')
+
+
+def object_processed(bucket, key, version):
+    with session_factory() as session:
+        return session.scalar(
+            select(ProcessedObject.id).filter_by(
+                bucket=bucket, key=key, version=version
+            )
+        ) is not None
+
+
+def record_processed_object(session, bucket, key, version, row_count):
+    """Add an S3 object version to the processed_object ledger. This should
+    be done in the same transaction that stores the results from the object
+    so the ledger never lists an object whose results weren't committed.
+    """
+    session.execute(
+        insert(ProcessedObject).on_conflict_do_nothing(),
+        [{
+            "bucket": bucket,
+            "key": key,
+            "version": version,
+            "row_count": row_count
+        }]
+    )
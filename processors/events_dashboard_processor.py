@@ -1,40 +1,42 @@
 import os
 import argparse
 import boto3
+import csv
+import io
 import json
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from fastavro import reader
 from datetime import datetime, timezone
 from urllib.parse import unquote
 import hashlib
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from .common import (
-    ProcessorException,
-    processor_runner,
-    commit_ignoring_unique_violations,
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from .common import ProcessorException, get_runner_config, processor_runner
+from .database import (
+    session_factory,
+    get_object_version,
+    object_processed,
+    record_processed_object,
 )
 from raise_data.dashboard.schema import (
     ContentLoadedEvent,
     PsetProblemAttemptedEvent,
     InputSubmittedEvent,
+    generate_utc_timestamp,
 )
 
 
 logging.basicConfig(level=logging.INFO)
 
-# We setup the sqlalchemy resources at global scope and so read some expected
-# environment variables here. If they end up being missing, we'll fail later
-# anyways.
+EVENT_MODELS = {
+    "content_loaded_event": ContentLoadedEvent,
+    "input_submitted_event": InputSubmittedEvent,
+    "pset_problem_attempted_event": PsetProblemAttemptedEvent,
+}
 
-pg_server = os.getenv("POSTGRES_SERVER", "")
-pg_db = os.getenv("POSTGRES_DB", "")
-pg_user = os.getenv("POSTGRES_USER", "")
-pg_password = os.getenv("POSTGRES_PASSWORD", "")
-sqlalchemy_url = f"postgresql://{pg_user}:{pg_password}@{pg_server}/{pg_db}"
-
-engine = create_engine(sqlalchemy_url)
-session_factory = sessionmaker(engine)
+INGEST_MODES = ["insert", "copy"]
 
 
 def get_config():
@@ -43,6 +45,8 @@ def get_config():
             "consumer_queue": os.environ["SQS_QUEUE"],
             "poll_interval_mins": int(os.environ["POLL_INTERVAL_MINS"]),
             "event_type": os.environ["EVENT_TYPE"],
+            "ingest_mode": os.getenv("INGEST_MODE", "insert"),
+            "decode_workers": int(os.getenv("DECODE_WORKERS", "0")),
             "postgres_server": os.environ["POSTGRES_SERVER"],
             "postgres_db": os.environ["POSTGRES_DB"],
             "postgres_user": os.environ["POSTGRES_USER"],
@@ -58,7 +62,7 @@ def timestamp_utc_conversion(millisecond_timestamp):
     return timestamp_utc
 
 
-def process_events(event_data, event_type):
+def transform_event(event_data, event_type):
     event_timestamp_utc = timestamp_utc_conversion(event_data["timestamp"])
     user_uuid_md5 = hashlib.md5(
         event_data["user_uuid"].encode("utf-8")
@@ -88,18 +92,111 @@ def process_events(event_data, event_type):
         modified_event_data["attempt"] = event_data["attempt"]
         modified_event_data["final_attempt"] = event_data["final_attempt"]
 
-    with session_factory() as session:
-        if event_type == "content_loaded_event":
-            session.add(ContentLoadedEvent(**modified_event_data))
-        elif event_type == "input_submitted_event":
-            session.add(InputSubmittedEvent(**modified_event_data))
-        elif event_type == "pset_problem_attempted_event":
-            session.add(PsetProblemAttemptedEvent(**modified_event_data))
-
-        commit_ignoring_unique_violations(session)
+    return modified_event_data
+
+
+def decode_event_rows(event_file, event_type):
+    """Decode an Avro file of events and transform them into table rows.
+    This is kept at module level so it can be run in a worker process, in
+    which case event_file is the raw bytes of the S3 object.
+    """
+    if isinstance(event_file, bytes):
+        event_file = io.BytesIO(event_file)
+
+    return [
+        transform_event(event, event_type) for event in reader(event_file)
+    ]
+
+
+def insert_events(event_rows, event_type, processed_object=None):
+    """Insert all rows for a file in a single transaction. SQLAlchemy batches
+    the parameter sets into multi-row INSERT statements, and ON CONFLICT DO
+    NOTHING lets the unique constraints on each event table silently drop
+    previously ingested events. If processed_object is set, the file is
+    added to the processed_object ledger in the same transaction.
+    """
+    event_model = EVENT_MODELS[event_type]
+
+    with session_factory.begin() as session:
+        if len(event_rows) > 0:
+            session.execute(
+                insert(event_model).on_conflict_do_nothing(),
+                event_rows
+            )
+        if processed_object is not None:
+            record_processed_object(
+                session, row_count=len(event_rows), **processed_object
+            )
+
+
+def copy_events(event_rows, event_type, processed_object=None):
+    """Stream rows into a temporary staging table using COPY and then merge
+    them into the event table. This avoids per-row statement overhead for
+    large backfills while keeping the ON CONFLICT DO NOTHING semantics of
+    insert_events.
+    """
+    # There's nothing to stage, but the file may still need to be recorded
+    if len(event_rows) == 0:
+        insert_events(event_rows, event_type, processed_object)
+        return
+
+    event_table = EVENT_MODELS[event_type].__table__.name
+    staging_table = f"{event_table}_staging"
+    columns = list(event_rows[0].keys())
+    column_list = ", ".join(f'"{column}"' for column in columns)
+
+    # The timestamp is staged as timestamptz so the UTC offset in the CSV
+    # data is honored the same way it is for bound parameters
+    staging_columns = ", ".join(
+        f'"{column}"::timestamptz AS "{column}"' if column == "timestamp"
+        else f'"{column}"'
+        for column in columns
+    )
 
+    csv_data = io.StringIO()
+    csv_writer = csv.writer(csv_data)
+    for row in event_rows:
+        csv_writer.writerow([row[column] for column in columns])
+    csv_data.seek(0)
+
+    with session_factory.begin() as session:
+        cursor = session.connection().connection.cursor()
+        cursor.execute(
+            f"CREATE TEMP TABLE {staging_table} ON COMMIT DROP AS "
+            f"SELECT {staging_columns} FROM {event_table} WITH NO DATA"
+        )
+        # CSV reads unquoted empty fields as NULL, which csv.writer also
+        # writes for empty strings. The event columns are all NOT NULL, so
+        # empty fields are read as empty strings like they are inserted.
+        cursor.copy_expert(
+            f"COPY {staging_table} ({column_list}) FROM STDIN "
+            f"WITH (FORMAT csv, FORCE_NOT_NULL ({column_list}))",
+            csv_data
+        )
+        session.execute(
+            text(
+                f"INSERT INTO {event_table} "
+                f"({column_list}, created_at, updated_at) "
+                f"SELECT {column_list}, :timestamp, :timestamp "
+                f"FROM {staging_table} ON CONFLICT DO NOTHING"
+            ),
+            {"timestamp": generate_utc_timestamp()}
+        )
+        if processed_object is not None:
+            record_processed_object(
+                session, row_count=len(event_rows), **processed_object
+            )
+
+
+def process_s3_notification(
+    s3_client, s3_notification, event_type, ingest_mode="insert",
+    decode_pool=None
+):
+    if event_type not in EVENT_MODELS:  # pragma: no cover
+        raise ProcessorException(f"Unexpected event type {event_type}")
+    if ingest_mode not in INGEST_MODES:  # pragma: no cover
+        raise ProcessorException(f"Unexpected ingest mode {ingest_mode}")
 
-def process_s3_notification(s3_client, s3_notification, event_type):
     for record in s3_notification["Records"]:
         event_name = record["eventName"]
 
@@ -110,32 +207,72 @@ def process_s3_notification(s3_client, s3_notification, event_type):
         bucket = s3_data["bucket"]["name"]
         key = unquote(s3_data["object"]["key"])
 
-        event_data = s3_client.get_object(Bucket=bucket, Key=key)
-
-        expected_events = set([
-            "content_loaded_event",
-            "input_submitted_event",
-            "pset_problem_attempted_event",
-        ])
-
-        avro_reader = reader(event_data["Body"])
-        for event in avro_reader:
-            if event_type in expected_events:
-                process_events(event, event_type)
-            else:  # pragma: no cover
-                raise ProcessorException(f"Unexpected event type {event_type}")
+        # Files are skipped before they are fetched if the notification
+        # includes the ETag, or otherwise before they are decoded
+        version = get_object_version(s3_data["object"].get("eTag"))
+        if version is not None and object_processed(bucket, key, version):
+            logging.info(f"Ignoring previously processed file: {key}")
+            continue
 
+        event_data = s3_client.get_object(Bucket=bucket, Key=key)
 
-def get_sqs_message_processor(s3_client, event_type):
+        if version is None:
+            version = get_object_version(event_data.get("ETag"))
+            if version is not None and object_processed(bucket, key, version):
+                logging.info(f"Ignoring previously processed file: {key}")
+                continue
+        processed_object = None
+        if version is not None:
+            processed_object = {
+                "bucket": bucket,
+                "key": key,
+                "version": version
+            }
+
+        # Decoding is CPU bound, so it can optionally be moved to a process
+        # pool leaving only the database writes in this process
+        if decode_pool:
+            event_rows = decode_pool.submit(
+                decode_event_rows, event_data["Body"].read(), event_type
+            ).result()
+        else:
+            event_rows = decode_event_rows(event_data["Body"], event_type)
+
+        if ingest_mode == "copy":
+            copy_events(event_rows, event_type, processed_object)
+        else:
+            insert_events(event_rows, event_type, processed_object)
+
+
+def get_sqs_message_processor(
+    s3_client, event_type, ingest_mode="insert", decode_pool=None
+):
     def inner(sqs_message):
         sns_data = json.loads(sqs_message["Body"])
         s3_notification = json.loads(sns_data["Message"])
 
-        process_s3_notification(s3_client, s3_notification, event_type)
+        process_s3_notification(
+            s3_client, s3_notification, event_type, ingest_mode, decode_pool
+        )
 
     return inner
 
 
+def get_decode_pool(decode_workers):
+    if decode_workers <= 0:
+        return None
+
+    # Each message waits on its own file being decoded, so decode workers
+    # only run in parallel when the concurrency is larger than one. The
+    # pool starts its workers lazily from runner threads, and a process
+    # forked while other threads hold locks can deadlock, so the workers are
+    # spawned instead of forked
+    return ProcessPoolExecutor(
+        max_workers=decode_workers,
+        mp_context=multiprocessing.get_context("spawn")
+    )
+
+
 def main():
     logging.info("Starting processor...")
     parser = argparse.ArgumentParser(description="")
@@ -151,17 +288,27 @@ def main():
     sqs_client = boto3.client("sqs")
     s3_client = boto3.client("s3")
 
+    decode_pool = get_decode_pool(config["decode_workers"])
+
     processor = get_sqs_message_processor(
-        s3_client=s3_client, event_type=config["event_type"]
+        s3_client=s3_client,
+        event_type=config["event_type"],
+        ingest_mode=config["ingest_mode"],
+        decode_pool=decode_pool
     )
 
-    processor_runner(
-        sqs_client=sqs_client,
-        sqs_queue_name=config["consumer_queue"],
-        processor=processor,
-        poll_interval_mins=config["poll_interval_mins"],
-        daemonize=daemonize,
-    )
+    try:
+        processor_runner(
+            sqs_client=sqs_client,
+            sqs_queue_name=config["consumer_queue"],
+            processor=processor,
+            poll_interval_mins=config["poll_interval_mins"],
+            daemonize=daemonize,
+            **get_runner_config()
+        )
+    finally:
+        if decode_pool:
+            decode_pool.shutdown()
 
 
 if __name__ == "__main__":  # pragma: no cover
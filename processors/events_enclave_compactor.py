@@ -0,0 +1,299 @@
+import os
+import io
+import argparse
+import boto3
+import logging
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from fastavro import reader, writer, parse_schema
+from .common import ProcessorException
+from .events_enclave_processor import (
+    AVRO_CODECS,
+    CONDITIONAL_WRITE_MAX_ATTEMPTS,
+    OUTPUT_CODECS,
+    OUTPUT_FORMATS,
+    OutputConflictException,
+    decode_json_object,
+    get_json_data,
+    get_json_data_and_etag,
+    get_manifest_key,
+    get_output_prefix,
+    get_write_condition,
+    put_json_data,
+    register_conditional_writes,
+)
+
+
+logging.basicConfig(level=logging.INFO)
+
+DELETE_OBJECTS_MAX_KEYS = 1000
+
+
+def get_config():
+    try:
+        return {
+            "output_bucket": os.environ["JSON_OUTPUT_S3_BUCKET"],
+            "output_key": os.environ["JSON_OUTPUT_S3_KEY"],
+            "output_format": os.getenv("OUTPUT_FORMAT", "json"),
+            "output_codec": os.getenv("OUTPUT_CODEC") or None,
+            # The fields identifying an event differ between event types, so
+            # there's no default
+            "dedupe_fields": os.environ["DEDUPE_FIELDS"].split(",")
+        }
+    except KeyError as e:
+        raise ProcessorException(f"Missing expected environment variable: {e}")
+
+
+def get_partition_key(output_key, day, compaction_id, output_format):
+    """Every compaction writes new partition objects so readers of the
+    previous manifest can still read the partitions it references.
+    """
+    return (
+        f"{get_output_prefix(output_key)}/partitions/{day}/"
+        f"{compaction_id}.{output_format}"
+    )
+
+
+def get_event_day(event):
+    timestamp = event["timestamp"]
+    if not isinstance(timestamp, datetime):
+        timestamp = datetime.fromtimestamp(timestamp / 1000, timezone.utc)
+    return timestamp.date().isoformat()
+
+
+def read_events(s3_client, bucket, key):
+    """Returns the events in a shard or partition along with their Avro
+    schema, which is None for JSON objects. Objects referenced by the
+    manifest must exist, so a missing one is an error rather than empty.
+    """
+    try:
+        data = s3_client.get_object(Bucket=bucket, Key=key)
+    except s3_client.exceptions.NoSuchKey:
+        raise ProcessorException(f"Missing compaction input {key}")
+
+    if key.endswith(".avro"):
+        avro_reader = reader(data["Body"])
+        return list(avro_reader), avro_reader.writer_schema
+    return decode_json_object(data)["data"], None
+
+
+def dedupe_events(events, dedupe_fields):
+    """Drop all but the first of the events which share dedupe_fields."""
+    seen = set()
+    for event in events:
+        event_id = tuple(event.get(field) for field in dedupe_fields)
+        if event_id in seen:
+            continue
+        seen.add(event_id)
+        yield event
+
+
+def put_partition(
+    s3_client, bucket, key, events, schema, output_format, output_codec
+):
+    if output_format == "avro":
+        if schema is None:
+            raise ProcessorException(
+                "Avro partitions can only be written from Avro shards"
+            )
+        output = io.BytesIO()
+        writer(
+            output,
+            parse_schema(schema),
+            events,
+            codec=AVRO_CODECS.get(output_codec, "null")
+        )
+        s3_client.put_object(Body=output.getvalue(), Bucket=bucket, Key=key)
+    else:
+        put_json_data(
+            s3_client, bucket, key, {"data": list(events)}, codec=output_codec
+        )
+
+
+def update_manifest(
+    s3_client, bucket, manifest_key, compacted_shards, partitions,
+    output_codec
+):
+    """Replace the compacted shards in the manifest with the partitions.
+    Processors may add shards while the compaction is running, so the
+    manifest is written conditionally and the update is reapplied to the
+    latest manifest on conflicts.
+
+    The compacted shards and replaced partitions aren't deleted right away.
+    They are listed as retired in the manifest and deleted by the next run,
+    unless the manifest references them again by then, so a writer still
+    holding an older manifest can't lose data. Returns the objects retired
+    by earlier runs which can now be deleted.
+    """
+    compacted = set(compacted_shards)
+    for attempt in range(1, CONDITIONAL_WRITE_MAX_ATTEMPTS + 1):
+        manifest, etag = get_json_data_and_etag(
+            s3_client, bucket, manifest_key
+        )
+        existing_partitions = manifest.get("partitions", {})
+        # Anything the manifest references now, including the objects this
+        # run replaces, is still in use
+        referenced = set(manifest["shards"]) | \
+            set(existing_partitions.values())
+        deletable = [
+            key for key in manifest.get("retired", [])
+            if key not in referenced
+        ]
+
+        replaced_partitions = [
+            existing_partitions[day]
+            for day in partitions
+            if day in existing_partitions
+        ]
+        manifest["shards"] = [
+            shard for shard in manifest["shards"]
+            if shard not in compacted
+        ]
+        manifest["partitions"] = {**existing_partitions, **partitions}
+        # Retired objects which are referenced again are kept in the list so
+        # a later run can delete them once they're no longer referenced
+        manifest["retired"] = list(dict.fromkeys(
+            [key for key in manifest.get("retired", []) if key in referenced]
+            + replaced_partitions
+            + [shard for shard in compacted_shards if shard in referenced]
+        ))
+
+        try:
+            put_json_data(
+                s3_client,
+                bucket,
+                manifest_key,
+                manifest,
+                codec=output_codec,
+                condition=get_write_condition(etag, True)
+            )
+            return deletable
+        except OutputConflictException as e:
+            if attempt == CONDITIONAL_WRITE_MAX_ATTEMPTS:
+                raise
+            logging.info(f"Retrying after write conflict: {e}")
+
+
+def delete_objects(s3_client, bucket, keys):
+    for i in range(0, len(keys), DELETE_OBJECTS_MAX_KEYS):
+        res = s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={
+                "Objects": [
+                    {"Key": key}
+                    for key in keys[i:i + DELETE_OBJECTS_MAX_KEYS]
+                ],
+                "Quiet": True
+            }
+        )
+        # Leftover objects aren't referenced by the manifest, so failures
+        # are only logged
+        for error in res.get("Errors", []):
+            logging.warning(
+                f"Failed deleting {error['Key']}: {error['Code']}"
+            )
+
+
+def compact_output(
+    s3_client, output_bucket, output_key, dedupe_fields,
+    output_format="json", output_codec=None, max_shards=None
+):
+    """Merge the shards of a sharded enclave output into daily partitions.
+    Events are grouped by the UTC day of their timestamp and merged with the
+    existing partition for the day, dropping events which duplicate an
+    earlier one by dedupe_fields. New partitions are written before the
+    manifest is updated to reference them, and replaced objects are only
+    deleted by a later run, so readers always see a complete output.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ProcessorException(f"Unexpected output format {output_format}")
+    if output_codec is not None and output_codec not in OUTPUT_CODECS:
+        raise ProcessorException(f"Unexpected output codec {output_codec}")
+
+    manifest_key = get_manifest_key(output_key)
+    manifest = get_json_data(
+        s3_client,
+        output_bucket,
+        manifest_key,
+        default={"data_sources": [], "shards": []}
+    )
+    shards = manifest["shards"][:max_shards]
+    if not shards and not manifest.get("retired"):
+        logging.info("No shards to compact")
+        return
+
+    compaction_id = uuid.uuid4().hex
+    events_by_day = defaultdict(list)
+    schema = None
+    for shard in shards:
+        events, shard_schema = read_events(s3_client, output_bucket, shard)
+        schema = schema or shard_schema
+        for event in events:
+            events_by_day[get_event_day(event)].append(event)
+
+    partitions = {}
+    for day in sorted(events_by_day):
+        events = events_by_day[day]
+        existing_partition = manifest.get("partitions", {}).get(day)
+        if existing_partition is not None:
+            existing_events, partition_schema = read_events(
+                s3_client, output_bucket, existing_partition
+            )
+            events = existing_events + events
+            schema = schema or partition_schema
+
+        partitions[day] = get_partition_key(
+            output_key, day, compaction_id, output_format
+        )
+        put_partition(
+            s3_client,
+            output_bucket,
+            partitions[day],
+            dedupe_events(events, dedupe_fields),
+            schema,
+            output_format,
+            output_codec
+        )
+
+    deletable = update_manifest(
+        s3_client,
+        output_bucket,
+        manifest_key,
+        shards,
+        partitions,
+        output_codec
+    )
+    delete_objects(s3_client, output_bucket, deletable)
+    logging.info(
+        f"Compacted {len(shards)} shards into {len(partitions)} partitions"
+    )
+
+
+def main():
+    logging.info("Starting compactor...")
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument(
+        "--max-shards",
+        type=int,
+        help="Maximum number of shards to compact in this run"
+    )
+    args = parser.parse_args()
+    config = get_config()
+
+    s3_client = boto3.client("s3")
+    register_conditional_writes(s3_client)
+
+    compact_output(
+        s3_client=s3_client,
+        output_bucket=config["output_bucket"],
+        output_key=config["output_key"],
+        dedupe_fields=config["dedupe_fields"],
+        output_format=config["output_format"],
+        output_codec=config["output_codec"],
+        max_shards=args.max_shards
+    )
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -1,15 +1,61 @@
 import os
+import io
 import argparse
 import boto3
 import json
 import logging
-from fastavro import reader
+import hashlib
+import re
+import zlib
+import cramjam
+from functools import partial
+from botocore.exceptions import ClientError
+from fastavro import reader, writer, parse_schema
 from urllib.parse import unquote
-from .common import ProcessorException, processor_runner
+from .common import ProcessorException, get_runner_config, processor_runner
 
 
 logging.basicConfig(level=logging.INFO)
 
+OUTPUT_LAYOUTS = ["document", "sharded"]
+OUTPUT_FORMATS = ["json", "avro"]
+OUTPUT_CODECS = {
+    "gzip": cramjam.gzip,
+    "zstd": cramjam.zstd,
+    "snappy": cramjam.snappy,
+}
+# Avro output is compressed per block with the equivalent Avro codec so the
+# container files remain readable by any Avro reader
+AVRO_CODECS = {
+    "gzip": "deflate",
+    "snappy": "snappy",
+}
+# Codecs which can be decompressed incrementally for streaming output
+STREAMING_CODECS = ["gzip"]
+# S3 requires every part of a multipart upload except the last to be at
+# least 5 MiB
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+STREAM_BUFFER_SIZE = 1024 * 1024
+DOCUMENT_START = re.compile(rb'\s*\{\s*"data_sources"\s*:\s*')
+DOCUMENT_DATA_START = re.compile(rb'\s*,\s*"data"\s*:\s*\[')
+DOCUMENT_END = re.compile(rb'\]\s*\}\s*$')
+DOCUMENT_END_MAX_BYTES = 64
+# Conditional writes are sent as headers since the pinned botocore predates
+# these S3 parameters
+CONDITIONAL_WRITE_HEADERS = {
+    "IfMatch": "If-Match",
+    "IfNoneMatch": "If-None-Match",
+}
+CONDITIONAL_WRITE_OPERATIONS = ["PutObject", "CompleteMultipartUpload"]
+WRITE_CONFLICT_ERRORS = ["PreconditionFailed", "ConditionalRequestConflict"]
+CONDITIONAL_WRITE_MAX_ATTEMPTS = 5
+STRIPPED_EVENT_FIELDS = [
+    "source_scheme",
+    "source_host",
+    "source_path",
+    "source_query",
+]
+
 
 def get_config():
     try:
@@ -17,36 +63,145 @@ def get_config():
             "consumer_queue": os.environ["SQS_QUEUE"],
             "poll_interval_mins": int(os.environ["POLL_INTERVAL_MINS"]),
             "output_bucket": os.environ["JSON_OUTPUT_S3_BUCKET"],
-            "output_key": os.environ["JSON_OUTPUT_S3_KEY"]
+            "output_key": os.environ["JSON_OUTPUT_S3_KEY"],
+            "output_layout": os.getenv("OUTPUT_LAYOUT", "document"),
+            "output_format": os.getenv("OUTPUT_FORMAT", "json"),
+            "output_codec": os.getenv("OUTPUT_CODEC") or None,
+            "conditional_writes": os.getenv(
+                "CONDITIONAL_WRITES", "false"
+            ).lower() == "true",
+            "streaming_output": os.getenv(
+                "STREAMING_OUTPUT", "false"
+            ).lower() == "true",
+            "data_sources_sidecar": os.getenv(
+                "DATA_SOURCES_SIDECAR", "false"
+            ).lower() == "true"
         }
     except KeyError as e:
         raise ProcessorException(f"Missing expected environment variable: {e}")
 
 
-def get_json_data(s3_client, bucket, key):
+class OutputConflictException(ProcessorException):
+    pass
+
+
+def get_json_data(s3_client, bucket, key, default=None):
+    return get_json_data_and_etag(s3_client, bucket, key, default)[0]
+
+
+def decode_json_object(data):
+    """Parse the JSON contents of a get_object response, decompressing them
+    based on the ContentEncoding if they use one of the OUTPUT_CODECS.
+    """
+    contents = data["Body"].read()
+    content_encoding = data.get("ContentEncoding")
+    if content_encoding in OUTPUT_CODECS:
+        contents = bytes(OUTPUT_CODECS[content_encoding].decompress(contents))
+    return json.loads(contents)
+
+
+def get_json_data_and_etag(s3_client, bucket, key, default=None):
     """This function will attempt to read / parse S3 for JSON events data.
-    If data does not already exist, a default object will be returned.
+    Data compressed with one of the OUTPUT_CODECS is decompressed based on
+    its ContentEncoding. The data is returned along with the object's ETag.
+    If data does not already exist, default will be returned (an empty
+    events document if it isn't specified) with an ETag of None.
     """
     try:
         data = s3_client.get_object(Bucket=bucket, Key=key)
-        contents = data["Body"].read()
-        return json.loads(contents)
+        return decode_json_object(data), data.get("ETag")
     except s3_client.exceptions.NoSuchKey:
+        if default is not None:
+            return default, None
         return {
             "data_sources": [],
             "data": []
-        }
+        }, None
 
 
-def process_s3_notification(
-        s3_client, s3_notification, output_bucket, output_key
-):
-    output_data = get_json_data(
-        s3_client,
-        output_bucket,
-        output_key
-    )
+def get_write_condition(etag, conditional_writes):
+    """Returns the parameters which make a write of an object read with etag
+    fail if it was changed (or created) by someone else in the meantime.
+    """
+    if not conditional_writes:
+        return None
+    if etag is None:
+        return {"IfNoneMatch": "*"}
+    return {"IfMatch": etag}
+
+
+def register_conditional_writes(s3_client):
+    """Allow IfMatch and IfNoneMatch to be passed to the conditional write
+    operations. They are removed from the parameters before validation and
+    added to the request as headers.
+    """
+    def pop_conditions(params, context, **kwargs):
+        for param in CONDITIONAL_WRITE_HEADERS:
+            if param in params:
+                context[param] = params.pop(param)
+
+    def add_condition_headers(params, context, **kwargs):
+        for param, header in CONDITIONAL_WRITE_HEADERS.items():
+            if param in context:
+                params["headers"][header] = context[param]
+
+    for operation in CONDITIONAL_WRITE_OPERATIONS:
+        s3_client.meta.events.register(
+            f"provide-client-params.s3.{operation}",
+            pop_conditions,
+            unique_id=f"pop-conditions-{operation}"
+        )
+        s3_client.meta.events.register(
+            f"before-call.s3.{operation}",
+            add_condition_headers,
+            unique_id=f"add-condition-headers-{operation}"
+        )
+
 
+def raise_on_write_conflict(error, key):
+    if error.response["Error"]["Code"] in WRITE_CONFLICT_ERRORS:
+        raise OutputConflictException(
+            f"Conflicting write to output: {key}"
+        ) from error
+
+
+def retry_on_write_conflict(process_notifications):
+    """Retry a read-modify-write of the output if its conditional write
+    failed because another processor updated the output in the meantime.
+    """
+    def inner(*args, **kwargs):
+        for attempt in range(1, CONDITIONAL_WRITE_MAX_ATTEMPTS + 1):
+            try:
+                return process_notifications(*args, **kwargs)
+            except OutputConflictException as e:
+                if attempt == CONDITIONAL_WRITE_MAX_ATTEMPTS:
+                    raise
+                logging.info(f"Retrying after write conflict: {e}")
+
+    return inner
+
+
+def get_output_prefix(output_key):
+    return os.path.splitext(output_key)[0]
+
+
+def get_manifest_key(output_key):
+    return f"{get_output_prefix(output_key)}/manifest.json"
+
+
+def get_data_sources_key(output_key):
+    return f"{get_output_prefix(output_key)}/data_sources.json"
+
+
+def get_shard_key(output_key, s3_url, output_format="json"):
+    """Shards are named after the source file they were created from so
+    reprocessing a file overwrites its shard instead of duplicating it.
+    """
+    shard_id = hashlib.sha256(s3_url.encode("utf-8")).hexdigest()
+    return f"{get_output_prefix(output_key)}/shards/{shard_id}.{output_format}"
+
+
+def get_notification_sources(s3_notification):
     for record in s3_notification["Records"]:
         event_name = record["eventName"]
 
@@ -56,49 +211,584 @@ def process_s3_notification(
         s3_data = record["s3"]
         bucket = s3_data["bucket"]["name"]
         key = unquote(s3_data["object"]["key"])
-        s3_url = f"s3://{bucket}/{key}"
+        yield f"s3://{bucket}/{key}", bucket, key
+
+
+def strip_events(avro_reader):
+    for event in avro_reader:
+        for field in STRIPPED_EVENT_FIELDS:
+            del event[field]
+        yield event
+
+
+def read_events(s3_client, bucket, key):
+    event_data = s3_client.get_object(
+        Bucket=bucket,
+        Key=key
+    )
+    yield from strip_events(reader(event_data["Body"]))
+
 
-        if s3_url in output_data["data_sources"]:
+def put_avro_events(
+    s3_client, bucket, key, output_bucket, output_key, codec=None
+):
+    """Write the events of an Avro source file to an Avro container file
+    using the source schema minus the stripped fields. Records are streamed
+    from the reader to the writer rather than collected in a document.
+    """
+    event_data = s3_client.get_object(
+        Bucket=bucket,
+        Key=key
+    )
+    avro_reader = reader(event_data["Body"])
+    schema = dict(avro_reader.writer_schema)
+    schema["fields"] = [
+        field for field in schema["fields"]
+        if field["name"] not in STRIPPED_EVENT_FIELDS
+    ]
+
+    output = io.BytesIO()
+    writer(
+        output,
+        parse_schema(schema),
+        strip_events(avro_reader),
+        codec=AVRO_CODECS.get(codec, "null")
+    )
+    s3_client.put_object(
+        Body=output.getvalue(),
+        Bucket=output_bucket,
+        Key=output_key
+    )
+
+
+def get_sources(s3_notifications):
+    return [
+        source
+        for s3_notification in s3_notifications
+        for source in get_notification_sources(s3_notification)
+    ]
+
+
+def sources_in_sidecar(s3_client, sources, output_bucket, output_key):
+    sidecar_data = get_json_data(
+        s3_client,
+        output_bucket,
+        get_data_sources_key(output_key),
+        default={"data_sources": []}
+    )
+    sidecar_sources = set(sidecar_data["data_sources"])
+    return all(s3_url in sidecar_sources for s3_url, _, _ in sources)
+
+
+def process_s3_notifications(
+        s3_client, s3_notifications, output_bucket, output_key,
+        data_sources_sidecar=False, output_codec=None, conditional_writes=False
+):
+    """Apply the new files from all notifications to the output document
+    and write it once, so a batch of notifications costs a single
+    read-modify-write of the document. If data_sources_sidecar is set, the
+    processed data sources are also written to a small sidecar object which
+    is checked first so notifications for processed files don't require
+    loading the document. Without the sidecar the document layout is
+    unchanged, so the document is loaded for every batch and its
+    data_sources are indexed again each time.
+    """
+    sources = get_sources(s3_notifications)
+
+    if data_sources_sidecar and sources_in_sidecar(
+        s3_client, sources, output_bucket, output_key
+    ):
+        logging.info("Ignoring previously processed files")
+        return
+
+    output_data, etag = get_json_data_and_etag(
+        s3_client,
+        output_bucket,
+        output_key
+    )
+    processed_sources = set(output_data["data_sources"])
+
+    for s3_url, bucket, key in sources:
+        if s3_url in processed_sources:
             logging.info(f"Ignoring previously processed file: {s3_url}")
             continue
 
+        processed_sources.add(s3_url)
         output_data["data_sources"].append(s3_url)
+        output_data["data"].extend(read_events(s3_client, bucket, key))
 
-        event_data = s3_client.get_object(
-            Bucket=bucket,
-            Key=key
+    put_json_data(
+        s3_client,
+        output_bucket,
+        output_key,
+        output_data,
+        codec=output_codec,
+        condition=get_write_condition(etag, conditional_writes)
+    )
+
+    # The sidecar is written after the document so it never lists sources
+    # which are missing from the document. It's only used to skip work, so
+    # it doesn't need to be written conditionally
+    if data_sources_sidecar:
+        put_json_data(
+            s3_client,
+            output_bucket,
+            get_data_sources_key(output_key),
+            {"data_sources": output_data["data_sources"]},
+            codec=output_codec
         )
-        avro_reader = reader(event_data["Body"])
-        for event in avro_reader:
-            for field in ["source_scheme", "source_host", "source_path",
-                          "source_query"]:
-                del event[field]
-            output_data["data"].append(event)
 
-    put_json_data(
+
+def process_s3_notifications_streaming(
+        s3_client, s3_notifications, output_bucket, output_key,
+        data_sources_sidecar=False, output_codec=None, conditional_writes=False
+):
+    """Streaming alternative to process_s3_notifications which produces the
+    same document. Only the data_sources of the existing document are
+    parsed. Its events are copied to the new document as raw bytes, followed
+    by the events of the new files, and the result is uploaded in parts.
+    Memory use is proportional to the part size and data sources rather than
+    all events processed so far.
+    """
+    sources = get_sources(s3_notifications)
+
+    if data_sources_sidecar and sources_in_sidecar(
+        s3_client, sources, output_bucket, output_key
+    ):
+        logging.info("Ignoring previously processed files")
+        return
+
+    etag, chunks = read_object_chunks(s3_client, output_bucket, output_key)
+    data_sources, existing_data = read_document_stream(chunks)
+    processed_sources = set(data_sources)
+    new_sources = []
+    for s3_url, bucket, key in sources:
+        if s3_url in processed_sources:
+            logging.info(f"Ignoring previously processed file: {s3_url}")
+            continue
+
+        processed_sources.add(s3_url)
+        data_sources.append(s3_url)
+        new_sources.append((bucket, key))
+
+    # Unlike the in memory path the document isn't rewritten if there is
+    # nothing to add, since that would mean copying all of it
+    if not new_sources:
+        existing_data.close()
+        return
+
+    output = S3MultipartWriter(
         s3_client,
         output_bucket,
         output_key,
-        output_data
+        codec=output_codec,
+        condition=get_write_condition(etag, conditional_writes)
     )
+    try:
+        output.write(
+            f'{{"data_sources": {json.dumps(data_sources)}, "data": ['
+            .encode("utf-8")
+        )
+        has_data = False
+        for chunk in existing_data:
+            output.write(chunk)
+            has_data = has_data or bool(chunk.strip())
+        for bucket, key in new_sources:
+            for event in read_events(s3_client, bucket, key):
+                if has_data:
+                    output.write(b", ")
+                output.write(json.dumps(event).encode("utf-8"))
+                has_data = True
+        output.write(b"]}")
+        output.close()
+    except Exception:
+        output.abort()
+        raise
 
+    if data_sources_sidecar:
+        put_json_data(
+            s3_client,
+            output_bucket,
+            get_data_sources_key(output_key),
+            {"data_sources": data_sources},
+            codec=output_codec
+        )
+
+
+def process_s3_notifications_sharded(
+        s3_client, s3_notifications, output_bucket, output_key,
+        output_codec=None, output_format="json", conditional_writes=False
+):
+    """Append-only alternative to process_s3_notifications. Events from every
+    source file are written to their own shard, and a manifest lists the
+    processed data sources and shards. The work per message is proportional
+    to the new data and the size of the manifest rather than all events
+    processed so far. Shards are JSON documents or, if output_format is avro,
+    Avro container files.
+    """
+    manifest_key = get_manifest_key(output_key)
+    manifest, etag = get_json_data_and_etag(
+        s3_client,
+        output_bucket,
+        manifest_key,
+        default={"data_sources": [], "shards": []}
+    )
+    # The compactor rewrites the manifest, so an unconditional write here
+    # could undo a compaction
+    if "partitions" in manifest and not conditional_writes:
+        raise ProcessorException(
+            "Compacted outputs require conditional writes to be enabled"
+        )
+    processed_sources = set(manifest["data_sources"])
+    manifest_updated = False
+
+    for s3_notification in s3_notifications:
+        for s3_url, bucket, key in get_notification_sources(s3_notification):
+            if s3_url in processed_sources:
+                logging.info(f"Ignoring previously processed file: {s3_url}")
+                continue
 
-def put_json_data(s3_client, bucket, key, data):
+            # The shard is written before the manifest references it, so a
+            # failure in between leaves at most an unreferenced shard which
+            # is overwritten when the message is redelivered
+            shard_key = get_shard_key(output_key, s3_url, output_format)
+            if output_format == "avro":
+                put_avro_events(
+                    s3_client,
+                    bucket,
+                    key,
+                    output_bucket,
+                    shard_key,
+                    codec=output_codec
+                )
+            else:
+                put_json_data(
+                    s3_client,
+                    output_bucket,
+                    shard_key,
+                    {
+                        "data_sources": [s3_url],
+                        "data": list(read_events(s3_client, bucket, key))
+                    },
+                    codec=output_codec
+                )
+            processed_sources.add(s3_url)
+            manifest["data_sources"].append(s3_url)
+            manifest["shards"].append(shard_key)
+            manifest_updated = True
+
+    if manifest_updated:
+        put_json_data(
+            s3_client,
+            output_bucket,
+            manifest_key,
+            manifest,
+            codec=output_codec,
+            condition=get_write_condition(etag, conditional_writes)
+        )
+
+
+def put_json_data(s3_client, bucket, key, data, codec=None, condition=None):
     binary_data = json.dumps(data).encode("utf-8")
-    s3_client.put_object(Body=binary_data, Bucket=bucket, Key=key)
+    put_args = {"Body": binary_data, "Bucket": bucket, "Key": key}
+
+    if codec is not None:
+        put_args["Body"] = bytes(OUTPUT_CODECS[codec].compress(binary_data))
+        put_args["ContentEncoding"] = codec
+    if condition is not None:
+        put_args.update(condition)
+
+    try:
+        s3_client.put_object(**put_args)
+    except ClientError as e:
+        raise_on_write_conflict(e, key)
+        raise
+
+
+def read_object_chunks(s3_client, bucket, key):
+    """Returns the ETag of an S3 object and a generator of its decompressed
+    contents in chunks. If the object doesn't exist the ETag is None and
+    nothing is generated.
+    """
+    try:
+        data = s3_client.get_object(Bucket=bucket, Key=key)
+    except s3_client.exceptions.NoSuchKey:
+        return None, iter([])
+
+    content_encoding = data.get("ContentEncoding")
+    if content_encoding == "gzip":
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        decompress = decompressor.decompress
+    elif content_encoding in OUTPUT_CODECS:
+        raise ProcessorException(
+            f"Unable to stream {content_encoding} encoded output"
+        )
+    else:
+        def decompress(chunk):
+            return chunk
+
+    return data.get("ETag"), (
+        decompress(chunk)
+        for chunk in iter(partial(data["Body"].read, STREAM_BUFFER_SIZE), b"")
+    )
+
+
+def parse_document_start(buffer):
+    """Parse the data_sources at the start of an output document. Returns
+    the data sources and the offset of the contents of the data array, or
+    None if the buffer doesn't contain all of them yet.
+    """
+    start = DOCUMENT_START.match(buffer)
+    if start is None:
+        return None
+
+    # Documents are written by json.dumps so data sources are ASCII
+    text = buffer[start.end():].decode("utf-8", errors="ignore")
+    try:
+        data_sources, end = json.JSONDecoder().raw_decode(text)
+    except json.JSONDecodeError:
+        return None
+
+    data_start = DOCUMENT_DATA_START.match(
+        buffer, start.end() + len(text[:end].encode("utf-8"))
+    )
+    if data_start is None:
+        return None
+    return data_sources, data_start.end()
+
+
+def read_document_stream(chunks):
+    """Read the data sources of an output document from chunks of its
+    contents. Returns them along with a generator of the raw bytes of the
+    elements of the data array so they can be copied without being decoded.
+    A missing document is treated as being empty.
+    """
+    chunks = iter(chunks)
+    buffer = b""
+    parsed = None
+    while parsed is None:
+        chunk = next(chunks, None)
+        if chunk is None:
+            if buffer.strip():
+                raise ProcessorException("Unexpected output document format")
+            return [], iter_document_data(b"", chunks)
+        buffer += chunk
+        parsed = parse_document_start(buffer)
+
+    data_sources, offset = parsed
+    return data_sources, iter_document_data(buffer[offset:], chunks)
+
+
+def iter_document_data(buffer, chunks):
+    # The end of the document is held back until all chunks have been read
+    # so the closing brackets can be removed
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) > DOCUMENT_END_MAX_BYTES:
+            yield buffer[:-DOCUMENT_END_MAX_BYTES]
+            buffer = buffer[-DOCUMENT_END_MAX_BYTES:]
+
+    if not buffer:
+        return
+    end = DOCUMENT_END.search(buffer)
+    if end is None:
+        raise ProcessorException("Unexpected output document format")
+    yield buffer[:end.start()]
+
+
+class S3MultipartWriter:
+    """Write an S3 object with a multipart upload as data is written to it,
+    so at most around one part is held in memory. If codec is set data is
+    compressed as it is written. The upload is completed with the optional
+    write condition.
+    """
+
+    def __init__(self, s3_client, bucket, key, codec=None, condition=None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.condition = condition or {}
+        self.compressor = \
+            OUTPUT_CODECS[codec].Compressor() if codec is not None else None
+        self.pending = bytearray()
+        self.buffer = bytearray()
+        self.parts = []
+
+        upload_args = {"Bucket": bucket, "Key": key}
+        if codec is not None:
+            upload_args["ContentEncoding"] = codec
+        self.upload_id = s3_client.create_multipart_upload(
+            **upload_args
+        )["UploadId"]
+
+    def write(self, data):
+        self.pending += data
+        if len(self.pending) >= STREAM_BUFFER_SIZE:
+            self._flush_pending()
+
+    def close(self):
+        self._flush_pending()
+        if self.compressor is not None:
+            self.buffer += bytes(self.compressor.finish())
+        if self.buffer or not self.parts:
+            self._upload_part()
+
+        try:
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+                **self.condition
+            )
+        except ClientError as e:
+            raise_on_write_conflict(e, self.key)
+            raise
+
+    def abort(self):
+        self.s3_client.abort_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id
+        )
+
+    def _flush_pending(self):
+        if self.compressor is not None:
+            self.compressor.compress(bytes(self.pending))
+            self.buffer += bytes(self.compressor.flush())
+        else:
+            self.buffer += self.pending
+        self.pending.clear()
+
+        if len(self.buffer) >= MULTIPART_PART_SIZE:
+            self._upload_part()
+
+    def _upload_part(self):
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(
+            Body=bytes(self.buffer),
+            Bucket=self.bucket,
+            Key=self.key,
+            PartNumber=part_number,
+            UploadId=self.upload_id
+        )
+        self.parts.append(
+            {"ETag": response["ETag"], "PartNumber": part_number}
+        )
+        self.buffer.clear()
+
+
+def get_s3_notification(sqs_message):
+    sns_data = json.loads(sqs_message["Body"])
+    return json.loads(sns_data["Message"])
+
+
+def get_notifications_processor(
+    output_layout, data_sources_sidecar=False, output_codec=None,
+    output_format="json", streaming_output=False, conditional_writes=False
+):
+    process_notifications = get_layout_processor(
+        output_layout, data_sources_sidecar, output_codec, output_format,
+        streaming_output
+    )
+    if not conditional_writes:
+        return process_notifications
+    return retry_on_write_conflict(
+        partial(process_notifications, conditional_writes=True)
+    )
+
+
+def get_layout_processor(
+    output_layout, data_sources_sidecar, output_codec, output_format,
+    streaming_output
+):
+    if output_layout not in OUTPUT_LAYOUTS:
+        raise ProcessorException(f"Unexpected output layout {output_layout}")
+    if output_codec is not None and output_codec not in OUTPUT_CODECS:
+        raise ProcessorException(f"Unexpected output codec {output_codec}")
+    if output_format not in OUTPUT_FORMATS:
+        raise ProcessorException(f"Unexpected output format {output_format}")
+
+    # Avro container files can't be appended to in S3, so they are only
+    # written as shards
+    if output_format == "avro":
+        if output_layout != "sharded":
+            raise ProcessorException(
+                "The avro output format requires the sharded output layout"
+            )
+        if output_codec is not None and output_codec not in AVRO_CODECS:
+            raise ProcessorException(
+                f"Unsupported avro output codec {output_codec}"
+            )
+
+    if streaming_output:
+        if output_layout != "document":
+            raise ProcessorException(
+                "Streaming output requires the document output layout"
+            )
+        if output_codec is not None and output_codec not in STREAMING_CODECS:
+            raise ProcessorException(
+                f"Unsupported streaming output codec {output_codec}"
+            )
+        return partial(
+            process_s3_notifications_streaming,
+            data_sources_sidecar=data_sources_sidecar,
+            output_codec=output_codec
+        )
+
+    # The sharded layout's manifest already serves as a compact ledger
+    if output_layout == "sharded":
+        return partial(
+            process_s3_notifications_sharded,
+            output_codec=output_codec,
+            output_format=output_format
+        )
+    return partial(
+        process_s3_notifications,
+        data_sources_sidecar=data_sources_sidecar,
+        output_codec=output_codec
+    )
 
 
 def get_sqs_message_processor(
-    s3_client, s3_output_bucket, s3_output_key
+    s3_client, s3_output_bucket, s3_output_key, output_layout="document",
+    data_sources_sidecar=False, output_codec=None, output_format="json",
+    streaming_output=False, conditional_writes=False
 ):
+    process_notifications = get_notifications_processor(
+        output_layout, data_sources_sidecar, output_codec, output_format,
+        streaming_output, conditional_writes
+    )
+    if conditional_writes:
+        register_conditional_writes(s3_client)
 
     def inner(sqs_message):
-        sns_data = json.loads(sqs_message["Body"])
-        s3_notification = json.loads(sns_data["Message"])
+        process_notifications(
+            s3_client,
+            [get_s3_notification(sqs_message)],
+            s3_output_bucket,
+            s3_output_key
+        )
+
+    return inner
+
 
-        process_s3_notification(
+def get_sqs_batch_processor(
+    s3_client, s3_output_bucket, s3_output_key, output_layout="document",
+    data_sources_sidecar=False, output_codec=None, output_format="json",
+    streaming_output=False, conditional_writes=False
+):
+    process_notifications = get_notifications_processor(
+        output_layout, data_sources_sidecar, output_codec, output_format,
+        streaming_output, conditional_writes
+    )
+    if conditional_writes:
+        register_conditional_writes(s3_client)
+
+    def inner(sqs_messages):
+        process_notifications(
             s3_client,
-            s3_notification,
+            [get_s3_notification(message) for message in sqs_messages],
             s3_output_bucket,
             s3_output_key
         )
@@ -124,7 +814,24 @@ def main():
     processor = get_sqs_message_processor(
         s3_client=s3_client,
         s3_output_bucket=config["output_bucket"],
-        s3_output_key=config["output_key"]
+        s3_output_key=config["output_key"],
+        output_layout=config["output_layout"],
+        data_sources_sidecar=config["data_sources_sidecar"],
+        output_codec=config["output_codec"],
+        output_format=config["output_format"],
+        streaming_output=config["streaming_output"],
+        conditional_writes=config["conditional_writes"]
+    )
+    batch_processor = get_sqs_batch_processor(
+        s3_client=s3_client,
+        s3_output_bucket=config["output_bucket"],
+        s3_output_key=config["output_key"],
+        output_layout=config["output_layout"],
+        data_sources_sidecar=config["data_sources_sidecar"],
+        output_codec=config["output_codec"],
+        output_format=config["output_format"],
+        streaming_output=config["streaming_output"],
+        conditional_writes=config["conditional_writes"]
     )
 
     processor_runner(
@@ -132,7 +839,9 @@ def main():
         sqs_queue_name=config["consumer_queue"],
         processor=processor,
         poll_interval_mins=config["poll_interval_mins"],
-        daemonize=daemonize
+        daemonize=daemonize,
+        batch_processor=batch_processor,
+        **get_runner_config()
     )
 
 
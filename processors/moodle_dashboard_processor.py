@@ -2,32 +2,38 @@ import os
 import argparse
 import boto3
 import json
+import codecs
 import logging
-from datetime import datetime, timezone, timedelta
+import re
+from datetime import datetime, timezone, timedelta, time
 from urllib.parse import unquote
 import hashlib
-from sqlalchemy import create_engine, select
+from sqlalchemy import select, func
 from sqlalchemy.dialects.postgresql import insert
-from sqlalchemy.orm import sessionmaker
-from .common import ProcessorException, processor_runner, \
-    commit_ignoring_unique_violations
+from .common import ProcessorException, get_runner_config, \
+    processor_runner, commit_ignoring_unique_violations
+from .database import (
+    session_factory,
+    object_processed,
+    record_processed_object,
+)
 from raise_data.dashboard.schema import Course, EventUserEnrollment, \
     CourseActivityStat, CourseQuizStat, generate_utc_timestamp
 
 
 logging.basicConfig(level=logging.INFO)
 
-# We setup the sqlalchemy resources at global scope and so read some expected
-# environment variables here. If they end up being missing, we'll fail later
-# anyways.
-pg_server = os.getenv('POSTGRES_SERVER', '')
-pg_db = os.getenv('POSTGRES_DB', '')
-pg_user = os.getenv('POSTGRES_USER', '')
-pg_password = os.getenv('POSTGRES_PASSWORD', '')
-sqlalchemy_url = f"postgresql://{pg_user}:{pg_password}@{pg_server}/{pg_db}"
+DEFAULT_GRADES_SAFETY_WINDOW_DAYS = 7
+JSON_STREAM_CHUNK_SIZE = 64 * 1024
+JSON_WHITESPACE = re.compile(r"\s*")
+JSON_NUMBER_CHARS = set(".eE+-0123456789")
 
-engine = create_engine(sqlalchemy_url)
-session_factory = sessionmaker(engine)
+
+def parse_grades_safety_window_days(value):
+    """A safety window of "none" disables the grades watermark"""
+    if value.lower() == "none":
+        return None
+    return int(value)
 
 
 def get_config():
@@ -36,6 +42,12 @@ def get_config():
             "consumer_queue": os.environ["SQS_QUEUE"],
             "poll_interval_mins": int(os.environ["POLL_INTERVAL_MINS"]),
             "data_type": os.environ["DATA_TYPE"],
+            "grades_safety_window_days": parse_grades_safety_window_days(
+                os.getenv(
+                    "GRADES_SAFETY_WINDOW_DAYS",
+                    str(DEFAULT_GRADES_SAFETY_WINDOW_DAYS)
+                )
+            ),
             "postgres_server": os.environ["POSTGRES_SERVER"],
             "postgres_db": os.environ["POSTGRES_DB"],
             "postgres_user": os.environ["POSTGRES_USER"],
@@ -45,13 +57,114 @@ def get_config():
         raise ProcessorException(f"Missing expected environment variable: {e}")
 
 
-def process_moodle_users_data(
+class JSONStreamReader:
+    """Parse a JSON document incrementally from a file-like object of UTF-8
+    bytes. Arrays and objects can be iterated one element at a time, and
+    each element is either iterated in turn or decoded with read_value, so
+    only the element being decoded is held in memory.
+    """
+
+    def __init__(self, fileobj, chunk_size=JSON_STREAM_CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.fileobj.read(self.chunk_size)
+        self.eof = not chunk
+        self.buffer = self.buffer[self.pos:] + self.text_decoder.decode(
+            chunk, final=self.eof
+        )
+        self.pos = 0
+        return not self.eof
+
+    def _peek(self):
+        while True:
+            self.pos = JSON_WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ProcessorException(f"Expected {char} in JSON data")
+        self.pos += 1
+
+    def _iter_container(self, start, end):
+        self._expect(start)
+        if self._peek() == end:
+            self.pos += 1
+            return
+        while True:
+            yield
+            separator = self._peek()
+            self.pos += 1
+            if separator == end:
+                return
+            if separator != ",":
+                raise ProcessorException("Unexpected separator in JSON data")
+
+    def iter_array(self):
+        """Yields once per element of an array. The caller must consume
+        each element before resuming.
+        """
+        yield from self._iter_container("[", "]")
+
+    def iter_object(self):
+        """Yields the keys of an object. The caller must consume the value
+        of each key before resuming.
+        """
+        for _ in self._iter_container("{", "}"):
+            key = self.read_value()
+            if not isinstance(key, str):
+                raise ProcessorException("Unexpected key in JSON data")
+            self._expect(":")
+            yield key
+
+    def read_value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(
+                    self.buffer, self.pos
+                )
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise ProcessorException("Unexpected end of JSON data")
+            # A number at the end of the buffer may continue in the next
+            # chunk. raw_decode stops at the longest valid prefix, so a
+            # number split after its integer part is only partially
+            # decoded, leaving its fraction or exponent in the buffer.
+            if end == len(self.buffer) or (
+                isinstance(value, (int, float)) and
+                self.buffer[end] in JSON_NUMBER_CHARS
+            ):
+                if self._fill():
+                    continue
+            self.pos = end
+            return value
+
+
+def aggregate_users_data(
     course_id, course_term, users_data, data_timestamp_utc
 ):
-    def get_course_data():
+    """Compute the course, activity stats and event user enrollments for a
+    users file in a single pass over users_data, which can be any iterable
+    of user records so they can be streamed from the file. Returns them as a
+    (course_data, course_activity_stats, event_user_enrollments) tuple.
+    """
+    def get_course_data(user):
         # Parse out course name. We should be able to find the target course in
         # any user, so the first is as good as any
-        enrolled_courses = users_data[0]["enrolledcourses"]
+        enrolled_courses = user["enrolledcourses"]
         for course in enrolled_courses:
             if str(course["id"]) == course_id:
                 return {
@@ -64,62 +177,70 @@ def process_moodle_users_data(
             f"Could not find course name for {course_id} in users data"
         )
 
-    def count_enrolled_students():
-        enrolled_students = 0
-        for user in users_data:
-            user_role = user["roles"][0]["shortname"]
-            if user_role == "student":
-                enrolled_students += 1
-        return enrolled_students
-
-    def count_active_users():
-        weekly_active_users = 0
-        daily_active_users = 0
-        for user in users_data:
-            # This is a unix timestamp or 0
-            lastaccess = user["lastcourseaccess"]
-            lastaccess_utc = datetime.fromtimestamp(lastaccess, timezone.utc)
-
-            access_time_delta = data_timestamp_utc - lastaccess_utc
-            if access_time_delta < timedelta(days=7):
-                weekly_active_users += 1
-            if access_time_delta < timedelta(days=1):
+    # Last access times are unix timestamps (or 0), so they're compared with
+    # epoch second cutoffs rather than being converted to datetimes
+    data_timestamp = data_timestamp_utc.timestamp()
+    weekly_cutoff = data_timestamp - timedelta(days=7).total_seconds()
+    daily_cutoff = data_timestamp - timedelta(days=1).total_seconds()
+
+    course_data = None
+    enrolled_students = 0
+    weekly_active_users = 0
+    daily_active_users = 0
+    event_user_enrollments = []
+
+    for user in users_data:
+        if course_data is None:
+            course_data = get_course_data(user)
+
+        user_role = user["roles"][0]["shortname"]
+        if user_role == "student":
+            enrolled_students += 1
+
+        lastaccess = user["lastcourseaccess"]
+        if lastaccess > weekly_cutoff:
+            weekly_active_users += 1
+            if lastaccess > daily_cutoff:
                 daily_active_users += 1
-        return {
-            "weekly_active_users": weekly_active_users,
-            "daily_active_users": daily_active_users
-        }
 
-    def get_event_user_enrollments():
-        res = []
-        for user in users_data:
-            # Old JSON files may not have a UUID field, and in new ones it
-            # will be null if a user has not generated events
-            maybe_user_uuid = user.get("uuid")
-            if maybe_user_uuid is not None:
-                role = user["roles"][0]["shortname"]
-                user_uuid_md5 = hashlib.md5(
-                    maybe_user_uuid.encode("utf-8")
-                ).hexdigest()
-                res.append({
-                    "course_id": course_id,
-                    "role": role,
-                    "user_uuid_md5": user_uuid_md5
-                })
-
-        return res
-
-    course_data = get_course_data()
-    enrolled_students = count_enrolled_students()
-    active_users = count_active_users()
+        # Old JSON files may not have a UUID field, and in new ones it
+        # will be null if a user has not generated events
+        maybe_user_uuid = user.get("uuid")
+        if maybe_user_uuid is not None:
+            user_uuid_md5 = hashlib.md5(
+                maybe_user_uuid.encode("utf-8")
+            ).hexdigest()
+            event_user_enrollments.append({
+                "course_id": course_id,
+                "role": user_role,
+                "user_uuid_md5": user_uuid_md5
+            })
+
+    if course_data is None:  # pragma: no cover
+        raise ProcessorException(f"No users in users data for {course_id}")
+
     course_activity_stats = {
         "course_id": course_id,
         "date": data_timestamp_utc.date(),
         "enrolled_students": enrolled_students,
-        "weekly_active_users": active_users["weekly_active_users"],
-        "daily_active_users": active_users["daily_active_users"]
+        "weekly_active_users": weekly_active_users,
+        "daily_active_users": daily_active_users
     }
-    event_user_enrollments = get_event_user_enrollments()
+    return course_data, course_activity_stats, event_user_enrollments
+
+
+def process_moodle_users_data(
+    course_id, course_term, users_data, data_timestamp_utc,
+    processed_object=None
+):
+    """If processed_object is set, the file is added to the processed_object
+    ledger in the same transaction as the enrollments, which are written
+    last.
+    """
+    course_data, course_activity_stats, event_user_enrollments = \
+        aggregate_users_data(
+            course_id, course_term, users_data, data_timestamp_utc
+        )
 
     with session_factory() as session:
         session.add(CourseActivityStat(**course_activity_stats))
@@ -129,72 +250,167 @@ def process_moodle_users_data(
 
         # Since the event user enrollment rows are cumulative, we'll query
         # existing course entries first so the steady-state has no new inserts
-        # being attempted
-        existing_enrollment_users = session.scalars(
+        # being attempted. New rows are inserted with a single statement, and
+        # ON CONFLICT DO NOTHING covers rows added concurrently.
+        existing_enrollment_users = set(session.scalars(
             select(EventUserEnrollment.user_uuid_md5).filter_by(
                 course_id=course_id
             )
-        ).all()
+        ))
+        new_enrollments = [
+            item for item in event_user_enrollments
+            if item["user_uuid_md5"] not in existing_enrollment_users
+        ]
+
+        if new_enrollments:
+            session.execute(
+                insert(EventUserEnrollment).on_conflict_do_nothing(),
+                new_enrollments
+            )
+        if processed_object is not None:
+            record_processed_object(
+                session,
+                row_count=len(event_user_enrollments),
+                **processed_object
+            )
+        session.commit()
 
-        for item in event_user_enrollments:
-            if item["user_uuid_md5"] not in existing_enrollment_users:
-                session.add(EventUserEnrollment(**item))
-                commit_ignoring_unique_violations(session)
 
+def get_grades_watermark(course_id, safety_window_days):
+    """Grades files are cumulative for the term, so only dates at or after
+    the latest date already aggregated for the course, minus a safety window
+    for attempts that are synced late, need to be re-counted. Returns None
+    if the course has no stats yet, or if safety_window_days is None so
+    that replays and corrections of older files re-count every date.
+    """
+    if safety_window_days is None:
+        return None
 
-def process_moodle_grades_data(course_id, grades_data):
-    attempts_by_date = {}
+    with session_factory() as session:
+        latest_date = session.scalar(
+            select(func.max(CourseQuizStat.date)).filter_by(
+                course_id=course_id
+            )
+        )
+
+    if latest_date is None:
+        return None
+    return latest_date - timedelta(days=safety_window_days)
+
+
+def iter_attempt_summaries(attempts_reader):
+    """Yields the attempt summaries in the attempts object of a grades file
+    as they are parsed.
+    """
+    for _ in attempts_reader.iter_object():
+        for _ in attempts_reader.iter_object():
+            for key in attempts_reader.iter_object():
+                if key != "summaries":  # pragma: no cover
+                    attempts_reader.read_value()
+                    continue
+                for _ in attempts_reader.iter_array():
+                    yield attempts_reader.read_value()
+
+
+def process_moodle_grades_data(
+    course_id, grades_reader,
+    safety_window_days=DEFAULT_GRADES_SAFETY_WINDOW_DAYS,
+    processed_object=None
+):
+    """grades_reader is a JSONStreamReader over a grades file. Attempts are
+    counted by quiz id as they are parsed since the quizzes may come after
+    them in the file. If processed_object is set, the file is added to the
+    processed_object ledger in the same transaction as the stats.
+    """
+    watermark = get_grades_watermark(course_id, safety_window_days)
+    if watermark is None:
+        min_timefinish = None
+    else:
+        min_timefinish = datetime.combine(
+            watermark, time(), timezone.utc
+        ).timestamp()
+
+    quiz_data = None
+    attempts_by_date_and_quiz_id = None
+    for key in grades_reader.iter_object():
+        if key == "quizzes":
+            quiz_data = grades_reader.read_value()
+        elif key == "attempts":
+            attempts_by_date_and_quiz_id = {}
+            for attempt in iter_attempt_summaries(grades_reader):
+                # Counts for dates before the watermark were upserted by
+                # earlier files and are left as is
+                if min_timefinish is not None and \
+                        attempt["timefinish"] < min_timefinish:
+                    continue
+                date_utc = datetime.fromtimestamp(
+                    attempt["timefinish"],
+                    timezone.utc
+                ).date()
+                date_and_quiz_id = (date_utc, attempt["quiz"])
+                attempts_by_date_and_quiz_id[date_and_quiz_id] = \
+                    attempts_by_date_and_quiz_id.get(date_and_quiz_id, 0) + 1
+        else:
+            grades_reader.read_value()
 
     # This check is here because legacy grades JSON files don't have this data
-    maybe_attempts_data = grades_data.get("attempts")
-    quiz_data = grades_data.get("quizzes")
-    if maybe_attempts_data is None or quiz_data is None:  # pragma: no cover
-        return
+    if attempts_by_date_and_quiz_id is None or \
+            quiz_data is None:  # pragma: no cover
+        quiz_data, attempts_by_date_and_quiz_id = [], {}
 
     quiz_name_by_id = {}
     for quiz in quiz_data:
         quiz_name_by_id[quiz["id"]] = quiz["name"]
 
-    for _, user_data in maybe_attempts_data.items():
-        for _, attempt_data in user_data.items():
-            for attempt in attempt_data["summaries"]:
-                quiz_name = quiz_name_by_id[attempt["quiz"]]
-                date_utc = datetime.fromtimestamp(
-                    attempt["timefinish"],
-                    timezone.utc
-                ).date()
-                attempts_by_quiz = attempts_by_date.setdefault(date_utc, {})
-                attempts_by_quiz_count = attempts_by_quiz.get(quiz_name, 0)
-                attempts_by_quiz[quiz_name] = attempts_by_quiz_count + 1
-
-    results = []
-
-    # We're going to attempt an "upsert" for every item. If this ends up
-    # being a performance issue, we can filter to only recent dates relative
-    # to data_timestamp here.
-    for date, attempts_by_quiz in attempts_by_date.items():
-        for quiz_name, count in attempts_by_quiz.items():
-            results.append({
-                "course_id": course_id,
-                "date": date,
-                "quiz_name": quiz_name,
-                "quiz_attempts": count
-            })
+    attempts_by_date_and_quiz = {}
+    for (date_utc, quiz_id), count in attempts_by_date_and_quiz_id.items():
+        date_and_quiz = (date_utc, quiz_name_by_id[quiz_id])
+        attempts_by_date_and_quiz[date_and_quiz] = \
+            attempts_by_date_and_quiz.get(date_and_quiz, 0) + count
+
+    # We're going to attempt an "upsert" for every item on or after the
+    # watermark
+    results = [
+        {
+            "course_id": course_id,
+            "date": date,
+            "quiz_name": quiz_name,
+            "quiz_attempts": count
+        }
+        for (date, quiz_name), count in attempts_by_date_and_quiz.items()
+    ]
+
+    # All rows are upserted with one statement, which SQLAlchemy sends as
+    # batched multi-row INSERTs. Each row's new count is taken from the
+    # conflicting row via excluded.
+    insert_stmt = insert(CourseQuizStat)
+    do_update_stmt = insert_stmt.on_conflict_do_update(
+        index_elements=['course_id', 'date', 'quiz_name'],
+        set_=dict(
+            quiz_attempts=insert_stmt.excluded.quiz_attempts,
+            updated_at=generate_utc_timestamp()
+        )
+    )
 
     with session_factory.begin() as session:
-        for item in results:
-            insert_stmt = insert(CourseQuizStat).values(**item)
-            do_update_stmt = insert_stmt.on_conflict_do_update(
-                index_elements=['course_id', 'date', 'quiz_name'],
-                set_=dict(
-                    quiz_attempts=item["quiz_attempts"],
-                    updated_at=generate_utc_timestamp()
-                )
+        if len(results) > 0:
+            session.execute(do_update_stmt, results)
+        if processed_object is not None:
+            record_processed_object(
+                session, row_count=len(results), **processed_object
             )
-            session.execute(do_update_stmt)
 
 
-def process_s3_notification(s3_client, s3_notification, data_type):
+def get_course_id(object_key):
+    # Parse course_id out of the filename convention since it isn't
+    # consistently contained in all data files
+    return object_key.split("/")[-1].split(".json")[0]
+
+
+def process_s3_notification(
+    s3_client, s3_notification, data_type,
+    grades_safety_window_days=DEFAULT_GRADES_SAFETY_WINDOW_DAYS
+):
     for record in s3_notification["Records"]:
         event_name = record["eventName"]
 
@@ -206,18 +422,31 @@ def process_s3_notification(s3_client, s3_notification, data_type):
         object_key = unquote(s3_data["object"]["key"])
         object_version_id = s3_data["object"]["versionId"]
 
-        # Parse course_id out of the filename convention since it isn't
-        # consistently contained in all data files
-        course_id = object_key.split("/")[-1].split(".json")[0]
+        course_id = get_course_id(object_key)
         course_term = object_key.split('/moodle')[0].split('/')[-1]
 
+        # Replays of historical versions are skipped before they are
+        # fetched if their results are already stored
+        if object_processed(bucket, object_key, object_version_id):
+            logging.info(
+                f"Ignoring previously processed file: {object_key} "
+                f"({object_version_id})"
+            )
+            continue
+        processed_object = {
+            "bucket": bucket,
+            "key": object_key,
+            "version": object_version_id
+        }
+
         data = s3_client.get_object(
             Bucket=bucket,
             Key=object_key,
             VersionId=object_version_id
         )
-        data_contents = data["Body"].read()
-        json_data = json.loads(data_contents)
+        # The file is parsed as it is read so the whole file and object tree
+        # are never held in memory
+        json_reader = JSONStreamReader(data["Body"])
 
         # This should be a tz aware timestamp that is already UTC, but
         # we'll convert just to be sure
@@ -228,29 +457,52 @@ def process_s3_notification(s3_client, s3_notification, data_type):
             process_moodle_users_data(
                 course_id,
                 course_term,
-                json_data,
-                data_timestamp_utc
+                (json_reader.read_value() for _ in json_reader.iter_array()),
+                data_timestamp_utc,
+                processed_object
             )
         elif data_type == 'grades':
             process_moodle_grades_data(
                 course_id,
-                json_data
+                json_reader,
+                grades_safety_window_days,
+                processed_object
             )
         else:  # pragma: no cover
             raise ProcessorException(f"Unexpected data type {data_type}")
 
 
-def get_sqs_message_processor(s3_client, data_type):
+def get_sqs_message_processor(
+    s3_client, data_type,
+    grades_safety_window_days=DEFAULT_GRADES_SAFETY_WINDOW_DAYS
+):
 
     def inner(sqs_message):
         sns_data = json.loads(sqs_message["Body"])
         s3_notification = json.loads(sns_data["Message"])
 
-        process_s3_notification(s3_client, s3_notification, data_type)
+        process_s3_notification(
+            s3_client, s3_notification, data_type, grades_safety_window_days
+        )
 
     return inner
 
 
+def get_sqs_message_ordering_key(sqs_message):
+    """Messages for different courses write disjoint rows, so they can be
+    processed concurrently, while messages for the same course are processed
+    in order so versions of its files are applied in the order they were
+    queued. S3 notifications have a single record, but the course IDs of all
+    records are used to be safe.
+    """
+    sns_data = json.loads(sqs_message["Body"])
+    s3_notification = json.loads(sns_data["Message"])
+    return tuple(
+        get_course_id(unquote(record["s3"]["object"]["key"]))
+        for record in s3_notification["Records"]
+    )
+
+
 def main():
     logging.info("Starting processor...")
     parser = argparse.ArgumentParser(description="")
@@ -268,7 +520,8 @@ def main():
 
     processor = get_sqs_message_processor(
         s3_client=s3_client,
-        data_type=config["data_type"]
+        data_type=config["data_type"],
+        grades_safety_window_days=config["grades_safety_window_days"]
     )
 
     processor_runner(
@@ -276,7 +529,9 @@ def main():
         sqs_queue_name=config["consumer_queue"],
         processor=processor,
         poll_interval_mins=config["poll_interval_mins"],
-        daemonize=daemonize
+        daemonize=daemonize,
+        ordering_key=get_sqs_message_ordering_key,
+        **get_runner_config()
     )
 
 
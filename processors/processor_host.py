@@ -0,0 +1,202 @@
+import os
+import argparse
+import boto3
+import json
+import logging
+import queue
+import threading
+from .common import ProcessorException, RUNNER_OPTIONS, processor_runner
+from . import (
+    events_dashboard_processor,
+    events_enclave_processor,
+    moodle_dashboard_processor,
+)
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+def get_config():
+    """The host is configured with a JSON list of queue configurations. Each
+    one names the processor kind, its SQS queue, poll interval, the kind
+    specific settings and optionally any processor_runner options.
+    """
+    try:
+        queue_configs = json.loads(os.environ["PROCESSOR_HOST_CONFIG"])
+    except KeyError as e:
+        raise ProcessorException(f"Missing expected environment variable: {e}")
+
+    for queue_config in queue_configs:
+        for field in ["kind", "sqs_queue", "poll_interval_mins"]:
+            if field not in queue_config:
+                raise ProcessorException(
+                    f"Missing expected processor host setting: {field}"
+                )
+
+    return {"queues": queue_configs}
+
+
+def get_enclave_options(queue_config):
+    return {
+        "s3_output_bucket": queue_config["output_bucket"],
+        "s3_output_key": queue_config["output_key"],
+        "output_layout": queue_config.get("output_layout", "document"),
+        "data_sources_sidecar": queue_config.get(
+            "data_sources_sidecar", False
+        ),
+        "output_codec": queue_config.get("output_codec"),
+        "output_format": queue_config.get("output_format", "json"),
+        "streaming_output": queue_config.get("streaming_output", False),
+        "conditional_writes": queue_config.get("conditional_writes", False)
+    }
+
+
+def get_decode_pool(queue_config):
+    if queue_config["kind"] == "events-dashboard":
+        return events_dashboard_processor.get_decode_pool(
+            queue_config.get("decode_workers", 0)
+        )
+
+    return None
+
+
+def get_sqs_message_processor(s3_client, queue_config, decode_pool=None):
+    kind = queue_config["kind"]
+
+    if kind == "events-dashboard":
+        return events_dashboard_processor.get_sqs_message_processor(
+            s3_client=s3_client,
+            event_type=queue_config["event_type"],
+            ingest_mode=queue_config.get("ingest_mode", "insert"),
+            decode_pool=decode_pool
+        )
+    elif kind == "events-enclave":
+        return events_enclave_processor.get_sqs_message_processor(
+            s3_client=s3_client,
+            **get_enclave_options(queue_config)
+        )
+    elif kind == "moodle-dashboard":
+        return moodle_dashboard_processor.get_sqs_message_processor(
+            s3_client=s3_client,
+            data_type=queue_config["data_type"],
+            grades_safety_window_days=queue_config.get(
+                "grades_safety_window_days",
+                moodle_dashboard_processor.DEFAULT_GRADES_SAFETY_WINDOW_DAYS
+            )
+        )
+
+    raise ProcessorException(f"Unexpected processor kind {kind}")
+
+
+def get_sqs_batch_processor(s3_client, queue_config):
+    if queue_config["kind"] == "events-enclave":
+        return events_enclave_processor.get_sqs_batch_processor(
+            s3_client=s3_client,
+            **get_enclave_options(queue_config)
+        )
+
+    return None
+
+
+def get_ordering_key(queue_config):
+    if queue_config["kind"] == "moodle-dashboard":
+        return moodle_dashboard_processor.get_sqs_message_ordering_key
+
+    return None
+
+
+def run_processors(sqs_client, s3_client, queue_configs, daemonize):
+    """Run a processor_runner for every configured queue in its own thread.
+    The boto3 clients and the SQLAlchemy connection pool are shared. Giving
+    each queue its own polling loop and worker pool keeps a busy queue from
+    using up the workers of any other queue, but database connections still
+    come from the shared pool (POSTGRES_POOL_SIZE plus 10 overflow
+    connections). Queues can wait on each other for connections if their
+    combined concurrency is larger than that. If a runner fails the error is
+    raised so the host exits. The decode pools of events dashboard queues
+    are shut down when the runners finish or one of them fails.
+    """
+    decode_pools = [
+        get_decode_pool(queue_config) for queue_config in queue_configs
+    ]
+    try:
+        processors = [
+            (
+                get_sqs_message_processor(
+                    s3_client, queue_config, decode_pool
+                ),
+                get_sqs_batch_processor(s3_client, queue_config)
+            )
+            for queue_config, decode_pool in zip(queue_configs, decode_pools)
+        ]
+        run_runners(sqs_client, queue_configs, processors, daemonize)
+    finally:
+        for decode_pool in decode_pools:
+            if decode_pool:
+                decode_pool.shutdown()
+
+
+def run_runners(sqs_client, queue_configs, processors, daemonize):
+    finished = queue.Queue()
+
+    def run(queue_config, processor, batch_processor):
+        try:
+            processor_runner(
+                sqs_client=sqs_client,
+                sqs_queue_name=queue_config["sqs_queue"],
+                processor=processor,
+                poll_interval_mins=queue_config["poll_interval_mins"],
+                daemonize=daemonize,
+                batch_processor=batch_processor,
+                ordering_key=get_ordering_key(queue_config),
+                **{
+                    option: queue_config[option]
+                    for option in RUNNER_OPTIONS if option in queue_config
+                }
+            )
+            finished.put((queue_config, None))
+        except Exception as e:
+            finished.put((queue_config, e))
+
+    for queue_config, (processor, batch_processor) in zip(
+        queue_configs, processors
+    ):
+        threading.Thread(
+            target=run,
+            args=(queue_config, processor, batch_processor),
+            daemon=True
+        ).start()
+
+    for _ in queue_configs:
+        queue_config, error = finished.get()
+        if error is not None:
+            raise ProcessorException(
+                f"Processor for {queue_config['sqs_queue']} failed: {error}"
+            ) from error
+
+
+def main():
+    logging.info("Starting processor host...")
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument(
+        "--daemonize",
+        action="store_true",
+        help="Deamonize processors"
+    )
+    args = parser.parse_args()
+    daemonize = args.daemonize
+    config = get_config()
+
+    sqs_client = boto3.client("sqs")
+    s3_client = boto3.client("s3")
+
+    run_processors(
+        sqs_client=sqs_client,
+        s3_client=s3_client,
+        queue_configs=config["queues"],
+        daemonize=daemonize
+    )
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
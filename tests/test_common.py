@@ -0,0 +1,546 @@
+from raise_data.processors import common
+import pytest
+import threading
+import boto3
+import botocore.stub
+from botocore.exceptions import ClientError
+
+
+def add_queue_responses(sqs_stubber, messages):
+    sqs_stubber.add_response(
+        "get_queue_url",
+        {"QueueUrl": "https://testqueue"},
+        expected_params={"QueueName": "testqueue"}
+    )
+    sqs_stubber.add_response(
+        "receive_message",
+        {"Messages": messages},
+        expected_params={
+            "QueueUrl": "https://testqueue",
+            "MaxNumberOfMessages": 10,
+            "WaitTimeSeconds": 20
+        }
+    )
+
+
+def test_processor_runner_concurrency():
+    sqs_client = boto3.client("sqs", region_name="naboo")
+    sqs_stubber = botocore.stub.Stubber(sqs_client)
+    messages = [
+        {"ReceiptHandle": f"message{i}", "Body": str(i)} for i in range(3)
+    ]
+    add_queue_responses(sqs_stubber, messages)
+    sqs_stubber.add_response(
+        "delete_message_batch",
+        {"Successful": [{"Id": "0"}, {"Id": "1"}], "Failed": []},
+        expected_params={
+            "QueueUrl": "https://testqueue",
+            "Entries": [
+                {"Id": "0", "ReceiptHandle": "message0"},
+                {"Id": "1", "ReceiptHandle": "message2"}
+            ]
+        }
+    )
+
+    # The barrier can only be passed if all messages are being processed
+    # at the same time
+    barrier = threading.Barrier(3, timeout=5)
+
+    def processor(message):
+        barrier.wait()
+        if message["Body"] == "1":
+            raise common.ProcessorException("Bad message")
+
+    sqs_stubber.activate()
+    common.processor_runner(
+        sqs_client=sqs_client,
+        sqs_queue_name="testqueue",
+        processor=processor,
+        poll_interval_mins=1,
+        daemonize=False,
+        concurrency=3
+    )
+
+    sqs_stubber.assert_no_pending_responses()
+
+
+def test_processor_runner_max_in_flight():
+    sqs_client = boto3.client("sqs", region_name="naboo")
+    sqs_stubber = botocore.stub.Stubber(sqs_client)
+    messages = [
+        {"ReceiptHandle": f"message{i}", "Body": str(i)} for i in range(4)
+    ]
+    add_queue_responses(sqs_stubber, messages)
+    sqs_stubber.add_response(
+        "delete_message_batch",
+        {"Successful": [{"Id": str(i)} for i in range(4)], "Failed": []},
+        expected_params={
+            "QueueUrl": "https://testqueue",
+            "Entries": [
+                {"Id": str(i), "ReceiptHandle": f"message{i}"}
+                for i in range(4)
+            ]
+        }
+    )
+
+    lock = threading.Lock()
+    active = []
+    max_active = []
+
+    def processor(message):
+        with lock:
+            active.append(message)
+            max_active.append(len(active))
+        threading.Event().wait(0.05)
+        with lock:
+            active.remove(message)
+
+    sqs_stubber.activate()
+    common.processor_runner(
+        sqs_client=sqs_client,
+        sqs_queue_name="testqueue",
+        processor=processor,
+        poll_interval_mins=1,
+        daemonize=False,
+        concurrency=4,
+        max_in_flight=2
+    )
+
+    assert max(max_active) <= 2
+    sqs_stubber.assert_no_pending_responses()
+
+
+def test_processor_runner_ordering_key():
+    sqs_client = boto3.client("sqs", region_name="naboo")
+    sqs_stubber = botocore.stub.Stubber(sqs_client)
+    bodies = ["a1", "b1", "a2", "a3"]
+    messages = [
+        {"ReceiptHandle": f"message{i}", "Body": body}
+        for i, body in enumerate(bodies)
+    ]
+    add_queue_responses(sqs_stubber, messages)
+    # Later messages with the key of a failed message are left on the queue
+    sqs_stubber.add_response(
+        "delete_message_batch",
+        {"Successful": [{"Id": "0"}, {"Id": "1"}], "Failed": []},
+        expected_params={
+            "QueueUrl": "https://testqueue",
+            "Entries": [
+                {"Id": "0", "ReceiptHandle": "message0"},
+                {"Id": "1", "ReceiptHandle": "message1"}
+            ]
+        }
+    )
+
+    # The barrier can only be passed if messages with different keys are
+    # processed at the same time
+    barrier = threading.Barrier(2, timeout=5)
+    processed = []
+
+    def processor(message):
+        processed.append(message["Body"])
+        if message["Body"] in ["a1", "b1"]:
+            barrier.wait()
+        if message["Body"] == "a2":
+            raise common.ProcessorException("Bad message")
+
+    sqs_stubber.activate()
+    common.processor_runner(
+        sqs_client=sqs_client,
+        sqs_queue_name="testqueue",
+        processor=processor,
+        poll_interval_mins=1,
+        daemonize=False,
+        concurrency=4,
+        ordering_key=lambda message: message["Body"][0]
+    )
+
+    assert [body for body in processed if body[0] == "a"] == ["a1", "a2"]
+    assert "b1" in processed
+    sqs_stubber.assert_no_pending_responses()
+
+
+def test_delete_sqs_messages_partial_failures(mocker):
+    mock_sleep = mocker.patch("time.sleep")
+    sqs_client = boto3.client("sqs", region_name="naboo")
+    sqs_stubber = botocore.stub.Stubber(sqs_client)
+    receipt_handles = [f"message{i}" for i in range(12)]
+
+    sqs_stubber.add_response(
+        "delete_message_batch",
+        {
+            "Successful": [{"Id": str(i)} for i in range(8)],
+            "Failed": [
+                {"Id": "8", "SenderFault": False, "Code": "InternalError"},
+                {"Id": "9", "SenderFault": True, "Code": "InvalidHandle",
+                 "Message": "Invalid handle"}
+            ]
+        },
+        expected_params={
+            "QueueUrl": "https://testqueue",
+            "Entries": [
+                {"Id": str(i), "ReceiptHandle": f"message{i}"}
+                for i in range(10)
+            ]
+        }
+    )
+    # Only the entry that failed for a transient reason is retried
+    sqs_stubber.add_response(
+        "delete_message_batch",
+        {"Successful": [{"Id": "8"}], "Failed": []},
+        expected_params={
+            "QueueUrl": "https://testqueue",
+            "Entries": [{"Id": "8", "ReceiptHandle": "message8"}]
+        }
+    )
+    sqs_stubber.add_response(
+        "delete_message_batch",
+        {"Successful": [{"Id": "0"}, {"Id": "1"}], "Failed": []},
+        expected_params={
+            "QueueUrl": "https://testqueue",
+            "Entries": [
+                {"Id": "0", "ReceiptHandle": "message10"},
+                {"Id": "1", "ReceiptHandle": "message11"}
+            ]
+        }
+    )
+
+    sqs_stubber.activate()
+    common.delete_sqs_messages(
+        sqs_client, "https://testqueue", receipt_handles
+    )
+
+    sqs_stubber.assert_no_pending_responses()
+    mock_sleep.assert_called_once_with(common.SQS_DELETE_RETRY_BASE_SECS)
+
+
+def test_delete_sqs_messages_retries_exhausted(mocker, caplog):
+    mock_sleep = mocker.patch("time.sleep")
+    sqs_client = boto3.client("sqs", region_name="naboo")
+    sqs_stubber = botocore.stub.Stubber(sqs_client)
+
+    for code in ["InternalError", "InternalError", "ServiceUnavailable"]:
+        sqs_stubber.add_response(
+            "delete_message_batch",
+            {
+                "Successful": [],
+                "Failed": [
+                    {"Id": "0", "SenderFault": False, "Code": code},
+                    {"Id": "1", "SenderFault": False, "Code": "InternalError"}
+                ]
+            },
+            expected_params={
+                "QueueUrl": "https://testqueue",
+                "Entries": [
+                    {"Id": "0", "ReceiptHandle": "message0"},
+                    {"Id": "1", "ReceiptHandle": "message1"}
+                ]
+            }
+        )
+
+    sqs_stubber.activate()
+    common.delete_sqs_messages(
+        sqs_client, "https://testqueue", ["message0", "message1"]
+    )
+
+    sqs_stubber.assert_no_pending_responses()
+    # The wait doubles before each retry
+    assert [call.args[0] for call in mock_sleep.call_args_list] == [
+        common.SQS_DELETE_RETRY_BASE_SECS,
+        common.SQS_DELETE_RETRY_BASE_SECS * 2
+    ]
+    # The remaining failures are logged once with their last failure codes
+    errors = [
+        record.getMessage() for record in caplog.records
+        if record.levelname == "ERROR"
+    ]
+    assert errors == [
+        "Failed deleting 2 SQS messages after 3 attempts: "
+        "{'0': 'ServiceUnavailable', '1': 'InternalError'}"
+    ]
+
+
+def test_visibility_heartbeat(mocker):
+    sqs_client = mocker.Mock()
+    extended = threading.Event()
+    sqs_client.change_message_visibility_batch.side_effect = \
+        lambda **_: extended.set() or {"Successful": [], "Failed": []}
+
+    heartbeat = common.VisibilityHeartbeat(
+        sqs_client, "https://testqueue", 60, interval_secs=0.01
+    )
+    heartbeat.track("message1")
+    heartbeat.start()
+    assert extended.wait(5)
+    heartbeat.untrack("message1")
+    heartbeat.stop()
+
+    sqs_client.change_message_visibility_batch.assert_called_with(
+        QueueUrl="https://testqueue",
+        Entries=[{
+            "Id": "0",
+            "ReceiptHandle": "message1",
+            "VisibilityTimeout": 60
+        }]
+    )
+
+    # Untracked messages are no longer extended
+    sqs_client.change_message_visibility_batch.reset_mock()
+    heartbeat = common.VisibilityHeartbeat(
+        sqs_client, "https://testqueue", 60, interval_secs=0.01
+    )
+    heartbeat.start()
+    threading.Event().wait(0.05)
+    heartbeat.stop()
+    sqs_client.change_message_visibility_batch.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "queue_visibility_timeout,expected_interval",
+    [(None, 150), (30, 15), (600, 150)]
+)
+def test_visibility_heartbeat_interval(
+    mocker, queue_visibility_timeout, expected_interval
+):
+    heartbeat = common.VisibilityHeartbeat(
+        mocker.Mock(),
+        "https://testqueue",
+        300,
+        queue_visibility_timeout_secs=queue_visibility_timeout
+    )
+    assert heartbeat.interval_secs == expected_interval
+
+
+def test_processor_runner_heartbeat_queue_visibility_timeout(mocker):
+    sqs_client = mocker.Mock()
+    sqs_client.get_queue_url.return_value = {"QueueUrl": "https://testqueue"}
+    sqs_client.get_queue_attributes.return_value = {
+        "Attributes": {"VisibilityTimeout": "30"}
+    }
+    sqs_client.receive_message.return_value = {"Messages": []}
+    mock_heartbeat = mocker.patch(
+        "raise_data.processors.common.VisibilityHeartbeat"
+    )
+
+    common.processor_runner(
+        sqs_client=sqs_client,
+        sqs_queue_name="testqueue",
+        processor=lambda message: None,
+        poll_interval_mins=1,
+        daemonize=False,
+        visibility_timeout_secs=300
+    )
+
+    mock_heartbeat.assert_called_once_with(
+        sqs_client,
+        "https://testqueue",
+        300,
+        queue_visibility_timeout_secs=30
+    )
+
+
+@pytest.mark.parametrize(
+    "visibility_timeout,failed_entries,expected_messages",
+    [
+        ("30", [], [{"ReceiptHandle": "message1"}]),
+        (
+            "30",
+            [{"Id": "0", "SenderFault": True, "Code": "InvalidHandle"}],
+            []
+        ),
+        ("0", [], [])
+    ]
+)
+def test_sqs_message_prefetcher(
+    mocker, visibility_timeout, failed_entries, expected_messages
+):
+    sqs_client = mocker.Mock()
+    sqs_client.get_queue_attributes.return_value = {
+        "Attributes": {"VisibilityTimeout": visibility_timeout}
+    }
+    sqs_client.receive_message.return_value = {
+        "Messages": [{"ReceiptHandle": "message1"}]
+    }
+    sqs_client.change_message_visibility_batch.return_value = {
+        "Successful": [], "Failed": failed_entries
+    }
+
+    prefetcher = common.SQSMessagePrefetcher(
+        sqs_client, "https://testqueue", 1
+    )
+    prefetcher.start()
+    # Batches that waited longer than the visibility timeout are dropped,
+    # and otherwise their visibility timeout is reset when handed out
+    assert prefetcher.get() == expected_messages
+    prefetcher.stop()
+
+    sqs_client.get_queue_attributes.assert_called_once_with(
+        QueueUrl="https://testqueue",
+        AttributeNames=["VisibilityTimeout"]
+    )
+    if visibility_timeout != "0":
+        sqs_client.change_message_visibility_batch.assert_called_once_with(
+            QueueUrl="https://testqueue",
+            Entries=[{
+                "Id": "0",
+                "ReceiptHandle": "message1",
+                "VisibilityTimeout": 30
+            }]
+        )
+
+
+def test_sqs_message_prefetcher_heartbeat(mocker):
+    sqs_client = mocker.Mock()
+    sqs_client.receive_message.return_value = {
+        "Messages": [{"ReceiptHandle": "message1"}]
+    }
+    heartbeat = mocker.Mock()
+
+    prefetcher = common.SQSMessagePrefetcher(
+        sqs_client, "https://testqueue", 1, heartbeat
+    )
+    prefetcher.start()
+    assert prefetcher.get() == [{"ReceiptHandle": "message1"}]
+    heartbeat.track.assert_any_call("message1")
+    prefetcher.stop()
+
+    # The visibility timeout is extended by the heartbeat instead
+    sqs_client.get_queue_attributes.assert_not_called()
+
+
+def test_poll_scheduler_backoff(mocker):
+    sqs_client = mocker.Mock()
+    poll_scheduler = common.PollScheduler(sqs_client, "https://testqueue", 5)
+
+    delays = [poll_scheduler.next_delay([]) for _ in range(5)]
+    assert delays == [1, 2, 4, 5, 5]
+
+    # Receiving messages resets the backoff so the queue is polled again
+    # immediately
+    assert poll_scheduler.next_delay([{"ReceiptHandle": "message1"}]) == 0
+    assert poll_scheduler.next_delay([]) == 1
+    sqs_client.get_queue_attributes.assert_not_called()
+
+
+def test_poll_scheduler_check_queue_depth(mocker):
+    sqs_client = mocker.Mock()
+    sqs_client.get_queue_attributes.side_effect = [
+        {"Attributes": {"ApproximateNumberOfMessages": "0"}},
+        {"Attributes": {"ApproximateNumberOfMessages": "0"}},
+        {"Attributes": {"ApproximateNumberOfMessages": "3"}},
+        {"Attributes": {"ApproximateNumberOfMessages": "0"}},
+    ]
+    poll_scheduler = common.PollScheduler(
+        sqs_client, "https://testqueue", 60, check_queue_depth=True
+    )
+
+    delays = [poll_scheduler.next_delay([]) for _ in range(4)]
+    assert delays == [1, 2, 0, 1]
+    sqs_client.get_queue_attributes.assert_called_with(
+        QueueUrl="https://testqueue",
+        AttributeNames=["ApproximateNumberOfMessages"]
+    )
+
+
+def test_poll_scheduler_check_queue_depth_failure(mocker):
+    sqs_client = mocker.Mock()
+    sqs_client.get_queue_attributes.side_effect = ClientError(
+        {"Error": {"Code": "ThrottlingException"}}, "GetQueueAttributes"
+    )
+    poll_scheduler = common.PollScheduler(
+        sqs_client, "https://testqueue", 60, check_queue_depth=True
+    )
+
+    delays = [poll_scheduler.next_delay([]) for _ in range(3)]
+    assert delays == [1, 2, 4]
+
+
+def test_sqs_message_prefetcher_poll_scheduler_failure(mocker):
+    sqs_client = mocker.Mock()
+    sqs_client.receive_message.return_value = {
+        "Messages": [{"ReceiptHandle": "message1"}]
+    }
+    poll_scheduler = mocker.Mock()
+    poll_scheduler.next_delay.side_effect = RuntimeError("Lost connection")
+
+    prefetcher = common.SQSMessagePrefetcher(
+        sqs_client, "https://testqueue", 1, mocker.Mock(), poll_scheduler
+    )
+    prefetcher.start()
+    assert prefetcher.get() == [{"ReceiptHandle": "message1"}]
+    # The error is raised to the consumer instead of leaving get blocked
+    with pytest.raises(RuntimeError):
+        prefetcher.get()
+    prefetcher.stop()
+
+
+@pytest.mark.parametrize("batch_fails", [False, True])
+def test_processor_runner_batch_processor(batch_fails):
+    sqs_client = boto3.client("sqs", region_name="naboo")
+    sqs_stubber = botocore.stub.Stubber(sqs_client)
+    messages = [
+        {"ReceiptHandle": f"message{i}", "Body": str(i)} for i in range(3)
+    ]
+    add_queue_responses(sqs_stubber, messages)
+
+    # When the batch fails the messages are retried individually, so only
+    # the bad message is left on the queue
+    processed_handles = ["message0", "message2"] if batch_fails else \
+        ["message0", "message1", "message2"]
+    sqs_stubber.add_response(
+        "delete_message_batch",
+        {"Successful": [], "Failed": []},
+        expected_params={
+            "QueueUrl": "https://testqueue",
+            "Entries": [
+                {"Id": str(i), "ReceiptHandle": handle}
+                for i, handle in enumerate(processed_handles)
+            ]
+        }
+    )
+
+    batches = []
+    individual = []
+
+    def batch_processor(sqs_messages):
+        batches.append(sqs_messages)
+        if batch_fails:
+            raise common.ProcessorException("Bad message in batch")
+
+    def processor(message):
+        individual.append(message)
+        if message["Body"] == "1":
+            raise common.ProcessorException("Bad message")
+
+    sqs_stubber.activate()
+    common.processor_runner(
+        sqs_client=sqs_client,
+        sqs_queue_name="testqueue",
+        processor=processor,
+        poll_interval_mins=1,
+        daemonize=False,
+        batch_processor=batch_processor
+    )
+
+    assert batches == [messages]
+    assert individual == (messages if batch_fails else [])
+    sqs_stubber.assert_no_pending_responses()
+
+
+def test_get_runner_config(mocker):
+    mocker.patch("os.environ", {
+        "PROCESSOR_CONCURRENCY": "4",
+        "SQS_VISIBILITY_TIMEOUT_SECS": "60",
+        "SQS_CHECK_QUEUE_DEPTH": "True"
+    })
+
+    runner_config = common.get_runner_config()
+
+    assert list(runner_config) == common.RUNNER_OPTIONS
+    assert runner_config == {
+        "concurrency": 4,
+        "max_in_flight": 0,
+        "visibility_timeout_secs": 60,
+        "prefetch_batches": 0,
+        "check_queue_depth": True
+    }
@@ -11,6 +11,7 @@ from raise_data.dashboard.schema import (
     ContentLoadedEvent,
     PsetProblemAttemptedEvent,
     InputSubmittedEvent,
+    ProcessedObject,
 )
 
 
@@ -23,9 +24,23 @@ def clear_database_tables():
         session.query(ContentLoadedEvent).delete()
         session.query(PsetProblemAttemptedEvent).delete()
         session.query(InputSubmittedEvent).delete()
-
-
-def test_process_content_loaded_event_data(mocker):
+        session.query(ProcessedObject).delete()
+
+
+# Empty strings are stored as they are rather than as NULL in every mode
+@pytest.mark.parametrize(
+    "ingest_mode,decode_workers,variant",
+    [
+        ("insert", "0", "main"),
+        ("copy", "0", "main"),
+        ("insert", "0", ""),
+        ("copy", "0", ""),
+        ("insert", "2", "main")
+    ]
+)
+def test_process_content_loaded_event_data(
+    mocker, ingest_mode, decode_workers, variant
+):
     s3_client = boto3.client("s3")
     sqs_client = boto3.client("sqs", region_name="halo")
     s3_stubber = botocore.stub.Stubber(s3_client)
@@ -75,7 +90,7 @@ def test_process_content_loaded_event_data(mocker):
             "source_query": "query",
             "timestamp": 1671306033221,
             "content_id": "c16c2d65-b03d-4769-bd57-aca27af11fc0",
-            "variant": "main",
+            "variant": variant,
         },
         {
             "user_uuid": "c7c2a07f-bf25-40e0-b497-4823579aea10",
@@ -87,7 +102,7 @@ def test_process_content_loaded_event_data(mocker):
             "source_query": "query",
             "timestamp": 1671306338950,
             "content_id": "c64e158e-7168-4438-bd16-565adeeb87fd",
-            "variant": "main",
+            "variant": variant,
         },
     ]
     for _ in range(2):
@@ -117,11 +132,11 @@ def test_process_content_loaded_event_data(mocker):
             },
         )
         sqs_stubber.add_response(
-            "delete_message",
-            {},
+            "delete_message_batch",
+            {"Successful": [{"Id": "0"}], "Failed": []},
             expected_params={
                 "QueueUrl": "https://testqueue",
-                "ReceiptHandle": "message1"
+                "Entries": [{"Id": "0", "ReceiptHandle": "message1"}]
             },
         )
         s3_stubber.add_response(
@@ -145,6 +160,8 @@ def test_process_content_loaded_event_data(mocker):
                 "SQS_QUEUE": "testqueue",
                 "POLL_INTERVAL_MINS": "1",
                 "EVENT_TYPE": "content_loaded_event",
+                "INGEST_MODE": ingest_mode,
+                "DECODE_WORKERS": decode_workers,
             },
         },
     )
@@ -171,7 +188,7 @@ def test_process_content_loaded_event_data(mocker):
             str(content_loaded_event[0].content_id)
             == "c16c2d65-b03d-4769-bd57-aca27af11fc0"
         )
-        assert content_loaded_event[0].variant == "main"
+        assert content_loaded_event[0].variant == variant
         assert (
             content_loaded_event[1].user_uuid_md5 ==
             "a6f9ae229ed5ac799b8cf34065046b36"
@@ -186,7 +203,7 @@ def test_process_content_loaded_event_data(mocker):
             str(content_loaded_event[1].content_id)
             == "c64e158e-7168-4438-bd16-565adeeb87fd"
         )
-        assert content_loaded_event[1].variant == "main"
+        assert content_loaded_event[1].variant == variant
 
     # Run a second pass with the same data to be sure we process properly
     mocker.patch("sys.argv", [""])
@@ -299,11 +316,11 @@ def test_process_input_submitted_event_data(mocker):
             },
         )
         sqs_stubber.add_response(
-            "delete_message",
-            {},
+            "delete_message_batch",
+            {"Successful": [{"Id": "0"}], "Failed": []},
             expected_params={
                 "QueueUrl": "https://testqueue",
-                "ReceiptHandle": "message1"
+                "Entries": [{"Id": "0", "ReceiptHandle": "message1"}]
             },
         )
         s3_stubber.add_response(
@@ -391,7 +408,8 @@ def test_process_input_submitted_event_data(mocker):
     sqs_stubber.assert_no_pending_responses()
 
 
-def test_process_pset_problem_attempted_event_data(mocker):
+@pytest.mark.parametrize("ingest_mode", ["insert", "copy"])
+def test_process_pset_problem_attempted_event_data(mocker, ingest_mode):
     s3_client = boto3.client("s3")
     sqs_client = boto3.client("sqs", region_name="halo")
     s3_stubber = botocore.stub.Stubber(s3_client)
@@ -504,11 +522,11 @@ def test_process_pset_problem_attempted_event_data(mocker):
             },
         )
         sqs_stubber.add_response(
-            "delete_message",
-            {},
+            "delete_message_batch",
+            {"Successful": [{"Id": "0"}], "Failed": []},
             expected_params={
                 "QueueUrl": "https://testqueue",
-                "ReceiptHandle": "message1"
+                "Entries": [{"Id": "0", "ReceiptHandle": "message1"}]
             },
         )
         s3_stubber.add_response(
@@ -532,6 +550,7 @@ def test_process_pset_problem_attempted_event_data(mocker):
                 "SQS_QUEUE": "testqueue",
                 "POLL_INTERVAL_MINS": "1",
                 "EVENT_TYPE": "pset_problem_attempted_event",
+                "INGEST_MODE": ingest_mode,
             },
         },
     )
@@ -618,6 +637,150 @@ def test_process_pset_problem_attempted_event_data(mocker):
     sqs_stubber.assert_no_pending_responses()
 
 
+@pytest.mark.parametrize("ingest_mode", ["insert", "copy"])
+@pytest.mark.parametrize("etag_in_notification", [True, False])
+def test_process_previously_processed_object(
+    mocker, ingest_mode, etag_in_notification
+):
+    s3_client = boto3.client("s3")
+    sqs_client = boto3.client("sqs", region_name="halo")
+    s3_stubber = botocore.stub.Stubber(s3_client)
+    sqs_stubber = botocore.stub.Stubber(sqs_client)
+
+    s3_object = {"key": "testeventkey"}
+    if etag_in_notification:
+        s3_object["eTag"] = "testetag"
+    mock_s3_notification_data = {
+        "Records": [
+            {
+                "eventName": "ObjectCreated:Post",
+                "s3": {
+                    "bucket": {"name": "testeventbucket"},
+                    "object": s3_object,
+                },
+            }
+        ]
+    }
+    mock_sns_data = {"Message": json.dumps(mock_s3_notification_data)}
+    mock_avro_schema = {
+        "namespace": "test",
+        "type": "record",
+        "name": "Event",
+        "fields": [
+            {"name": "user_uuid", "type": "string"},
+            {"name": "course_id", "type": "int"},
+            {"name": "impression_id", "type": "string"},
+            {"name": "source_scheme", "type": "string"},
+            {"name": "source_host", "type": "string"},
+            {"name": "source_path", "type": "string"},
+            {"name": "source_query", "type": "string"},
+            {"name": "timestamp", "type": "int"},
+            {"name": "content_id", "type": "string"},
+            {"name": "variant", "type": "string"},
+        ],
+    }
+    mock_avro_data = [
+        {
+            "user_uuid": "629f56a3-4ddc-4603-a860-89bdcdc04554",
+            "course_id": 1,
+            "impression_id": "0ee17feb-1883-4889-9cd9-81ee541d28a9",
+            "source_scheme": "scheme",
+            "source_host": "host",
+            "source_path": "path",
+            "source_query": "query",
+            "timestamp": 1671306033221,
+            "content_id": "c16c2d65-b03d-4769-bd57-aca27af11fc0",
+            "variant": "main",
+        },
+    ]
+
+    for attempt in range(2):
+        sqs_stubber.add_response(
+            "get_queue_url",
+            {"QueueUrl": "https://testqueue"},
+            expected_params={"QueueName": "testqueue"},
+        )
+        sqs_stubber.add_response(
+            "receive_message",
+            {
+                "Messages": [
+                    {
+                        "ReceiptHandle": "message1",
+                        "Body": json.dumps(mock_sns_data)
+                    }
+                ]
+            },
+            expected_params={
+                "QueueUrl": "https://testqueue",
+                "MaxNumberOfMessages": 10,
+                "WaitTimeSeconds": 20,
+            },
+        )
+        sqs_stubber.add_response(
+            "delete_message_batch",
+            {"Successful": [{"Id": "0"}], "Failed": []},
+            expected_params={
+                "QueueUrl": "https://testqueue",
+                "Entries": [{"Id": "0", "ReceiptHandle": "message1"}]
+            },
+        )
+
+        # The second delivery is skipped without fetching the file if the
+        # notification includes its ETag
+        if attempt == 0 or not etag_in_notification:
+            mock_avro_bytes = io.BytesIO()
+            writer(
+                mock_avro_bytes, parse_schema(mock_avro_schema), mock_avro_data
+            )
+            mock_avro_bytes.seek(0)
+            s3_stubber.add_response(
+                "get_object",
+                {"Body": mock_avro_bytes, "ETag": '"testetag"'},
+                expected_params={
+                    "Bucket": "testeventbucket",
+                    "Key": "testeventkey",
+                },
+            )
+
+    s3_stubber.activate()
+    sqs_stubber.activate()
+    mocker_map = {"s3": s3_client, "sqs": sqs_client}
+    mocker.patch("boto3.client", lambda client: mocker_map[client])
+    mocker.patch(
+        "os.environ",
+        {
+            **os.environ,
+            **{
+                "SQS_QUEUE": "testqueue",
+                "POLL_INTERVAL_MINS": "1",
+                "EVENT_TYPE": "content_loaded_event",
+                "INGEST_MODE": ingest_mode,
+            },
+        },
+    )
+    mocker.patch("sys.argv", [""])
+    events_dashboard_processor.main()
+
+    # Remove the event so a reprocessed file would be noticed
+    with events_dashboard_processor.session_factory.begin() as session:
+        assert session.query(ContentLoadedEvent).delete() == 1
+
+    events_dashboard_processor.main()
+
+    with events_dashboard_processor.session_factory.begin() as session:
+        assert session.query(ContentLoadedEvent).count() == 0
+
+        processed_objects = session.query(ProcessedObject).all()
+        assert len(processed_objects) == 1
+        assert processed_objects[0].bucket == "testeventbucket"
+        assert processed_objects[0].key == "testeventkey"
+        assert processed_objects[0].version == "testetag"
+        assert processed_objects[0].row_count == 1
+
+    s3_stubber.assert_no_pending_responses()
+    sqs_stubber.assert_no_pending_responses()
+
+
 def test_missing_config(mocker):
     mocker.patch("sys.argv", [""])
     with pytest.raises(common.ProcessorException):
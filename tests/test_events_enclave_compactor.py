@@ -0,0 +1,463 @@
+from raise_data.processors import events_enclave_compactor, \
+    events_enclave_processor, common
+import pytest
+import json
+import io
+import boto3
+import botocore.stub
+from fastavro import reader, writer, parse_schema
+
+
+# 2022-12-17 and 2022-12-18 UTC
+DAY1_TIMESTAMP = 1671306033221
+DAY2_TIMESTAMP = 1671392433221
+
+
+def get_event(impression_id, timestamp):
+    return {
+        "impression_id": impression_id,
+        "content_id": "content1",
+        "timestamp": timestamp
+    }
+
+
+def add_json_response(s3_stubber, key, data, etag=None):
+    response = {"Body": io.BytesIO(json.dumps(data).encode("utf-8"))}
+    if etag is not None:
+        response["ETag"] = etag
+    s3_stubber.add_response(
+        "get_object",
+        response,
+        expected_params={"Bucket": "testdatabucket", "Key": key}
+    )
+
+
+def add_put_response(s3_stubber, key, data):
+    s3_stubber.add_response(
+        "put_object",
+        {},
+        {
+            "Bucket": "testdatabucket",
+            "Body": json.dumps(data).encode("utf-8"),
+            "Key": key
+        }
+    )
+
+
+@pytest.mark.parametrize("manifest_conflict", [False, True])
+def test_compact_output(mocker, manifest_conflict):
+    s3_client = boto3.client("s3")
+    s3_stubber = botocore.stub.Stubber(s3_client)
+
+    # Objects retired by the previous run are deleted by this one
+    manifest = {
+        "data_sources": ["s3://testeventbucket/1", "s3://testeventbucket/2"],
+        "shards": ["testdata/shards/1.json", "testdata/shards/2.json"],
+        "partitions": {
+            "2022-12-17": "testdata/partitions/2022-12-17/old.json"
+        },
+        "retired": ["testdata/shards/0.json"]
+    }
+    # A processor adds a shard while the compaction is running
+    updated_manifest = {
+        "data_sources": manifest["data_sources"] + ["s3://testeventbucket/3"],
+        "shards": manifest["shards"] + ["testdata/shards/3.json"],
+        "partitions": manifest["partitions"],
+        "retired": manifest["retired"]
+    }
+
+    add_json_response(
+        s3_stubber, "testdata/manifest.json", manifest, etag='"etag1"'
+    )
+    add_json_response(s3_stubber, "testdata/shards/1.json", {
+        "data_sources": ["s3://testeventbucket/1"],
+        "data": [
+            get_event("impression1", DAY1_TIMESTAMP),
+            get_event("impression2", DAY2_TIMESTAMP)
+        ]
+    })
+    add_json_response(s3_stubber, "testdata/shards/2.json", {
+        "data_sources": ["s3://testeventbucket/2"],
+        "data": [
+            get_event("impression2", DAY2_TIMESTAMP),
+            get_event("impression3", DAY2_TIMESTAMP)
+        ]
+    })
+
+    # Events in the existing partition are kept and deduped against
+    add_json_response(
+        s3_stubber,
+        "testdata/partitions/2022-12-17/old.json",
+        {"data": [
+            get_event("impression0", DAY1_TIMESTAMP),
+            get_event("impression1", DAY1_TIMESTAMP)
+        ]}
+    )
+    add_put_response(
+        s3_stubber,
+        "testdata/partitions/2022-12-17/compaction1.json",
+        {"data": [
+            get_event("impression0", DAY1_TIMESTAMP),
+            get_event("impression1", DAY1_TIMESTAMP)
+        ]}
+    )
+    add_put_response(
+        s3_stubber,
+        "testdata/partitions/2022-12-18/compaction1.json",
+        {"data": [
+            get_event("impression2", DAY2_TIMESTAMP),
+            get_event("impression3", DAY2_TIMESTAMP)
+        ]}
+    )
+
+    expected_partitions = {
+        "2022-12-17": "testdata/partitions/2022-12-17/compaction1.json",
+        "2022-12-18": "testdata/partitions/2022-12-18/compaction1.json"
+    }
+    expected_retired = [
+        "testdata/partitions/2022-12-17/old.json",
+        "testdata/shards/1.json",
+        "testdata/shards/2.json"
+    ]
+    add_json_response(
+        s3_stubber, "testdata/manifest.json", manifest, etag='"etag1"'
+    )
+    if manifest_conflict:
+        s3_stubber.add_client_error(
+            "put_object",
+            service_error_code="PreconditionFailed",
+            http_status_code=412,
+            expected_params={
+                "Bucket": "testdatabucket",
+                "Body": json.dumps({
+                    **manifest,
+                    "shards": [],
+                    "partitions": expected_partitions,
+                    "retired": expected_retired
+                }).encode("utf-8"),
+                "Key": "testdata/manifest.json"
+            }
+        )
+        add_json_response(
+            s3_stubber,
+            "testdata/manifest.json",
+            updated_manifest,
+            etag='"etag2"'
+        )
+        expected_manifest = {
+            **updated_manifest,
+            "shards": ["testdata/shards/3.json"],
+            "partitions": expected_partitions,
+            "retired": expected_retired
+        }
+    else:
+        expected_manifest = {
+            **manifest,
+            "shards": [],
+            "partitions": expected_partitions,
+            "retired": expected_retired
+        }
+    add_put_response(s3_stubber, "testdata/manifest.json", expected_manifest)
+
+    s3_stubber.add_response(
+        "delete_objects",
+        {},
+        expected_params={
+            "Bucket": "testdatabucket",
+            "Delete": {
+                "Objects": [{"Key": "testdata/shards/0.json"}],
+                "Quiet": True
+            }
+        }
+    )
+
+    s3_stubber.activate()
+    mocker.patch("boto3.client", lambda client: s3_client)
+    mocker.patch(
+        "raise_data.processors.events_enclave_compactor.uuid.uuid4",
+        return_value=mocker.Mock(hex="compaction1")
+    )
+    mocker.patch(
+        "os.environ",
+        {
+            "JSON_OUTPUT_S3_BUCKET": "testdatabucket",
+            "JSON_OUTPUT_S3_KEY": "testdata.json",
+            "DEDUPE_FIELDS": "impression_id,content_id"
+        }
+    )
+    mocker.patch("sys.argv", [""])
+    events_enclave_compactor.main()
+
+    s3_stubber.assert_no_pending_responses()
+
+
+def test_compact_output_no_shards(mocker):
+    s3_client = boto3.client("s3")
+    s3_stubber = botocore.stub.Stubber(s3_client)
+
+    add_json_response(s3_stubber, "testdata/manifest.json", {
+        "data_sources": ["s3://testeventbucket/1"],
+        "shards": ["testdata/shards/1.json"]
+    })
+
+    s3_stubber.activate()
+    mocker.patch("boto3.client", lambda client: s3_client)
+    mocker.patch(
+        "os.environ",
+        {
+            "JSON_OUTPUT_S3_BUCKET": "testdatabucket",
+            "JSON_OUTPUT_S3_KEY": "testdata.json",
+            "DEDUPE_FIELDS": "impression_id,content_id"
+        }
+    )
+    mocker.patch("sys.argv", ["", "--max-shards", "0"])
+    events_enclave_compactor.main()
+
+    s3_stubber.assert_no_pending_responses()
+
+
+def test_compact_output_avro(mocker):
+    schema = {
+        "namespace": "test",
+        "type": "record",
+        "name": "Event",
+        "fields": [
+            {"name": "impression_id", "type": "string"},
+            {"name": "content_id", "type": "string"},
+            {"name": "timestamp", "type": "long"},
+        ]
+    }
+    shard_bytes = io.BytesIO()
+    writer(shard_bytes, parse_schema(schema), [
+        get_event("impression1", DAY1_TIMESTAMP),
+        get_event("impression1", DAY1_TIMESTAMP)
+    ])
+    manifest = {
+        "data_sources": ["s3://testeventbucket/1"],
+        "shards": ["testdata/shards/1.avro"]
+    }
+    objects = {
+        "testdata/manifest.json": json.dumps(manifest).encode("utf-8"),
+        "testdata/shards/1.avro": shard_bytes.getvalue()
+    }
+    s3_client = mocker.Mock()
+    s3_client.get_object.side_effect = \
+        lambda Bucket, Key: {"Body": io.BytesIO(objects[Key])}
+    s3_client.delete_objects.return_value = {}
+    mocker.patch(
+        "raise_data.processors.events_enclave_compactor.uuid.uuid4",
+        return_value=mocker.Mock(hex="compaction1")
+    )
+
+    events_enclave_compactor.compact_output(
+        s3_client,
+        "testdatabucket",
+        "testdata.json",
+        ["impression_id", "content_id"],
+        output_format="avro",
+        output_codec="gzip"
+    )
+
+    partition_put, manifest_put = s3_client.put_object.call_args_list
+    assert partition_put.kwargs["Key"] == \
+        "testdata/partitions/2022-12-17/compaction1.avro"
+    partition_reader = reader(io.BytesIO(partition_put.kwargs["Body"]))
+    assert partition_reader.codec == "deflate"
+    assert list(partition_reader) == [get_event("impression1", DAY1_TIMESTAMP)]
+    assert manifest_put.kwargs["Key"] == "testdata/manifest.json"
+    manifest = events_enclave_processor.decode_json_object({
+        "Body": io.BytesIO(manifest_put.kwargs["Body"]),
+        "ContentEncoding": manifest_put.kwargs["ContentEncoding"]
+    })
+    assert manifest["retired"] == ["testdata/shards/1.avro"]
+    s3_client.delete_objects.assert_not_called()
+
+
+def test_compact_output_pset_attempts(mocker):
+    def get_pset_event(attempt):
+        return {
+            "impression_id": "impression1",
+            "pset_problem_content_id": "problem1",
+            "attempt": attempt,
+            "timestamp": DAY1_TIMESTAMP
+        }
+
+    # Every attempt in an impression is kept, while the redelivered attempt
+    # is dropped
+    shards = {
+        "testdata/shards/1.json": [get_pset_event(1), get_pset_event(2)],
+        "testdata/shards/2.json": [get_pset_event(2), get_pset_event(3)]
+    }
+    objects = {
+        "testdata/manifest.json": {
+            "data_sources": ["s3://testeventbucket/1"],
+            "shards": list(shards)
+        },
+        **{key: {"data": events} for key, events in shards.items()}
+    }
+    s3_client = mocker.Mock()
+    s3_client.get_object.side_effect = lambda Bucket, Key: {
+        "Body": io.BytesIO(json.dumps(objects[Key]).encode("utf-8"))
+    }
+    s3_client.delete_objects.return_value = {}
+    mocker.patch(
+        "raise_data.processors.events_enclave_compactor.uuid.uuid4",
+        return_value=mocker.Mock(hex="compaction1")
+    )
+
+    events_enclave_compactor.compact_output(
+        s3_client,
+        "testdatabucket",
+        "testdata.json",
+        ["impression_id", "pset_problem_content_id", "attempt"]
+    )
+
+    partition_put = s3_client.put_object.call_args_list[0]
+    assert partition_put.kwargs["Key"] == \
+        "testdata/partitions/2022-12-17/compaction1.json"
+    assert json.loads(partition_put.kwargs["Body"])["data"] == [
+        get_pset_event(1), get_pset_event(2), get_pset_event(3)
+    ]
+
+
+def get_mock_s3_client(mocker, objects):
+    """Mock S3 client which serves JSON objects by key"""
+    s3_client = mocker.Mock()
+    s3_client.exceptions.NoSuchKey = type("NoSuchKey", (Exception,), {})
+
+    def get_object(Bucket, Key):
+        if Key not in objects:
+            raise s3_client.exceptions.NoSuchKey()
+        return {"Body": io.BytesIO(json.dumps(objects[Key]).encode("utf-8"))}
+
+    s3_client.get_object.side_effect = get_object
+    s3_client.delete_objects.return_value = {}
+    return s3_client
+
+
+def test_compact_output_restored_shard(mocker):
+    # A processor with an older manifest restored a shard retired by the
+    # previous run, so it's compacted again instead of being deleted
+    s3_client = get_mock_s3_client(mocker, {
+        "testdata/manifest.json": {
+            "data_sources": ["s3://testeventbucket/1"],
+            "shards": ["testdata/shards/1.json"],
+            "retired": ["testdata/shards/0.json", "testdata/shards/1.json"]
+        },
+        "testdata/shards/1.json": {
+            "data": [get_event("impression1", DAY1_TIMESTAMP)]
+        }
+    })
+    mocker.patch(
+        "raise_data.processors.events_enclave_compactor.uuid.uuid4",
+        return_value=mocker.Mock(hex="compaction1")
+    )
+
+    events_enclave_compactor.compact_output(
+        s3_client, "testdatabucket", "testdata.json", ["impression_id"]
+    )
+
+    manifest_put = s3_client.put_object.call_args_list[-1]
+    assert json.loads(manifest_put.kwargs["Body"])["retired"] == \
+        ["testdata/shards/1.json"]
+    s3_client.delete_objects.assert_called_once_with(
+        Bucket="testdatabucket",
+        Delete={"Objects": [{"Key": "testdata/shards/0.json"}], "Quiet": True}
+    )
+
+
+def test_compact_output_retired_shard_still_referenced(mocker):
+    # A shard retired by an earlier run was restored by a processor with an
+    # older manifest, and isn't compacted by the next run since it's limited
+    # to one shard
+    objects = {
+        "testdata/manifest.json": {
+            "data_sources": ["s3://testeventbucket/1"],
+            "shards": ["testdata/shards/2.json", "testdata/shards/1.json"],
+            "retired": ["testdata/shards/1.json"]
+        },
+        "testdata/shards/1.json": {
+            "data": [get_event("impression1", DAY1_TIMESTAMP)]
+        },
+        "testdata/shards/2.json": {
+            "data": [get_event("impression2", DAY1_TIMESTAMP)]
+        }
+    }
+    s3_client = get_mock_s3_client(mocker, objects)
+    s3_client.put_object.side_effect = lambda Body, Bucket, Key, **_: \
+        objects.update({Key: json.loads(Body)})
+
+    def compact(compaction_id):
+        mocker.patch(
+            "raise_data.processors.events_enclave_compactor.uuid.uuid4",
+            return_value=mocker.Mock(hex=compaction_id)
+        )
+        events_enclave_compactor.compact_output(
+            s3_client,
+            "testdatabucket",
+            "testdata.json",
+            ["impression_id"],
+            max_shards=1
+        )
+
+    compact("compaction1")
+    # The still referenced shard stays retired
+    assert objects["testdata/manifest.json"]["retired"] == [
+        "testdata/shards/1.json", "testdata/shards/2.json"
+    ]
+    s3_client.delete_objects.assert_not_called()
+
+    compact("compaction2")
+    assert objects["testdata/manifest.json"]["shards"] == []
+    assert objects["testdata/manifest.json"]["retired"] == [
+        "testdata/shards/1.json",
+        "testdata/partitions/2022-12-17/compaction1.json"
+    ]
+    s3_client.delete_objects.assert_called_once_with(
+        Bucket="testdatabucket",
+        Delete={"Objects": [{"Key": "testdata/shards/2.json"}], "Quiet": True}
+    )
+
+    # Once it's no longer referenced, it's deleted by the next run
+    compact("compaction3")
+    s3_client.delete_objects.assert_called_with(
+        Bucket="testdatabucket",
+        Delete={
+            "Objects": [
+                {"Key": "testdata/shards/1.json"},
+                {"Key": "testdata/partitions/2022-12-17/compaction1.json"}
+            ],
+            "Quiet": True
+        }
+    )
+    assert objects["testdata/manifest.json"]["retired"] == []
+
+
+def test_compact_output_missing_shard(mocker):
+    s3_client = get_mock_s3_client(mocker, {
+        "testdata/manifest.json": {
+            "data_sources": ["s3://testeventbucket/1"],
+            "shards": ["testdata/shards/1.json"]
+        }
+    })
+
+    with pytest.raises(common.ProcessorException):
+        events_enclave_compactor.compact_output(
+            s3_client, "testdatabucket", "testdata.json", ["impression_id"]
+        )
+    s3_client.put_object.assert_not_called()
+    s3_client.delete_objects.assert_not_called()
+
+
+@pytest.mark.parametrize("environ", [
+    {},
+    {
+        "JSON_OUTPUT_S3_BUCKET": "testdatabucket",
+        "JSON_OUTPUT_S3_KEY": "testdata.json"
+    }
+])
+def test_missing_config(mocker, environ):
+    mocker.patch("os.environ", environ)
+    mocker.patch("sys.argv", [""])
+    with pytest.raises(common.ProcessorException):
+        events_enclave_compactor.main()
@@ -3,8 +3,10 @@ import pytest
 import json
 import io
 import boto3
+import botocore.awsrequest
 import botocore.stub
-from fastavro import writer, parse_schema
+import hashlib
+from fastavro import reader, writer, parse_schema
 
 
 def test_process_single_message_new_data(mocker):
@@ -93,11 +95,11 @@ def test_process_single_message_new_data(mocker):
         }
     )
     sqs_stubber.add_response(
-        "delete_message",
-        {},
+        "delete_message_batch",
+        {"Successful": [{"Id": "0"}], "Failed": []},
         expected_params={
             "QueueUrl": "https://testqueue",
-            "ReceiptHandle": "message1"
+            "Entries": [{"Id": "0", "ReceiptHandle": "message1"}]
         }
     )
     s3_stubber.add_client_error(
@@ -151,6 +153,157 @@ def test_process_single_message_new_data(mocker):
     sqs_stubber.assert_no_pending_responses()
 
 
+def test_process_message_batch(mocker):
+    s3_client = boto3.client("s3")
+    sqs_client = boto3.client("sqs", region_name="tatooine")
+    s3_stubber = botocore.stub.Stubber(s3_client)
+    sqs_stubber = botocore.stub.Stubber(sqs_client)
+
+    mock_avro_schema = {
+        "namespace": "test",
+        "type": "record",
+        "name": "Event",
+        "fields": [
+            {"name": "course_id", "type": "long"},
+            {"name": "source_scheme", "type": "string"},
+            {"name": "source_host", "type": "string"},
+            {"name": "source_path", "type": "string"},
+            {"name": "source_query", "type": "string"},
+        ]
+    }
+    parsed_schema = parse_schema(mock_avro_schema)
+    mock_messages = []
+    mock_avro_files = []
+    for course_id in [1, 2]:
+        mock_s3_notification_data = {
+            "Records": [{
+                "eventName": "ObjectCreated:Put",
+                "s3": {
+                    "bucket": {
+                        "name": "testeventbucket"
+                    },
+                    "object": {
+                        "key": f"testeventkey{course_id}"
+                    }
+                }
+            }]
+        }
+        mock_sns_data = {
+            "Message": json.dumps(mock_s3_notification_data)
+        }
+        mock_messages.append({
+            "ReceiptHandle": f"message{course_id}",
+            "Body": json.dumps(mock_sns_data)
+        })
+        mock_avro_bytes = io.BytesIO()
+        writer(
+            mock_avro_bytes,
+            parsed_schema,
+            [{
+                "course_id": course_id,
+                "source_scheme": "scheme",
+                "source_host": "host",
+                "source_path": "path",
+                "source_query": "query"
+            }],
+            codec="snappy"
+        )
+        mock_avro_bytes.seek(0)
+        mock_avro_files.append(mock_avro_bytes)
+
+    expected_put_data = {
+            "data_sources": [
+                "s3://testeventbucket/testeventkey1",
+                "s3://testeventbucket/testeventkey2"
+            ],
+            "data": [
+                {"course_id": 1},
+                {"course_id": 2}
+            ]
+    }
+
+    sqs_stubber.add_response(
+        "get_queue_url",
+        {
+            "QueueUrl": "https://testqueue"
+        },
+        expected_params={"QueueName": "testqueue"}
+    )
+    sqs_stubber.add_response(
+        "receive_message",
+        {
+            "Messages": mock_messages
+        },
+        expected_params={
+            "QueueUrl": "https://testqueue",
+            "MaxNumberOfMessages": 10,
+            "WaitTimeSeconds": 20
+        }
+    )
+    sqs_stubber.add_response(
+        "delete_message_batch",
+        {"Successful": [{"Id": "0"}, {"Id": "1"}], "Failed": []},
+        expected_params={
+            "QueueUrl": "https://testqueue",
+            "Entries": [
+                {"Id": "0", "ReceiptHandle": "message1"},
+                {"Id": "1", "ReceiptHandle": "message2"}
+            ]
+        }
+    )
+    # The output document is only read and written once for the batch
+    s3_stubber.add_client_error(
+        "get_object",
+        service_error_code="NoSuchKey",
+        expected_params={
+            "Bucket": "testdatabucket",
+            "Key": "testdatakey",
+        },
+    )
+    for course_id, mock_avro_bytes in zip([1, 2], mock_avro_files):
+        s3_stubber.add_response(
+            "get_object",
+            {
+                "Body": mock_avro_bytes
+            },
+            expected_params={
+                "Bucket": "testeventbucket",
+                "Key": f"testeventkey{course_id}",
+            }
+        )
+    s3_stubber.add_response(
+        "put_object",
+        {},
+        {
+            "Bucket": "testdatabucket",
+            "Body": json.dumps(expected_put_data).encode("utf-8"),
+            "Key": "testdatakey"
+        }
+    )
+
+    s3_stubber.activate()
+    sqs_stubber.activate()
+    mocker_map = {
+        "s3": s3_client,
+        "sqs": sqs_client
+    }
+    mocker.patch("boto3.client", lambda client: mocker_map[client])
+    mocker.patch(
+        "os.environ",
+        {
+            "SQS_QUEUE": "testqueue",
+            "POLL_INTERVAL_MINS": "1",
+            "JSON_OUTPUT_S3_BUCKET": "testdatabucket",
+            "JSON_OUTPUT_S3_KEY": "testdatakey"
+        }
+    )
+    mocker.patch("sys.argv", [""])
+    events_enclave_processor.main()
+
+    s3_stubber.assert_no_pending_responses()
+    sqs_stubber.assert_no_pending_responses()
+
+
 def test_process_single_message_duplicate_data(mocker):
     s3_client = boto3.client("s3")
     sqs_client = boto3.client("sqs", region_name="tatooine")
@@ -215,11 +368,11 @@ def test_process_single_message_duplicate_data(mocker):
         }
     )
     sqs_stubber.add_response(
-        "delete_message",
-        {},
+        "delete_message_batch",
+        {"Successful": [{"Id": "0"}], "Failed": []},
         expected_params={
             "QueueUrl": "https://testqueue",
-            "ReceiptHandle": "message1"
+            "Entries": [{"Id": "0", "ReceiptHandle": "message1"}]
         }
     )
 
@@ -266,7 +419,175 @@ def test_process_single_message_duplicate_data(mocker):
     sqs_stubber.assert_no_pending_responses()
 
 
-def test_process_single_message_bad_event(mocker):
+def test_process_single_message_sharded(mocker):
+    s3_client = boto3.client("s3")
+    sqs_client = boto3.client("sqs", region_name="tatooine")
+    s3_stubber = botocore.stub.Stubber(s3_client)
+    sqs_stubber = botocore.stub.Stubber(sqs_client)
+
+    mock_s3_notification_data = {
+        "Records": [
+            {
+                "eventName": "ObjectCreated:Put",
+                "s3": {
+                    "bucket": {"name": "testeventbucket"},
+                    "object": {"key": "testeventkey1"}
+                }
+            },
+            {
+                "eventName": "ObjectCreated:Put",
+                "s3": {
+                    "bucket": {"name": "testeventbucket"},
+                    "object": {"key": "testeventkey2"}
+                }
+            }
+        ]
+    }
+    mock_sns_data = {
+        "Message": json.dumps(mock_s3_notification_data)
+    }
+    mock_avro_schema = {
+        "namespace": "test",
+        "type": "record",
+        "name": "Event",
+        "fields": [
+            {"name": "course_id", "type": "long"},
+            {"name": "source_scheme", "type": "string"},
+            {"name": "source_host", "type": "string"},
+            {"name": "source_path", "type": "string"},
+            {"name": "source_query", "type": "string"},
+        ]
+    }
+    mock_avro_bytes = io.BytesIO()
+    writer(
+        mock_avro_bytes,
+        parse_schema(mock_avro_schema),
+        [{
+            "course_id": 3,
+            "source_scheme": "scheme",
+            "source_host": "host",
+            "source_path": "path",
+            "source_query": "query"
+        }],
+        codec="snappy"
+    )
+    mock_avro_bytes.seek(0)
+    existing_shard_key = "testdata/shards/" + hashlib.sha256(
+        b"s3://testeventbucket/testeventkey1"
+    ).hexdigest() + ".json"
+    new_shard_key = "testdata/shards/" + hashlib.sha256(
+        b"s3://testeventbucket/testeventkey2"
+    ).hexdigest() + ".json"
+    mock_manifest_data = {
+        "data_sources": ["s3://testeventbucket/testeventkey1"],
+        "shards": [existing_shard_key]
+    }
+    expected_shard_data = {
+        "data_sources": ["s3://testeventbucket/testeventkey2"],
+        "data": [{"course_id": 3}]
+    }
+    expected_manifest_data = {
+        "data_sources": [
+            "s3://testeventbucket/testeventkey1",
+            "s3://testeventbucket/testeventkey2"
+        ],
+        "shards": [existing_shard_key, new_shard_key]
+    }
+
+    sqs_stubber.add_response(
+        "get_queue_url",
+        {
+            "QueueUrl": "https://testqueue"
+        },
+        expected_params={"QueueName": "testqueue"}
+    )
+    sqs_stubber.add_response(
+        "receive_message",
+        {
+            "Messages": [{
+                "ReceiptHandle": "message1",
+                "Body": json.dumps(mock_sns_data)
+            }]
+        },
+        expected_params={
+            "QueueUrl": "https://testqueue",
+            "MaxNumberOfMessages": 10,
+            "WaitTimeSeconds": 20
+        }
+    )
+    sqs_stubber.add_response(
+        "delete_message_batch",
+        {"Successful": [{"Id": "0"}], "Failed": []},
+        expected_params={
+            "QueueUrl": "https://testqueue",
+            "Entries": [{"Id": "0", "ReceiptHandle": "message1"}]
+        }
+    )
+    s3_stubber.add_response(
+        "get_object",
+        {
+            "Body": io.BytesIO(json.dumps(mock_manifest_data).encode("utf-8"))
+        },
+        expected_params={
+            "Bucket": "testdatabucket",
+            "Key": "testdata/manifest.json",
+        }
+    )
+    s3_stubber.add_response(
+        "get_object",
+        {
+            "Body": mock_avro_bytes
+        },
+        expected_params={
+            "Bucket": "testeventbucket",
+            "Key": "testeventkey2",
+        }
+    )
+    s3_stubber.add_response(
+        "put_object",
+        {},
+        {
+            "Bucket": "testdatabucket",
+            "Body": json.dumps(expected_shard_data).encode("utf-8"),
+            "Key": new_shard_key
+        }
+    )
+    s3_stubber.add_response(
+        "put_object",
+        {},
+        {
+            "Bucket": "testdatabucket",
+            "Body": json.dumps(expected_manifest_data).encode("utf-8"),
+            "Key": "testdata/manifest.json"
+        }
+    )
+
+    s3_stubber.activate()
+    sqs_stubber.activate()
+    mocker_map = {
+        "s3": s3_client,
+        "sqs": sqs_client
+    }
+    mocker.patch("boto3.client", lambda client: mocker_map[client])
+    mocker.patch(
+        "os.environ",
+        {
+            "SQS_QUEUE": "testqueue",
+            "POLL_INTERVAL_MINS": "1",
+            "JSON_OUTPUT_S3_BUCKET": "testdatabucket",
+            "JSON_OUTPUT_S3_KEY": "testdata.json",
+            "OUTPUT_LAYOUT": "sharded"
+        }
+    )
+    mocker.patch("sys.argv", [""])
+    events_enclave_processor.main()
+
+    s3_stubber.assert_no_pending_responses()
+    sqs_stubber.assert_no_pending_responses()
+
+
+@pytest.mark.parametrize("codec", [None, "gzip", "snappy"])
+def test_process_single_message_sharded_avro(mocker, codec):
     s3_client = boto3.client("s3")
     sqs_client = boto3.client("sqs", region_name="tatooine")
     s3_stubber = botocore.stub.Stubber(s3_client)
@@ -274,20 +595,52 @@ def test_process_single_message_bad_event(mocker):
 
     mock_s3_notification_data = {
         "Records": [{
-            "eventName": "ObjectSomething",
+            "eventName": "ObjectCreated:Put",
             "s3": {
-                "bucket": {
-                    "name": "testeventbucket"
-                },
-                "object": {
-                    "key": "testeventkey"
-                }
+                "bucket": {"name": "testeventbucket"},
+                "object": {"key": "testeventkey"}
             }
         }]
     }
     mock_sns_data = {
         "Message": json.dumps(mock_s3_notification_data)
     }
+    mock_avro_schema = {
+        "namespace": "test",
+        "type": "record",
+        "name": "Event",
+        "fields": [
+            {"name": "course_id", "type": "long"},
+            {"name": "source_scheme", "type": "string"},
+            {"name": "source_host", "type": "string"},
+            {"name": "source_path", "type": "string"},
+            {"name": "source_query", "type": "string"},
+        ]
+    }
+    mock_avro_bytes = io.BytesIO()
+    writer(
+        mock_avro_bytes,
+        parse_schema(mock_avro_schema),
+        [
+            {
+                "course_id": course_id,
+                "source_scheme": "scheme",
+                "source_host": "host",
+                "source_path": "path",
+                "source_query": "query"
+            }
+            for course_id in [1, 2]
+        ],
+        codec="snappy"
+    )
+    mock_avro_bytes.seek(0)
+    shard_key = "testdata/shards/" + hashlib.sha256(
+        b"s3://testeventbucket/testeventkey"
+    ).hexdigest() + ".avro"
+    expected_manifest_data = {
+        "data_sources": ["s3://testeventbucket/testeventkey"],
+        "shards": [shard_key]
+    }
 
     sqs_stubber.add_response(
         "get_queue_url",
@@ -310,15 +663,939 @@ def test_process_single_message_bad_event(mocker):
             "WaitTimeSeconds": 20
         }
     )
-
+    sqs_stubber.add_response(
+        "delete_message_batch",
+        {"Successful": [{"Id": "0"}], "Failed": []},
+        expected_params={
+            "QueueUrl": "https://testqueue",
+            "Entries": [{"Id": "0", "ReceiptHandle": "message1"}]
+        }
+    )
     s3_stubber.add_client_error(
         "get_object",
         service_error_code="NoSuchKey",
         expected_params={
             "Bucket": "testdatabucket",
-            "Key": "testdatakey",
-        },
+            "Key": "testdata/manifest.json",
+        }
     )
+    s3_stubber.add_response(
+        "get_object",
+        {
+            "Body": mock_avro_bytes
+        },
+        expected_params={
+            "Bucket": "testeventbucket",
+            "Key": "testeventkey",
+        }
+    )
+    # Avro container files include a random sync marker, so the shard is
+    # checked by reading it back
+    s3_stubber.add_response(
+        "put_object",
+        {},
+        {
+            "Bucket": "testdatabucket",
+            "Body": botocore.stub.ANY,
+            "Key": shard_key
+        }
+    )
+    expected_manifest_body = json.dumps(expected_manifest_data).encode("utf-8")
+    expected_manifest_params = {
+        "Bucket": "testdatabucket",
+        "Body": expected_manifest_body,
+        "Key": "testdata/manifest.json"
+    }
+    if codec is not None:
+        expected_manifest_params["Body"] = bytes(
+            events_enclave_processor.OUTPUT_CODECS[codec].compress(
+                expected_manifest_body
+            )
+        )
+        expected_manifest_params["ContentEncoding"] = codec
+    s3_stubber.add_response("put_object", {}, expected_manifest_params)
+
+    put_bodies = []
+    s3_client.meta.events.register(
+        "provide-client-params.s3.PutObject",
+        lambda params, **kwargs: put_bodies.append(params["Body"])
+    )
+
+    s3_stubber.activate()
+    sqs_stubber.activate()
+    mocker_map = {
+        "s3": s3_client,
+        "sqs": sqs_client
+    }
+    mocker.patch("boto3.client", lambda client: mocker_map[client])
+    environ = {
+        "SQS_QUEUE": "testqueue",
+        "POLL_INTERVAL_MINS": "1",
+        "JSON_OUTPUT_S3_BUCKET": "testdatabucket",
+        "JSON_OUTPUT_S3_KEY": "testdata.json",
+        "OUTPUT_LAYOUT": "sharded",
+        "OUTPUT_FORMAT": "avro"
+    }
+    if codec is not None:
+        environ["OUTPUT_CODEC"] = codec
+    mocker.patch("os.environ", environ)
+    mocker.patch("sys.argv", [""])
+    events_enclave_processor.main()
+
+    s3_stubber.assert_no_pending_responses()
+    sqs_stubber.assert_no_pending_responses()
+
+    shard_reader = reader(io.BytesIO(put_bodies[0]))
+    assert shard_reader.codec == {
+        None: "null", "gzip": "deflate", "snappy": "snappy"
+    }[codec]
+    assert [
+        field["name"] for field in shard_reader.writer_schema["fields"]
+    ] == ["course_id"]
+    assert list(shard_reader) == [{"course_id": 1}, {"course_id": 2}]
+
+
+@pytest.mark.parametrize("environ", [
+    {"STREAMING_OUTPUT": "true", "OUTPUT_LAYOUT": "sharded"},
+    {"STREAMING_OUTPUT": "true", "OUTPUT_CODEC": "zstd"},
+    {"OUTPUT_FORMAT": "parquet"},
+    {"OUTPUT_FORMAT": "avro"},
+    {"OUTPUT_FORMAT": "avro", "OUTPUT_LAYOUT": "sharded",
+     "OUTPUT_CODEC": "zstd"}
+])
+def test_bad_output_format(mocker, environ):
+    mocker.patch("boto3.client")
+    mocker.patch(
+        "os.environ",
+        {
+            "SQS_QUEUE": "testqueue",
+            "POLL_INTERVAL_MINS": "1",
+            "JSON_OUTPUT_S3_BUCKET": "testdatabucket",
+            "JSON_OUTPUT_S3_KEY": "testdatakey",
+            **environ
+        }
+    )
+    mocker.patch("sys.argv", [""])
+    with pytest.raises(common.ProcessorException):
+        events_enclave_processor.main()
+
+
+def get_streaming_s3_client(mocker, objects):
+    """Mock S3 client which serves objects (keyed by bucket and key) and
+    records the parts of multipart uploads.
+    """
+    s3_client = mocker.Mock()
+    s3_client.exceptions.NoSuchKey = type("NoSuchKey", (Exception,), {})
+
+    def get_object(Bucket, Key):
+        if (Bucket, Key) not in objects:
+            raise s3_client.exceptions.NoSuchKey()
+        body, content_encoding = objects[(Bucket, Key)]
+        response = {"Body": io.BytesIO(body)}
+        if content_encoding is not None:
+            response["ContentEncoding"] = content_encoding
+        return response
+
+    s3_client.get_object.side_effect = get_object
+    s3_client.create_multipart_upload.return_value = {"UploadId": "upload1"}
+    s3_client.upload_part.side_effect = \
+        lambda **kwargs: {"ETag": f"etag{kwargs['PartNumber']}"}
+    return s3_client
+
+
+def get_streaming_avro_bytes(course_ids):
+    mock_avro_schema = {
+        "namespace": "test",
+        "type": "record",
+        "name": "Event",
+        "fields": [
+            {"name": "course_id", "type": "long"},
+            {"name": "source_scheme", "type": "string"},
+            {"name": "source_host", "type": "string"},
+            {"name": "source_path", "type": "string"},
+            {"name": "source_query", "type": "string"},
+        ]
+    }
+    avro_bytes = io.BytesIO()
+    writer(
+        avro_bytes,
+        parse_schema(mock_avro_schema),
+        [
+            {
+                "course_id": course_id,
+                "source_scheme": "scheme",
+                "source_host": "host",
+                "source_path": "path",
+                "source_query": "query"
+            }
+            for course_id in course_ids
+        ]
+    )
+    return avro_bytes.getvalue()
+
+
+def get_streaming_sqs_message(keys):
+    mock_s3_notification_data = {
+        "Records": [
+            {
+                "eventName": "ObjectCreated:Put",
+                "s3": {
+                    "bucket": {"name": "testeventbucket"},
+                    "object": {"key": key}
+                }
+            }
+            for key in keys
+        ]
+    }
+    return {
+        "Body": json.dumps({"Message": json.dumps(mock_s3_notification_data)})
+    }
+
+
+@pytest.mark.parametrize("codec", [None, "gzip"])
+@pytest.mark.parametrize("existing_data", [
+    None,
+    {"data_sources": [], "data": []},
+    {
+        "data_sources": ["s3://testeventbucket/testeventkey1"],
+        "data": [{"course_id": 1, "title": "\u00e9t\u00e9 ]}"}]
+    }
+])
+def test_process_notifications_streaming(mocker, codec, existing_data):
+    # Small sizes so the document is read and uploaded in several pieces
+    mocker.patch.object(events_enclave_processor, "STREAM_BUFFER_SIZE", 16)
+    mocker.patch.object(events_enclave_processor, "MULTIPART_PART_SIZE", 64)
+
+    objects = {
+        ("testeventbucket", "testeventkey1"): (
+            get_streaming_avro_bytes([1]), None
+        ),
+        ("testeventbucket", "testeventkey2"): (
+            get_streaming_avro_bytes([2, 3]), None
+        ),
+    }
+    if existing_data is not None:
+        existing_body = json.dumps(existing_data).encode("utf-8")
+        if codec is not None:
+            existing_body = bytes(
+                events_enclave_processor.OUTPUT_CODECS[codec].compress(
+                    existing_body
+                )
+            )
+        objects[("testdatabucket", "testdatakey")] = (existing_body, codec)
+    s3_client = get_streaming_s3_client(mocker, objects)
+
+    processor = events_enclave_processor.get_sqs_message_processor(
+        s3_client, "testdatabucket", "testdatakey",
+        output_codec=codec, streaming_output=True
+    )
+    processor(get_streaming_sqs_message(["testeventkey1", "testeventkey2"]))
+
+    expected_data = existing_data or {"data_sources": [], "data": []}
+    if not expected_data["data_sources"]:
+        expected_data = {
+            "data_sources": ["s3://testeventbucket/testeventkey1"],
+            "data": [{"course_id": 1}]
+        }
+    expected_data = {
+        "data_sources": expected_data["data_sources"] + [
+            "s3://testeventbucket/testeventkey2"
+        ],
+        "data": expected_data["data"] + [{"course_id": 2}, {"course_id": 3}]
+    }
+
+    expected_upload_args = {"Bucket": "testdatabucket", "Key": "testdatakey"}
+    if codec is not None:
+        expected_upload_args["ContentEncoding"] = codec
+    s3_client.create_multipart_upload.assert_called_once_with(
+        **expected_upload_args
+    )
+    parts = s3_client.upload_part.call_args_list
+    assert [part.kwargs["PartNumber"] for part in parts] == \
+        list(range(1, len(parts) + 1))
+    s3_client.complete_multipart_upload.assert_called_once_with(
+        Bucket="testdatabucket",
+        Key="testdatakey",
+        UploadId="upload1",
+        MultipartUpload={"Parts": [
+            {"ETag": f"etag{i}", "PartNumber": i}
+            for i in range(1, len(parts) + 1)
+        ]}
+    )
+
+    body = b"".join(part.kwargs["Body"] for part in parts)
+    if codec is not None:
+        body = bytes(
+            events_enclave_processor.OUTPUT_CODECS[codec].decompress(body)
+        )
+    else:
+        assert len(parts) > 1
+    # The output matches what the in memory path would write
+    assert body == json.dumps(expected_data).encode("utf-8")
+    s3_client.abort_multipart_upload.assert_not_called()
+
+
+def test_process_notifications_streaming_duplicate_data(mocker):
+    existing_data = {
+        "data_sources": ["s3://testeventbucket/testeventkey1"],
+        "data": [{"course_id": 1}]
+    }
+    s3_client = get_streaming_s3_client(mocker, {
+        ("testdatabucket", "testdatakey"): (
+            json.dumps(existing_data).encode("utf-8"), None
+        )
+    })
+
+    processor = events_enclave_processor.get_sqs_message_processor(
+        s3_client, "testdatabucket", "testdatakey", streaming_output=True
+    )
+    processor(get_streaming_sqs_message(["testeventkey1"]))
+
+    s3_client.create_multipart_upload.assert_not_called()
+
+
+def test_process_notifications_streaming_failure(mocker):
+    s3_client = get_streaming_s3_client(mocker, {
+        ("testeventbucket", "testeventkey1"): (b"not avro", None)
+    })
+
+    processor = events_enclave_processor.get_sqs_message_processor(
+        s3_client, "testdatabucket", "testdatakey", streaming_output=True
+    )
+    with pytest.raises(Exception):
+        processor(get_streaming_sqs_message(["testeventkey1"]))
+
+    # The upload is aborted so the existing document is left unchanged
+    s3_client.abort_multipart_upload.assert_called_once_with(
+        Bucket="testdatabucket",
+        Key="testdatakey",
+        UploadId="upload1"
+    )
+    s3_client.complete_multipart_upload.assert_not_called()
+
+
+def test_process_sharded_compacted_output_requires_conditional_writes(
+    mocker
+):
+    manifest = {
+        "data_sources": [],
+        "shards": [],
+        "partitions": {"2022-12-17": "testdata/partitions/2022-12-17/1.json"}
+    }
+    s3_client = get_streaming_s3_client(mocker, {
+        ("testdatabucket", "testdata/manifest.json"): (
+            json.dumps(manifest).encode("utf-8"), None
+        ),
+        ("testeventbucket", "testeventkey1"): (
+            get_streaming_avro_bytes([1]), None
+        )
+    })
+
+    processor = events_enclave_processor.get_sqs_message_processor(
+        s3_client, "testdatabucket", "testdata.json", output_layout="sharded"
+    )
+    with pytest.raises(common.ProcessorException):
+        processor(get_streaming_sqs_message(["testeventkey1"]))
+    s3_client.put_object.assert_not_called()
+
+
+@pytest.mark.parametrize("processed", [False, True])
+def test_process_single_message_sidecar(mocker, processed):
+    s3_client = boto3.client("s3")
+    sqs_client = boto3.client("sqs", region_name="tatooine")
+    s3_stubber = botocore.stub.Stubber(s3_client)
+    sqs_stubber = botocore.stub.Stubber(sqs_client)
+
+    mock_s3_notification_data = {
+        "Records": [{
+            "eventName": "ObjectCreated:Put",
+            "s3": {
+                "bucket": {
+                    "name": "testeventbucket"
+                },
+                "object": {
+                    "key": "testeventkey"
+                }
+            }
+        }]
+    }
+    mock_sns_data = {
+        "Message": json.dumps(mock_s3_notification_data)
+    }
+    mock_sidecar_data = {
+        "data_sources": ["s3://testeventbucket/otherkey"]
+    }
+    if processed:
+        mock_sidecar_data["data_sources"].append(
+            "s3://testeventbucket/testeventkey"
+        )
+    mock_event_data = {
+        "data_sources": mock_sidecar_data["data_sources"],
+        "data": [{"course_id": 1}]
+    }
+
+    sqs_stubber.add_response(
+        "get_queue_url",
+        {
+            "QueueUrl": "https://testqueue"
+        },
+        expected_params={"QueueName": "testqueue"}
+    )
+    sqs_stubber.add_response(
+        "receive_message",
+        {
+            "Messages": [{
+                "ReceiptHandle": "message1",
+                "Body": json.dumps(mock_sns_data)
+            }]
+        },
+        expected_params={
+            "QueueUrl": "https://testqueue",
+            "MaxNumberOfMessages": 10,
+            "WaitTimeSeconds": 20
+        }
+    )
+    sqs_stubber.add_response(
+        "delete_message_batch",
+        {"Successful": [{"Id": "0"}], "Failed": []},
+        expected_params={
+            "QueueUrl": "https://testqueue",
+            "Entries": [{"Id": "0", "ReceiptHandle": "message1"}]
+        }
+    )
+    s3_stubber.add_response(
+        "get_object",
+        {
+            "Body": io.BytesIO(json.dumps(mock_sidecar_data).encode("utf-8"))
+        },
+        expected_params={
+            "Bucket": "testdatabucket",
+            "Key": "testdata/data_sources.json",
+        }
+    )
+
+    # The document is only loaded when the sidecar doesn't list the file
+    if not processed:
+        mock_avro_bytes = io.BytesIO()
+        writer(
+            mock_avro_bytes,
+            parse_schema({
+                "namespace": "test",
+                "type": "record",
+                "name": "Event",
+                "fields": [
+                    {"name": "course_id", "type": "long"},
+                    {"name": "source_scheme", "type": "string"},
+                    {"name": "source_host", "type": "string"},
+                    {"name": "source_path", "type": "string"},
+                    {"name": "source_query", "type": "string"},
+                ]
+            }),
+            [{
+                "course_id": 2,
+                "source_scheme": "scheme",
+                "source_host": "host",
+                "source_path": "path",
+                "source_query": "query"
+            }]
+        )
+        mock_avro_bytes.seek(0)
+        expected_sources = [
+            "s3://testeventbucket/otherkey",
+            "s3://testeventbucket/testeventkey"
+        ]
+
+        s3_stubber.add_response(
+            "get_object",
+            {
+                "Body": io.BytesIO(
+                    json.dumps(mock_event_data).encode("utf-8")
+                )
+            },
+            expected_params={
+                "Bucket": "testdatabucket",
+                "Key": "testdata.json",
+            }
+        )
+        s3_stubber.add_response(
+            "get_object",
+            {
+                "Body": mock_avro_bytes
+            },
+            expected_params={
+                "Bucket": "testeventbucket",
+                "Key": "testeventkey",
+            }
+        )
+        s3_stubber.add_response(
+            "put_object",
+            {},
+            {
+                "Bucket": "testdatabucket",
+                "Body": json.dumps({
+                    "data_sources": expected_sources,
+                    "data": [{"course_id": 1}, {"course_id": 2}]
+                }).encode("utf-8"),
+                "Key": "testdata.json"
+            }
+        )
+        s3_stubber.add_response(
+            "put_object",
+            {},
+            {
+                "Bucket": "testdatabucket",
+                "Body": json.dumps({
+                    "data_sources": expected_sources
+                }).encode("utf-8"),
+                "Key": "testdata/data_sources.json"
+            }
+        )
+
+    s3_stubber.activate()
+    sqs_stubber.activate()
+    mocker_map = {
+        "s3": s3_client,
+        "sqs": sqs_client
+    }
+    mocker.patch("boto3.client", lambda client: mocker_map[client])
+    mocker.patch(
+        "os.environ",
+        {
+            "SQS_QUEUE": "testqueue",
+            "POLL_INTERVAL_MINS": "1",
+            "JSON_OUTPUT_S3_BUCKET": "testdatabucket",
+            "JSON_OUTPUT_S3_KEY": "testdata.json",
+            "DATA_SOURCES_SIDECAR": "true"
+        }
+    )
+    mocker.patch("sys.argv", [""])
+    events_enclave_processor.main()
+
+    s3_stubber.assert_no_pending_responses()
+    sqs_stubber.assert_no_pending_responses()
+
+
+@pytest.mark.parametrize("codec", ["gzip", "zstd", "snappy"])
+def test_process_single_message_output_codec(mocker, codec):
+    s3_client = boto3.client("s3")
+    sqs_client = boto3.client("sqs", region_name="tatooine")
+    s3_stubber = botocore.stub.Stubber(s3_client)
+    sqs_stubber = botocore.stub.Stubber(sqs_client)
+    compression = events_enclave_processor.OUTPUT_CODECS[codec]
+
+    mock_s3_notification_data = {
+        "Records": [{
+            "eventName": "ObjectCreated:Put",
+            "s3": {
+                "bucket": {
+                    "name": "testeventbucket"
+                },
+                "object": {
+                    "key": "testeventkey"
+                }
+            }
+        }]
+    }
+    mock_sns_data = {
+        "Message": json.dumps(mock_s3_notification_data)
+    }
+    mock_event_data = {
+        "data_sources": [
+            "s3://testeventbucket/testeventkey"
+        ],
+        "data": [
+            {"course_id": 1},
+            {"course_id": 2}
+        ]
+    }
+
+    sqs_stubber.add_response(
+        "get_queue_url",
+        {
+            "QueueUrl": "https://testqueue"
+        },
+        expected_params={"QueueName": "testqueue"}
+    )
+    sqs_stubber.add_response(
+        "receive_message",
+        {
+            "Messages": [{
+                "ReceiptHandle": "message1",
+                "Body": json.dumps(mock_sns_data)
+            }]
+        },
+        expected_params={
+            "QueueUrl": "https://testqueue",
+            "MaxNumberOfMessages": 10,
+            "WaitTimeSeconds": 20
+        }
+    )
+    sqs_stubber.add_response(
+        "delete_message_batch",
+        {"Successful": [{"Id": "0"}], "Failed": []},
+        expected_params={
+            "QueueUrl": "https://testqueue",
+            "Entries": [{"Id": "0", "ReceiptHandle": "message1"}]
+        }
+    )
+
+    # The stored document is decompressed based on its ContentEncoding
+    s3_stubber.add_response(
+        "get_object",
+        {
+            "Body": io.BytesIO(bytes(compression.compress(
+                json.dumps(mock_event_data).encode("utf-8")
+            ))),
+            "ContentEncoding": codec
+        },
+        expected_params={
+            "Bucket": "testdatabucket",
+            "Key": "testdatakey",
+        }
+    )
+    s3_stubber.add_response(
+        "put_object",
+        {},
+        {
+            "Bucket": "testdatabucket",
+            "Body": bytes(compression.compress(
+                json.dumps(mock_event_data).encode("utf-8")
+            )),
+            "Key": "testdatakey",
+            "ContentEncoding": codec
+        }
+    )
+
+    s3_stubber.activate()
+    sqs_stubber.activate()
+    mocker_map = {
+        "s3": s3_client,
+        "sqs": sqs_client
+    }
+    mocker.patch("boto3.client", lambda client: mocker_map[client])
+    mocker.patch(
+        "os.environ",
+        {
+            "SQS_QUEUE": "testqueue",
+            "POLL_INTERVAL_MINS": "1",
+            "JSON_OUTPUT_S3_BUCKET": "testdatabucket",
+            "JSON_OUTPUT_S3_KEY": "testdatakey",
+            "OUTPUT_CODEC": codec
+        }
+    )
+    mocker.patch("sys.argv", [""])
+    events_enclave_processor.main()
+
+    s3_stubber.assert_no_pending_responses()
+    sqs_stubber.assert_no_pending_responses()
+
+
+def test_bad_output_codec(mocker):
+    mocker.patch("boto3.client")
+    mocker.patch(
+        "os.environ",
+        {
+            "SQS_QUEUE": "testqueue",
+            "POLL_INTERVAL_MINS": "1",
+            "JSON_OUTPUT_S3_BUCKET": "testdatabucket",
+            "JSON_OUTPUT_S3_KEY": "testdatakey",
+            "OUTPUT_CODEC": "lzma"
+        }
+    )
+    mocker.patch("sys.argv", [""])
+    with pytest.raises(common.ProcessorException):
+        events_enclave_processor.main()
+
+
+@pytest.mark.parametrize("conflicts", [1, 5])
+def test_process_single_message_conditional_writes(mocker, conflicts):
+    s3_client = boto3.client("s3")
+    sqs_client = boto3.client("sqs", region_name="tatooine")
+    s3_stubber = botocore.stub.Stubber(s3_client)
+    sqs_stubber = botocore.stub.Stubber(sqs_client)
+
+    mock_s3_notification_data = {
+        "Records": [{
+            "eventName": "ObjectCreated:Put",
+            "s3": {
+                "bucket": {"name": "testeventbucket"},
+                "object": {"key": "testeventkey2"}
+            }
+        }]
+    }
+    mock_sns_data = {
+        "Message": json.dumps(mock_s3_notification_data)
+    }
+    mock_avro_schema = {
+        "namespace": "test",
+        "type": "record",
+        "name": "Event",
+        "fields": [
+            {"name": "course_id", "type": "long"},
+            {"name": "source_scheme", "type": "string"},
+            {"name": "source_host", "type": "string"},
+            {"name": "source_path", "type": "string"},
+            {"name": "source_query", "type": "string"},
+        ]
+    }
+    mock_avro_bytes = io.BytesIO()
+    writer(
+        mock_avro_bytes,
+        parse_schema(mock_avro_schema),
+        [{
+            "course_id": 2,
+            "source_scheme": "scheme",
+            "source_host": "host",
+            "source_path": "path",
+            "source_query": "query"
+        }]
+    )
+    # Another processor added testeventkey1 after the first attempt read
+    # the output
+    mock_event_data = {
+        "data_sources": ["s3://testeventbucket/testeventkey1"],
+        "data": [{"course_id": 1}]
+    }
+
+    sqs_stubber.add_response(
+        "get_queue_url",
+        {
+            "QueueUrl": "https://testqueue"
+        },
+        expected_params={"QueueName": "testqueue"}
+    )
+    sqs_stubber.add_response(
+        "receive_message",
+        {
+            "Messages": [{
+                "ReceiptHandle": "message1",
+                "Body": json.dumps(mock_sns_data)
+            }]
+        },
+        expected_params={
+            "QueueUrl": "https://testqueue",
+            "MaxNumberOfMessages": 10,
+            "WaitTimeSeconds": 20
+        }
+    )
+
+    attempts = min(conflicts + 1, 5)
+    for attempt in range(attempts):
+        if attempt == 0:
+            s3_stubber.add_client_error(
+                "get_object",
+                service_error_code="NoSuchKey",
+                expected_params={
+                    "Bucket": "testdatabucket",
+                    "Key": "testdatakey",
+                }
+            )
+            expected_put_data = {
+                "data_sources": ["s3://testeventbucket/testeventkey2"],
+                "data": [{"course_id": 2}]
+            }
+        else:
+            s3_stubber.add_response(
+                "get_object",
+                {
+                    "Body": io.BytesIO(
+                        json.dumps(mock_event_data).encode("utf-8")
+                    ),
+                    "ETag": f'"etag{attempt}"'
+                },
+                expected_params={
+                    "Bucket": "testdatabucket",
+                    "Key": "testdatakey",
+                }
+            )
+            expected_put_data = {
+                "data_sources": [
+                    "s3://testeventbucket/testeventkey1",
+                    "s3://testeventbucket/testeventkey2"
+                ],
+                "data": [{"course_id": 1}, {"course_id": 2}]
+            }
+        s3_stubber.add_response(
+            "get_object",
+            {
+                "Body": io.BytesIO(mock_avro_bytes.getvalue())
+            },
+            expected_params={
+                "Bucket": "testeventbucket",
+                "Key": "testeventkey2",
+            }
+        )
+        expected_put_params = {
+            "Bucket": "testdatabucket",
+            "Body": json.dumps(expected_put_data).encode("utf-8"),
+            "Key": "testdatakey"
+        }
+        if attempt < conflicts:
+            s3_stubber.add_client_error(
+                "put_object",
+                service_error_code="PreconditionFailed",
+                http_status_code=412,
+                expected_params=expected_put_params
+            )
+        else:
+            s3_stubber.add_response("put_object", {}, expected_put_params)
+
+    # The message is only deleted if the output was written
+    if conflicts < 5:
+        sqs_stubber.add_response(
+            "delete_message_batch",
+            {"Successful": [{"Id": "0"}], "Failed": []},
+            expected_params={
+                "QueueUrl": "https://testqueue",
+                "Entries": [{"Id": "0", "ReceiptHandle": "message1"}]
+            }
+        )
+
+    s3_stubber.activate()
+    sqs_stubber.activate()
+    mocker_map = {
+        "s3": s3_client,
+        "sqs": sqs_client
+    }
+    mocker.patch("boto3.client", lambda client: mocker_map[client])
+    mocker.patch(
+        "os.environ",
+        {
+            "SQS_QUEUE": "testqueue",
+            "POLL_INTERVAL_MINS": "1",
+            "JSON_OUTPUT_S3_BUCKET": "testdatabucket",
+            "JSON_OUTPUT_S3_KEY": "testdatakey",
+            "CONDITIONAL_WRITES": "true"
+        }
+    )
+    mocker.patch("sys.argv", [""])
+    events_enclave_processor.main()
+
+    s3_stubber.assert_no_pending_responses()
+    sqs_stubber.assert_no_pending_responses()
+
+
+class MockRawResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+def test_conditional_write_headers():
+    # The Stubber responds before the headers are added, so requests are
+    # answered by a stand-in for S3 instead
+    s3_client = boto3.client(
+        "s3",
+        region_name="tatooine",
+        aws_access_key_id="testkey",
+        aws_secret_access_key="testsecret"
+    )
+    events_enclave_processor.register_conditional_writes(s3_client)
+    requests = []
+
+    def send(request, **kwargs):
+        requests.append({
+            header: value.decode("utf-8")
+            for header, value in request.headers.items()
+            if header.startswith("If-")
+        })
+        if request.headers.get("If-Match") == b'"etag1"':
+            return botocore.awsrequest.AWSResponse(
+                request.url,
+                412,
+                {},
+                MockRawResponse(
+                    b"<Error><Code>PreconditionFailed</Code>"
+                    b"<Message>At least one of the pre-conditions you "
+                    b"specified did not hold</Message></Error>"
+                )
+            )
+        return botocore.awsrequest.AWSResponse(
+            request.url,
+            200,
+            {"ETag": '"etag2"'},
+            MockRawResponse(
+                b"<CompleteMultipartUploadResult><ETag>&quot;etag2&quot;"
+                b"</ETag></CompleteMultipartUploadResult>"
+            )
+        )
+
+    s3_client.meta.events.register("before-send.s3.*", send)
+
+    with pytest.raises(events_enclave_processor.OutputConflictException):
+        events_enclave_processor.put_json_data(
+            s3_client, "testdatabucket", "testdatakey", {},
+            condition=events_enclave_processor.get_write_condition(
+                '"etag1"', True
+            )
+        )
+    events_enclave_processor.put_json_data(
+        s3_client, "testdatabucket", "testdatakey", {},
+        condition=events_enclave_processor.get_write_condition(None, True)
+    )
+    s3_client.complete_multipart_upload(
+        Bucket="testdatabucket",
+        Key="testdatakey",
+        UploadId="upload1",
+        MultipartUpload={"Parts": [{"ETag": "etag1", "PartNumber": 1}]},
+        IfMatch='"etag2"'
+    )
+
+    assert requests == [
+        {"If-Match": '"etag1"'},
+        {"If-None-Match": "*"},
+        {"If-Match": '"etag2"'}
+    ]
+
+
+def test_process_single_message_bad_event(mocker):
+    s3_client = boto3.client("s3")
+    sqs_client = boto3.client("sqs", region_name="tatooine")
+    s3_stubber = botocore.stub.Stubber(s3_client)
+    sqs_stubber = botocore.stub.Stubber(sqs_client)
+
+    mock_s3_notification_data = {
+        "Records": [{
+            "eventName": "ObjectSomething",
+            "s3": {
+                "bucket": {
+                    "name": "testeventbucket"
+                },
+                "object": {
+                    "key": "testeventkey"
+                }
+            }
+        }]
+    }
+    mock_sns_data = {
+        "Message": json.dumps(mock_s3_notification_data)
+    }
+
+    sqs_stubber.add_response(
+        "get_queue_url",
+        {
+            "QueueUrl": "https://testqueue"
+        },
+        expected_params={"QueueName": "testqueue"}
+    )
+    sqs_stubber.add_response(
+        "receive_message",
+        {
+            "Messages": [{
+                "ReceiptHandle": "message1",
+                "Body": json.dumps(mock_sns_data)
+            }]
+        },
+        expected_params={
+            "QueueUrl": "https://testqueue",
+            "MaxNumberOfMessages": 10,
+            "WaitTimeSeconds": 20
+        }
+    )
+
+    # The notification is rejected before any output data is read
 
     s3_stubber.activate()
     sqs_stubber.activate()
@@ -13,7 +13,8 @@ def test_load_events_data(mocker):
     list_objects_response = {
         "Contents": [
             {
-                "Key": "topics/1.avro"
+                "Key": "topics/1.avro",
+                "ETag": '"etag1"'
             },
             {
                 "Key": "topics/2.avro"
@@ -33,7 +34,8 @@ def test_load_events_data(mocker):
                         "name": "testbucket"
                     },
                     "object": {
-                        "key": "topics/1.avro"
+                        "key": "topics/1.avro",
+                        "eTag": "etag1"
                     }
                 }
             }]
@@ -5,9 +5,10 @@ import botocore.stub
 import os
 import io
 import json
+import hashlib
 from datetime import datetime, timezone, timedelta
 from raise_data.dashboard.schema import Course, EventUserEnrollment, \
-    CourseActivityStat, CourseQuizStat
+    CourseActivityStat, CourseQuizStat, ProcessedObject
 
 
 @pytest.fixture(autouse=True)
@@ -20,6 +21,7 @@ def clear_database_tables():
         session.query(EventUserEnrollment).delete()
         session.query(CourseActivityStat).delete()
         session.query(CourseQuizStat).delete()
+        session.query(ProcessedObject).delete()
 
 
 def test_process_users_data(mocker):
@@ -88,7 +90,8 @@ def test_process_users_data(mocker):
     ]
 
     # Setting up the sequence of stubs to be expected twice for multiple
-    # invocations
+    # invocations. The object version is only fetched the first time, since
+    # it's in the processed_object ledger afterwards.
     for _ in range(2):
         sqs_stubber.add_response(
             "get_queue_url",
@@ -112,26 +115,26 @@ def test_process_users_data(mocker):
             }
         )
         sqs_stubber.add_response(
-            "delete_message",
-            {},
+            "delete_message_batch",
+            {"Successful": [{"Id": "0"}], "Failed": []},
             expected_params={
                 "QueueUrl": "https://testqueue",
-                "ReceiptHandle": "message1"
+                "Entries": [{"Id": "0", "ReceiptHandle": "message1"}]
             }
         )
 
-        s3_stubber.add_response(
-            "get_object",
-            {
-                "Body": io.StringIO(json.dumps(mock_users_json)),
-                "LastModified": data_timestamp_utc
-            },
-            expected_params={
-                "Bucket": "testeventbucket",
-                "Key": "alg1/term/moodle/users/1.json",
-                "VersionId": "testeventversionid"
-            }
-        )
+    s3_stubber.add_response(
+        "get_object",
+        {
+            "Body": io.BytesIO(json.dumps(mock_users_json).encode("utf-8")),
+            "LastModified": data_timestamp_utc
+        },
+        expected_params={
+            "Bucket": "testeventbucket",
+            "Key": "alg1/term/moodle/users/1.json",
+            "VersionId": "testeventversionid"
+        }
+    )
 
     s3_stubber.activate()
     sqs_stubber.activate()
@@ -180,7 +183,7 @@ def test_process_users_data(mocker):
         assert course_stats[0].weekly_active_users == 2
         assert course_stats[0].daily_active_users == 1
 
-    # Run a second pass with the same data to be sure we process properly
+    # Run a second pass with the same object version to be sure it's skipped
 
     mocker.patch("sys.argv", [""])
     moodle_dashboard_processor.main()
@@ -194,34 +197,111 @@ def test_process_users_data(mocker):
         assert len(enrollments) == 2
         assert len(course_stats) == 1
 
+        processed_objects = session.query(ProcessedObject).all()
+        assert len(processed_objects) == 1
+        assert processed_objects[0].bucket == "testeventbucket"
+        assert processed_objects[0].key == "alg1/term/moodle/users/1.json"
+        assert processed_objects[0].version == "testeventversionid"
+        assert processed_objects[0].row_count == 2
+
     s3_stubber.assert_no_pending_responses()
     sqs_stubber.assert_no_pending_responses()
 
 
+def test_process_users_data_existing_enrollments():
+    data_timestamp_utc = datetime(2022, 1, 1, 3, 0, 0, tzinfo=timezone.utc)
+    users_data = [
+        {
+            "enrolledcourses": [{"id": 1, "fullname": "Course full name"}],
+            "roles": [{"shortname": "student"}],
+            "lastcourseaccess": 0,
+            "uuid": f"user{i}"
+        }
+        for i in range(3)
+    ]
+
+    # An enrollment with a different role from an earlier file is left as is
+    with moodle_dashboard_processor.session_factory.begin() as session:
+        session.add(EventUserEnrollment(
+            course_id=1,
+            role="teacher",
+            user_uuid_md5=hashlib.md5(b"user0").hexdigest()
+        ))
+
+    moodle_dashboard_processor.process_moodle_users_data(
+        "1", "term", users_data, data_timestamp_utc
+    )
+
+    with moodle_dashboard_processor.session_factory.begin() as session:
+        enrollments = session.query(EventUserEnrollment).order_by(
+            EventUserEnrollment.id
+        ).all()
+
+        assert [
+            (enrollment.user_uuid_md5, enrollment.role)
+            for enrollment in enrollments
+        ] == [
+            (hashlib.md5(b"user0").hexdigest(), "teacher"),
+            (hashlib.md5(b"user1").hexdigest(), "student"),
+            (hashlib.md5(b"user2").hexdigest(), "student")
+        ]
+
+
+@pytest.mark.parametrize("lastaccess_delta,expected_active_users", [
+    (timedelta(days=7), (0, 0)),
+    (timedelta(days=7, seconds=-1), (1, 0)),
+    (timedelta(days=1), (1, 0)),
+    (timedelta(days=1, seconds=-1), (1, 1)),
+    (timedelta(hours=-1), (1, 1))
+])
+def test_aggregate_users_data_active_users(
+    lastaccess_delta, expected_active_users
+):
+    data_timestamp_utc = datetime(2022, 1, 1, 3, 0, 0, tzinfo=timezone.utc)
+    users_data = [{
+        "enrolledcourses": [{"id": 1, "fullname": "Course full name"}],
+        "roles": [{"shortname": "student"}],
+        "lastcourseaccess": int(
+            (data_timestamp_utc - lastaccess_delta).timestamp()
+        )
+    }]
+
+    _, course_activity_stats, _ = \
+        moodle_dashboard_processor.aggregate_users_data(
+            "1", "term", iter(users_data), data_timestamp_utc
+        )
+
+    assert (
+        course_activity_stats["weekly_active_users"],
+        course_activity_stats["daily_active_users"]
+    ) == expected_active_users
+
+
 def test_process_grades_data(mocker):
     s3_client = boto3.client("s3")
     sqs_client = boto3.client("sqs", region_name="tatooine")
     s3_stubber = botocore.stub.Stubber(s3_client)
     sqs_stubber = botocore.stub.Stubber(sqs_client)
 
-    mock_s3_notification_data = {
-        "Records": [{
-            "eventName": "ObjectCreated:Put",
-            "s3": {
-                "bucket": {
-                    "name": "testeventbucket"
-                },
-                "object": {
-                    "key": "alg1/term/moodle/grades/1.json",
-                    "versionId": "testeventversionid"
+    def get_mock_sns_data(version_id):
+        mock_s3_notification_data = {
+            "Records": [{
+                "eventName": "ObjectCreated:Put",
+                "s3": {
+                    "bucket": {
+                        "name": "testeventbucket"
+                    },
+                    "object": {
+                        "key": "alg1/term/moodle/grades/1.json",
+                        "versionId": version_id
+                    }
                 }
-            }
-        }]
-    }
+            }]
+        }
 
-    mock_sns_data = {
-        "Message": json.dumps(mock_s3_notification_data)
-    }
+        return {
+            "Message": json.dumps(mock_s3_notification_data)
+        }
 
     data_timestamp_utc = datetime(2022, 1, 1, 3, 0, 0, tzinfo=timezone.utc)
     data_timestamp_minus_1h = data_timestamp_utc - timedelta(hours=1)
@@ -271,7 +351,7 @@ def test_process_grades_data(mocker):
         }
     }
 
-    def setup_sqs_stubs():
+    def setup_sqs_stubs(version_id):
         sqs_stubber.add_response(
             "get_queue_url",
             {
@@ -284,7 +364,7 @@ def test_process_grades_data(mocker):
             {
                 "Messages": [{
                     "ReceiptHandle": "message1",
-                    "Body": json.dumps(mock_sns_data)
+                    "Body": json.dumps(get_mock_sns_data(version_id))
                 }]
             },
             expected_params={
@@ -294,19 +374,19 @@ def test_process_grades_data(mocker):
             }
         )
         sqs_stubber.add_response(
-            "delete_message",
-            {},
+            "delete_message_batch",
+            {"Successful": [{"Id": "0"}], "Failed": []},
             expected_params={
                 "QueueUrl": "https://testqueue",
-                "ReceiptHandle": "message1"
+                "Entries": [{"Id": "0", "ReceiptHandle": "message1"}]
             }
         )
 
-    setup_sqs_stubs()
+    setup_sqs_stubs("testeventversionid")
     s3_stubber.add_response(
         "get_object",
         {
-            "Body": io.StringIO(json.dumps(mock_grades_json_1)),
+            "Body": io.BytesIO(json.dumps(mock_grades_json_1).encode("utf-8")),
             "LastModified": data_timestamp_utc
         },
         expected_params={
@@ -348,8 +428,8 @@ def test_process_grades_data(mocker):
         assert quiz_stats[1].quiz_name == "Quiz 2"
         assert quiz_stats[1].quiz_attempts == 1
 
-    # Run a second pass with slightly different data to confirm the
-    # upsert works
+    # Run a second pass with slightly different data in a new object version
+    # to confirm the upsert works
 
     mock_grades_json_2 = {
         "quizzes": [
@@ -398,17 +478,17 @@ def test_process_grades_data(mocker):
         }
     }
 
-    setup_sqs_stubs()
+    setup_sqs_stubs("testeventversionid2")
     s3_stubber.add_response(
         "get_object",
         {
-            "Body": io.StringIO(json.dumps(mock_grades_json_2)),
+            "Body": io.BytesIO(json.dumps(mock_grades_json_2).encode("utf-8")),
             "LastModified": data_timestamp_utc
         },
         expected_params={
             "Bucket": "testeventbucket",
             "Key": "alg1/term/moodle/grades/1.json",
-            "VersionId": "testeventversionid"
+            "VersionId": "testeventversionid2"
         }
     )
 
@@ -430,6 +510,170 @@ def test_process_grades_data(mocker):
     sqs_stubber.assert_no_pending_responses()
 
 
+@pytest.mark.parametrize("safety_window_days,expected_stats", [
+    (2, [
+        (datetime(2022, 1, 1).date(), 5),
+        (datetime(2022, 1, 8).date(), 2),
+        (datetime(2022, 1, 10).date(), 1),
+        (datetime(2022, 1, 11).date(), 1)
+    ]),
+    # Without a watermark every date in the file is re-counted
+    (None, [
+        (datetime(2022, 1, 1).date(), 1),
+        (datetime(2022, 1, 8).date(), 2),
+        (datetime(2022, 1, 10).date(), 1),
+        (datetime(2022, 1, 11).date(), 1)
+    ])
+])
+def test_process_grades_data_watermark(safety_window_days, expected_stats):
+    latest_date = datetime(2022, 1, 10, tzinfo=timezone.utc)
+
+    def get_attempt(timefinish):
+        return {"quiz": 1, "attempt": 1, "timefinish": timefinish.timestamp()}
+
+    # Stats for dates before the watermark were upserted by earlier files
+    with moodle_dashboard_processor.session_factory.begin() as session:
+        for date, quiz_attempts in [
+            (datetime(2022, 1, 1).date(), 5),
+            (datetime(2022, 1, 8).date(), 1),
+            (latest_date.date(), 1)
+        ]:
+            session.add(CourseQuizStat(
+                course_id=1,
+                date=date,
+                quiz_name="Quiz 1",
+                quiz_attempts=quiz_attempts
+            ))
+
+    grades_data = {
+        "quizzes": [{"id": 1, "name": "Quiz 1"}],
+        "attempts": {
+            "10": {
+                "1": {
+                    "summaries": [
+                        get_attempt(datetime(2022, 1, 1, tzinfo=timezone.utc)),
+                        get_attempt(latest_date - timedelta(days=2)),
+                        get_attempt(latest_date - timedelta(days=2)),
+                        get_attempt(latest_date + timedelta(days=1))
+                    ]
+                }
+            }
+        }
+    }
+
+    moodle_dashboard_processor.process_moodle_grades_data(
+        "1",
+        moodle_dashboard_processor.JSONStreamReader(
+            io.BytesIO(json.dumps(grades_data).encode("utf-8"))
+        ),
+        safety_window_days=safety_window_days
+    )
+
+    with moodle_dashboard_processor.session_factory.begin() as session:
+        quiz_stats = session.query(CourseQuizStat).order_by(
+            CourseQuizStat.date
+        ).all()
+
+        assert [
+            (quiz_stat.date, quiz_stat.quiz_attempts)
+            for quiz_stat in quiz_stats
+        ] == expected_stats
+
+
+@pytest.mark.parametrize("value,expected", [
+    ("7", 7),
+    ("0", 0),
+    ("None", None)
+])
+def test_parse_grades_safety_window_days(value, expected):
+    assert moodle_dashboard_processor.parse_grades_safety_window_days(
+        value
+    ) == expected
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1024])
+def test_json_stream_reader(chunk_size):
+    data = {
+        "attempts": {"10": {"1": {"summaries": [
+            {"quiz": 1, "timefinish": 1640995200},
+            {"quiz": 2, "timefinish": 1641081600.5}
+        ]}}},
+        "quizzes": [{"id": 1, "name": "Quiz \u00e9"}, {"id": 2, "name": ""}],
+        "empty": {},
+        "grade": 1.5,
+        "maxgrade": 10.25
+    }
+    reader = moodle_dashboard_processor.JSONStreamReader(
+        io.BytesIO(json.dumps(data, indent=2).encode("utf-8")),
+        chunk_size=chunk_size
+    )
+
+    parsed = {}
+    for key in reader.iter_object():
+        if key == "attempts":
+            parsed[key] = list(
+                moodle_dashboard_processor.iter_attempt_summaries(reader)
+            )
+        else:
+            parsed[key] = reader.read_value()
+
+    assert parsed == {
+        "attempts": data["attempts"]["10"]["1"]["summaries"],
+        "quizzes": data["quizzes"],
+        "empty": {},
+        "grade": 1.5,
+        "maxgrade": 10.25
+    }
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 4, 5, 1024])
+def test_json_stream_reader_numbers(chunk_size):
+    reader = moodle_dashboard_processor.JSONStreamReader(
+        io.BytesIO(b"[1.5, 1e5, -2.25E-3, 10, 1.5e+2]"),
+        chunk_size=chunk_size
+    )
+
+    assert [reader.read_value() for _ in reader.iter_array()] == \
+        [1.5, 1e5, -2.25e-3, 10, 150.0]
+
+
+@pytest.mark.parametrize("contents,iter_method", [
+    (b"[1, 2", "iter_array"),
+    (b"[1 2]", "iter_array"),
+    (b"{1: 2}", "iter_object"),
+    (b"[1, 2]", "iter_object")
+])
+def test_json_stream_reader_bad_data(contents, iter_method):
+    reader = moodle_dashboard_processor.JSONStreamReader(
+        io.BytesIO(contents), chunk_size=2
+    )
+    with pytest.raises(common.ProcessorException):
+        for _ in getattr(reader, iter_method)():
+            reader.read_value()
+
+
+def test_sqs_message_ordering_key():
+    def get_sqs_message(object_key):
+        s3_notification = {
+            "Records": [{
+                "eventName": "ObjectCreated:Put",
+                "s3": {
+                    "bucket": {"name": "testeventbucket"},
+                    "object": {"key": object_key, "versionId": "version1"}
+                }
+            }]
+        }
+        return {"Body": json.dumps({"Message": json.dumps(s3_notification)})}
+
+    get_ordering_key = moodle_dashboard_processor.get_sqs_message_ordering_key
+
+    # Stats rows are keyed by course ID alone, so the term doesn't matter
+    assert get_ordering_key(get_sqs_message("alg1/term/moodle/users/1.json")) \
+        == get_ordering_key(get_sqs_message("alg1/term2/moodle/users/1.json"))
+    assert get_ordering_key(get_sqs_message("alg1/term/moodle/users/1.json")) \
+        != get_ordering_key(get_sqs_message("alg1/term/moodle/users/2.json"))
+
+
 def test_missing_config(mocker):
     mocker.patch("sys.argv", [""])
     with pytest.raises(common.ProcessorException):
@@ -0,0 +1,114 @@
+from raise_data.processors import processor_host, common, \
+    moodle_dashboard_processor
+import pytest
+import json
+
+
+def test_processor_host(mocker):
+    queue_configs = [
+        {
+            "kind": "events-dashboard",
+            "sqs_queue": "eventsqueue",
+            "poll_interval_mins": 1,
+            "event_type": "content_loaded_event",
+            "concurrency": 4,
+            "decode_workers": 2
+        },
+        {
+            "kind": "events-enclave",
+            "sqs_queue": "enclavequeue",
+            "poll_interval_mins": 1,
+            "output_bucket": "testdatabucket",
+            "output_key": "testdatakey",
+            "visibility_timeout_secs": 60
+        },
+        {
+            "kind": "moodle-dashboard",
+            "sqs_queue": "moodlequeue",
+            "poll_interval_mins": 2,
+            "data_type": "users"
+        }
+    ]
+    mock_runner = mocker.patch(
+        "raise_data.processors.processor_host.processor_runner"
+    )
+    mock_decode_pool = mocker.patch(
+        "raise_data.processors.events_dashboard_processor.ProcessPoolExecutor"
+    )
+    mock_boto3_client = mocker.patch("boto3.client")
+    mocker.patch(
+        "os.environ",
+        {"PROCESSOR_HOST_CONFIG": json.dumps(queue_configs)}
+    )
+    mocker.patch("sys.argv", [""])
+    processor_host.main()
+
+    # Clients are shared by all queues
+    assert mock_boto3_client.call_count == 2
+
+    runner_kwargs = sorted(
+        [call.kwargs for call in mock_runner.call_args_list],
+        key=lambda kwargs: kwargs["sqs_queue_name"]
+    )
+    assert [kwargs["sqs_queue_name"] for kwargs in runner_kwargs] == [
+        "enclavequeue", "eventsqueue", "moodlequeue"
+    ]
+    assert runner_kwargs[0]["visibility_timeout_secs"] == 60
+    assert "concurrency" not in runner_kwargs[0]
+    assert runner_kwargs[1]["concurrency"] == 4
+    assert runner_kwargs[2]["poll_interval_mins"] == 2
+    assert runner_kwargs[0]["ordering_key"] is None
+    assert runner_kwargs[2]["ordering_key"] is \
+        moodle_dashboard_processor.get_sqs_message_ordering_key
+    assert all(kwargs["daemonize"] is False for kwargs in runner_kwargs)
+
+    # Only the events dashboard queue gets a decode pool, which is shut down
+    # once its runner is done
+    mock_decode_pool.assert_called_once()
+    assert mock_decode_pool.call_args.kwargs["max_workers"] == 2
+    mock_decode_pool.return_value.shutdown.assert_called_once()
+
+
+def test_processor_host_runner_failure(mocker):
+    queue_configs = [
+        {
+            "kind": "moodle-dashboard",
+            "sqs_queue": "moodlequeue",
+            "poll_interval_mins": 1,
+            "data_type": "grades"
+        }
+    ]
+    mocker.patch(
+        "raise_data.processors.processor_host.processor_runner",
+        side_effect=RuntimeError("Lost connection")
+    )
+    mocker.patch("boto3.client")
+    mocker.patch(
+        "os.environ",
+        {"PROCESSOR_HOST_CONFIG": json.dumps(queue_configs)}
+    )
+    mocker.patch("sys.argv", [""])
+    with pytest.raises(common.ProcessorException):
+        processor_host.main()
+
+
+@pytest.mark.parametrize("queue_config", [
+    {"kind": "events-dashboard", "poll_interval_mins": 1},
+    {"kind": "unknown", "sqs_queue": "testqueue", "poll_interval_mins": 1}
+])
+def test_processor_host_bad_config(mocker, queue_config):
+    mocker.patch("boto3.client")
+    mocker.patch(
+        "os.environ",
+        {"PROCESSOR_HOST_CONFIG": json.dumps([queue_config])}
+    )
+    mocker.patch("sys.argv", [""])
+    with pytest.raises(common.ProcessorException):
+        processor_host.main()
+
+
+def test_missing_config(mocker):
+    mocker.patch("os.environ", {})
+    mocker.patch("sys.argv", [""])
+    with pytest.raises(common.ProcessorException):
+        processor_host.main()